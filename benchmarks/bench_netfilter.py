@@ -0,0 +1,454 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import netfilter.analyzer
+import netfilter.chaintree
+import netfilter.classifier
+import netfilter.parser
+import netfilter.rule
+import netfilter.simulator
+import netfilter.table
+
+"""
+        bench_netfilter.py                          Author: Zach Bricker
+
+
+        Measures parse, serialize and apply throughput at growing ruleset sizes.
+        Every benchmark runs in its own process so peak RSS is reported per benchmark.
+
+        Usage: python benchmarks/bench_netfilter.py [--sizes 1000,10000] [--save FILE] [--compare FILE]
+
+"""
+
+default_sizes = [1000, 10000, 100000, 1000000]
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def make_spec(i):
+    """
+    Returns the i-th synthetic rule, shaped like the rules of a real edge box
+
+    :param i
+    :return spec
+    """
+    kind = i % 4
+    if kind == 0:
+        return '-i eth0.%d -p tcp -m state --state NEW -m multiport --dports %d,%d -j ACCEPT' % (
+            i % 400, 1024 + i % 5000, 2048 + i % 7000)
+    elif kind == 1:
+        return '-s 10.%d.%d.0/24 -p udp -m udp --dport %d -j ACCEPT' % ((i // 256) % 256, i % 256, i % 65535)
+    elif kind == 2:
+        return '-i eth0.%d -p tcp -j LOG --log-prefix "INPUT %d " --log-level 4' % (i % 400, i)
+    return '! -s 192.168.%d.0/24 -d 172.16.%d.%d -j DROP' % (i % 256, (i // 256) % 256, i % 256)
+
+
+def make_interface_spec(i):
+    """
+    Returns the i-th synthetic rule without ports, keyed only by interface and
+    protocol, like the per-VLAN rules of a router
+
+    :param i
+    :return spec
+    """
+    if i % 2:
+        return '-i eth%d.%d -p udp -j DROP' % (i % 16, i // 2)
+    return '-i eth%d.%d -p tcp -j ACCEPT' % (i % 16, i // 2)
+
+
+def make_dump(size):
+    """
+    Returns an iptables-save -c dump holding size rules
+
+    :param size
+    :return dump
+    """
+    lines = ['*filter',
+             ':INPUT DROP [0:0]',
+             ':FORWARD DROP [0:0]',
+             ':OUTPUT ACCEPT [0:0]',
+             ':bench - [0:0]']
+    for i in range(size):
+        lines.append('[%d:%d] -A bench %s' % (i, i * 64, make_spec(i)))
+    lines.append('COMMIT')
+    return '\n'.join(lines) + '\n'
+
+
+def bench_split_words(size):
+    """
+    Times split_words over size rule specs
+
+    :param size
+    :return ops, elapsed
+    """
+    specs = [make_spec(i) for i in range(size)]
+    start = time.time()
+    for spec in specs:
+        netfilter.parser.split_words(spec)
+    return size, time.time() - start
+
+
+def bench_parse_rule(size):
+    """
+    Times parse_rule over size rule specs
+
+    :param size
+    :return ops, elapsed
+    """
+    specs = [make_spec(i) for i in range(size)]
+    start = time.time()
+    for spec in specs:
+        netfilter.parser.parse_rule(spec)
+    return size, time.time() - start
+
+
+def bench_parse_rules(size):
+    """
+    Times parse_rules on a dump of size rules
+
+    :param size
+    :return ops, elapsed
+    """
+    dump = make_dump(size)
+    start = time.time()
+    netfilter.parser.parse_rules(dump, 'bench')
+    return size, time.time() - start
+
+
+def bench_parse_chains(size):
+    """
+    Times parse_chains on a dump of size rules
+
+    :param size
+    :return ops, elapsed
+    """
+    dump = make_dump(size)
+    start = time.time()
+    netfilter.parser.parse_chains(dump)
+    return size, time.time() - start
+
+
+def bench_parse_save(size):
+    """
+    Times the single pass parse_save on a dump of size rules
+
+    :param size
+    :return ops, elapsed
+    """
+    dump = make_dump(size)
+    start = time.time()
+    netfilter.parser.parse_save(dump)
+    return size, time.time() - start
+
+
+def bench_specbits(size):
+    """
+    Times the first specbits call on size parsed rules
+
+    :param size
+    :return ops, elapsed
+    """
+    rules = netfilter.parser.parse_rules(make_dump(size), 'bench')
+    start = time.time()
+    for rule in rules:
+        rule.specbits()
+    return size, time.time() - start
+
+
+def bench_specbits_cached(size):
+    """
+    Times specbits on size parsed rules that were already serialized
+
+    :param size
+    :return ops, elapsed
+    """
+    rules = netfilter.parser.parse_rules(make_dump(size), 'bench')
+    for rule in rules:
+        rule.specbits()
+    start = time.time()
+    for rule in rules:
+        rule.specbits()
+    return size, time.time() - start
+
+
+def bench_rule_eq(size):
+    """
+    Times Rule.__eq__ between size pairs of equal rules
+
+    :param size
+    :return ops, elapsed
+    """
+    rules = netfilter.parser.parse_rules(make_dump(size), 'bench')
+    others = netfilter.parser.parse_rules(make_dump(size), 'bench')
+    start = time.time()
+    for rule, other in zip(rules, others):
+        rule == other
+    return size, time.time() - start
+
+
+def bench_rule_find(size):
+    """
+    Times linear Rule.find lookups of the last rule in a list of size rules
+
+    :param size
+    :return ops, elapsed
+    """
+    rules = netfilter.parser.parse_rules(make_dump(size), 'bench')
+    wanted = netfilter.parser.parse_rule(make_spec(size - 1))
+    lookups = max(1, 100000 // size)
+    start = time.time()
+    for i in range(lookups):
+        wanted.find(rules)
+    return lookups, time.time() - start
+
+
+def bench_rule_index(size):
+    """
+    Times size Rule.find lookups against a RuleIndex
+
+    :param size
+    :return ops, elapsed
+    """
+    rules = netfilter.parser.parse_rules(make_dump(size), 'bench')
+    index = netfilter.rule.RuleIndex(rules)
+    wanted = netfilter.parser.parse_rules(make_dump(size), 'bench')
+    start = time.time()
+    for rule in wanted:
+        rule.find(index)
+    return size, time.time() - start
+
+
+def bench_classify(size):
+    """
+    Times classifying 10000 packets against a chain of size rules
+
+    :param size
+    :return ops, elapsed
+    """
+    chains = netfilter.parser.parse_save(make_dump(size))
+    chains['INPUT']['rules'].append(netfilter.rule.Rule(jump='bench'))
+    classifier = netfilter.classifier.Classifier(chains)
+    packets = [netfilter.classifier.Packet('tcp', '10.%d.%d.1' % ((i // 256) % 256, i % 256), '172.16.0.1',
+                                           40000, 1024 + i % 5000, 'eth0.%d' % (i % 400))
+               for i in range(10000)]
+    start = time.time()
+    for packet in packets:
+        classifier.verdict('INPUT', packet)
+    return len(packets), time.time() - start
+
+
+def bench_analyze(size):
+    """
+    Times looking for shadowed, redundant and mergeable rules in a chain of size rules
+
+    :param size
+    :return ops, elapsed
+    """
+    rules = netfilter.parser.parse_rules(make_dump(size), 'bench')
+    start = time.time()
+    netfilter.analyzer.analyze_chain(rules, 'bench')
+    return size, time.time() - start
+
+
+def bench_analyze_interfaces(size):
+    """
+    Times analyzing a chain of size port-less rules keyed by interface and protocol
+
+    :param size
+    :return ops, elapsed
+    """
+    rules = [netfilter.parser.parse_rule(make_interface_spec(i)) for i in range(size)]
+    start = time.time()
+    netfilter.analyzer.analyze_chain(rules, 'bench')
+    return size, time.time() - start
+
+
+def bench_chain_tree(size):
+    """
+    Times classifying 10000 packets without the classifier index against an INPUT
+    chain of size per-VLAN rules compiled into a tree, so time follows the number
+    of rules each packet walks
+
+    :param size
+    :return ops, elapsed
+    """
+    rules = [netfilter.parser.parse_rule(make_spec(i * 2)) for i in range(size)]
+    chains = netfilter.chaintree.compile_chain('INPUT', rules)
+    ruleset = netfilter.parser.ODict()
+    for name in chains.keys():
+        ruleset[name] = {'policy': 'DROP' if name == 'INPUT' else None, 'rules': chains[name]}
+    classifier = netfilter.classifier.Classifier(ruleset, indexed=False)
+    packets = [netfilter.classifier.Packet('tcp', '10.0.0.1', '172.16.0.1', 40000, 1024 + i % 5000,
+                                           'eth0.%d' % (i * 2 % 400))
+               for i in range(10000)]
+    start = time.time()
+    for packet in packets:
+        classifier.verdict('INPUT', packet)
+    return len(packets), time.time() - start
+
+
+def commit(size, atomic_commit):
+    """
+    Times committing size buffered appends to the simulator
+
+    :param size
+    :param atomic_commit
+    :return ops, elapsed
+    """
+    backend = netfilter.simulator.SimulatorBackend()
+    table = netfilter.table.Table('filter', False, atomic_commit=atomic_commit, backend=backend)
+    table.create_chain('bench')
+    for i in range(size):
+        table.append_rule('bench', netfilter.parser.parse_rule(make_spec(i)))
+    start = time.time()
+    table.commit()
+    return size, time.time() - start
+
+
+def bench_commit(size):
+    """
+    Times committing size buffered appends one command at a time to the simulator
+
+    :param size
+    :return ops, elapsed
+    """
+    return commit(size, False)
+
+
+def bench_commit_atomic(size):
+    """
+    Times committing size buffered appends as one restore payload to the simulator
+
+    :param size
+    :return ops, elapsed
+    """
+    return commit(size, True)
+
+
+benchmarks = [
+    ('split_words', bench_split_words),
+    ('parse_rule', bench_parse_rule),
+    ('parse_rules', bench_parse_rules),
+    ('parse_chains', bench_parse_chains),
+    ('parse_save', bench_parse_save),
+    ('specbits', bench_specbits),
+    ('specbits_cached', bench_specbits_cached),
+    ('rule_eq', bench_rule_eq),
+    ('rule_find', bench_rule_find),
+    ('rule_index', bench_rule_index),
+    ('classify', bench_classify),
+    ('analyze', bench_analyze),
+    ('analyze_interfaces', bench_analyze_interfaces),
+    ('chain_tree', bench_chain_tree),
+    ('commit', bench_commit),
+    ('commit_atomic', bench_commit_atomic),
+]
+
+
+def child(func, size, queue):
+    """
+    Runs a benchmark and reports its throughput and the process peak RSS
+
+    :param func
+    :param size
+    :param queue
+    :return
+    """
+    ops, elapsed = func(size)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((ops / max(elapsed, 1e-9), rss))
+
+
+def run_benchmark(func, size):
+    """
+    Runs a benchmark in a fresh process
+
+    :param func
+    :param size
+    :return ops_per_sec, peak_rss_kb
+    """
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=child, args=(func, size, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the benchmarks that are slower than the baseline by more than tolerance
+
+    :param results
+    :param baseline
+    :param tolerance
+    :return regressions
+    """
+    regressions = []
+    for key, result in sorted(results.items()):
+        base = baseline.get(key)
+        if base and result['ops_per_sec'] < base['ops_per_sec'] * (1 - tolerance):
+            regressions.append((key, base['ops_per_sec'], result['ops_per_sec']))
+    return regressions
+
+
+def main(args):
+    """
+    Runs the selected benchmarks, optionally saving or comparing against a baseline
+
+    :param args
+    :return status
+    """
+    parser = argparse.ArgumentParser(description='netfilter benchmarks')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in default_sizes))
+    parser.add_argument('--only', default=None, help='comma separated benchmark names')
+    parser.add_argument('--save', nargs='?', const=default_baseline, default=None)
+    parser.add_argument('--compare', nargs='?', const=default_baseline, default=None)
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    opts = parser.parse_args(args)
+
+    sizes = [int(size) for size in opts.sizes.split(',')]
+    selected = benchmarks
+    if opts.only:
+        names = opts.only.split(',')
+        selected = [bench for bench in benchmarks if bench[0] in names]
+
+    results = {}
+    print("%-18s %10s %14s %12s" % ('benchmark', 'rules', 'ops/sec', 'peak RSS kB'))
+    for name, func in selected:
+        for size in sizes:
+            ops_per_sec, rss = run_benchmark(func, size)
+            results['%s/%d' % (name, size)] = {'ops_per_sec': ops_per_sec, 'peak_rss_kb': rss}
+            print("%-18s %10d %14.0f %12d" % (name, size, ops_per_sec, rss))
+            sys.stdout.flush()
+
+    status = 0
+    if opts.compare:
+        with open(opts.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, opts.tolerance)
+        for key, before, after in regressions:
+            print("REGRESSION %s: %.0f -> %.0f ops/sec" % (key, before, after))
+        if regressions:
+            status = 1
+    if opts.save:
+        # entries of benchmarks and sizes that did not run are kept
+        saved = {}
+        if os.path.exists(opts.save):
+            with open(opts.save) as f:
+                saved = json.load(f)
+        saved.update(results)
+        with open(opts.save, 'w') as f:
+            json.dump(saved, f, indent=2, sort_keys=True)
+            f.write('\n')
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
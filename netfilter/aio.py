@@ -0,0 +1,477 @@
+import asyncio
+import re
+import weakref
+
+import netfilter.errors
+import netfilter.firewall
+import netfilter.parser
+import netfilter.table
+
+"""
+        aio.py                                      Author: Zach Bricker
+
+
+        asyncio versions of Table and Firewall, so many tables, address families and
+        network namespaces can be managed concurrently
+
+"""
+
+
+class LoopSemaphore:
+    def __init__(self, concurrency=1):
+        """
+        Constructor. Works like an asyncio.Semaphore, but keeps one per event
+        loop, so the same table or firewall can be driven by several asyncio.run
+        calls one after the other.
+
+        :param concurrency
+        :return
+        """
+        self.concurrency = concurrency
+        self.__semaphores = weakref.WeakKeyDictionary()
+
+    async def __aenter__(self):
+        """
+        Acquires the semaphore of the running loop
+
+        :return
+        """
+        await self.__semaphore().acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        """
+        Releases the semaphore of the running loop
+
+        :param exc_type
+        :param exc
+        :param tb
+        :return
+        """
+        self.__semaphore().release()
+
+    def __semaphore(self):
+        """
+        Returns the semaphore of the running loop, creating it on first use
+
+        :return semaphore
+        """
+        loop = asyncio.get_running_loop()
+        semaphore = self.__semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self.__semaphores[loop] = asyncio.Semaphore(self.concurrency)
+        return semaphore
+
+
+class AsyncTable:
+    def __init__(self, name, auto_commit=True, ipv6=False, atomic_commit=False,
+                 backend=None, concurrency=1, semaphore=None, table=None):
+        """
+        Constructor. Commands are built by a buffered Table and run as asyncio
+        subprocesses, or in an executor when a backend is given. At most
+        concurrency commands run at once. The xtables lock is shared by every
+        table of a network namespace, so tables of one namespace should share
+        a semaphore; otherwise their commands only end up waiting on the lock.
+
+        :param name
+        :param auto_commit
+        :param ipv6
+        :param atomic_commit
+        :param backend
+        :param concurrency
+        :param semaphore
+        :param table
+        :return
+        """
+        if table is None:
+            table = netfilter.table.Table(name, auto_commit=False, ipv6=ipv6,
+                                          atomic_commit=atomic_commit, backend=backend)
+        self.auto_commit = auto_commit
+        self.__table = table
+        self.__backend = backend
+        if semaphore is None:
+            semaphore = LoopSemaphore(concurrency)
+        self.__semaphore = semaphore
+
+    def name(self):
+        """
+        Returns the table name
+
+        :return self.__table.name()
+        """
+        return self.__table.name()
+
+    async def create_chain(self, chainname):
+        """
+        Creates a chain
+
+        :param chainname
+        :return
+        """
+        self.__table.create_chain(chainname)
+        await self.__auto_commit()
+
+    async def delete_chain(self, chainname=None):
+        """
+        Deletes a chain
+
+        :param chainname
+        :return
+        """
+        self.__table.delete_chain(chainname)
+        await self.__auto_commit()
+
+    async def flush_chain(self, chainname=None):
+        """
+        Flushes a chain
+
+        :param chainname
+        :return
+        """
+        self.__table.flush_chain(chainname)
+        await self.__auto_commit()
+
+    async def rename_chain(self, old_chain_name, new_chain_name):
+        """
+        Renames a selected chain
+
+        :param old_chain_name
+        :param new_chain_name
+        :return
+        """
+        self.__table.rename_chain(old_chain_name, new_chain_name)
+        await self.__auto_commit()
+
+    async def set_policy(self, chainname, policy):
+        """
+        Sets a policy
+
+        :param chainname
+        :param policy
+        :return
+        """
+        self.__table.set_policy(chainname, policy)
+        await self.__auto_commit()
+
+    async def append_rule(self, chainname, rule):
+        """
+        Adds a rule to the end of a chain
+
+        :param chainname
+        :param rule
+        :return
+        """
+        self.__table.append_rule(chainname, rule)
+        await self.__auto_commit()
+
+    async def prepend_rule(self, chainname, rule):
+        """
+        Adds a rule to the beginning of the chain
+
+        :param chainname
+        :param rule
+        :return
+        """
+        self.__table.prepend_rule(chainname, rule)
+        await self.__auto_commit()
+
+    async def insert_rule(self, chainname, position, rule):
+        """
+        Inserts a rule at a position (starting at 1) in a chain
+
+        :param chainname
+        :param position
+        :param rule
+        :return
+        """
+        self.__table.insert_rule(chainname, position, rule)
+        await self.__auto_commit()
+
+    async def replace_rule(self, chainname, position, rule):
+        """
+        Replaces the rule at a position (starting at 1) in a chain
+
+        :param chainname
+        :param position
+        :param rule
+        :return
+        """
+        self.__table.replace_rule(chainname, position, rule)
+        await self.__auto_commit()
+
+    async def delete_rule(self, chainname, rule):
+        """
+        Deletes a rule from a particular chain
+
+        :param chainname
+        :param rule
+        :return
+        """
+        self.__table.delete_rule(chainname, rule)
+        await self.__auto_commit()
+
+    async def delete_rule_at(self, chainname, position):
+        """
+        Deletes the rule at a position (starting at 1) in a chain
+
+        :param chainname
+        :param position
+        :return
+        """
+        self.__table.delete_rule_at(chainname, position)
+        await self.__auto_commit()
+
+    async def list_chains(self):
+        """
+        Lists all chains
+
+        :return chains.keys()
+        """
+        chains = await self.get_ruleset()
+        return chains.keys()
+
+    async def get_policy(self, chainname):
+        """
+        Returns a policy
+
+        :param chainname
+        :return chains[chainname]['policy']
+        """
+        chains = await self.get_ruleset()
+        return chains[chainname]['policy']
+
+    async def list_rules(self, chainname):
+        """
+        List all rules under a chain
+
+        :param chainname
+        :return rules
+        """
+        chains = await self.get_ruleset()
+        chain = chains.get(chainname)
+        if chain is None:
+            return []
+        # a copy, so callers cannot change the cached snapshot
+        return list(chain['rules'])
+
+    async def get_ruleset(self):
+        """
+        Returns the policy, counters and rules of every chain from a single dump
+
+        :return chains
+        """
+        cmd = self.__table.get_save_command()
+        async with self.__semaphore:
+            if self.__backend is not None:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(None, self.__backend.load_table, cmd)
+            p = await asyncio.create_subprocess_exec(*cmd,
+                                                     stdout=asyncio.subprocess.PIPE,
+                                                     stderr=asyncio.subprocess.PIPE)
+            chains = netfilter.parser.ODict()
+            # parse while iptables-save is still writing
+            while True:
+                line = await p.stdout.readline()
+                if not line:
+                    break
+                for event in netfilter.parser.iter_save([line.decode()]):
+                    netfilter.parser.index_event(chains, event)
+            err = await p.stderr.read()
+            if await p.wait():
+                raise netfilter.errors.IptablesError(cmd, err.decode())
+            return chains
+
+    async def commit(self):
+        """
+        Commits all changes, either one command at a time or as a single
+        iptables-restore transaction when atomic_commit is set
+
+        :return
+        """
+        buffer = self.__table.get_buffer()
+        if not buffer:
+            return
+        if self.__table.atomic_commit:
+            chains = None
+            if netfilter.table.creates_chains(buffer):
+                chains = await self.get_ruleset()
+            payload = self.__table.get_restore_payload(chains)
+            commands = list(buffer)
+            del buffer[:]
+            try:
+                await self.__run(self.__table.get_restore_command(), payload)
+            except:
+                # keep the transaction for a later retry
+                buffer[0:0] = commands
+                raise
+            return
+        while buffer:
+            cmd = buffer.pop(0)
+            try:
+                await self.__run(cmd)
+            except:
+                buffer.insert(0, cmd)
+                raise
+
+    def get_buffer(self):
+        """
+        Returns the buffer
+
+        :return self.__table.get_buffer()
+        """
+        return self.__table.get_buffer()
+
+    async def __auto_commit(self):
+        """
+        Runs the buffered command right away when auto_commit is set
+
+        :return
+        """
+        if self.auto_commit:
+            await self.commit()
+
+    async def __run(self, cmd, input=None):
+        """
+        Runs the commands for IPTables
+
+        :param cmd
+        :param input
+        :return out
+        """
+        async with self.__semaphore:
+            if self.__backend is not None:
+                loop = asyncio.get_running_loop()
+                try:
+                    return await loop.run_in_executor(None, self.__backend.run, cmd, input)
+                except netfilter.errors.IptablesError as e:
+                    err = e.message
+            else:
+                p = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdin=asyncio.subprocess.PIPE if input is not None else None,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE)
+                if input is not None:
+                    input = input.encode()
+                out, err = await p.communicate(input)
+                if not p.returncode:
+                    return out.decode()
+                err = err.decode()
+        if not re.match(r'(iptables|ip6tables): Chain already exists', err):
+            raise netfilter.errors.IptablesError(cmd, err)
+        return ''
+
+
+class AsyncFirewall(netfilter.firewall.Firewall):
+    def __init__(self, ipv6=False, atomic_commit=False, backend=None, concurrency=1, semaphore=None):
+        """
+        Constructor. The filter and nat attributes stay synchronous and only
+        buffer, so every Firewall helper keeps working; start, stop, restart,
+        reconcile and commit are coroutines. The tables share one semaphore,
+        since they contend for the same xtables lock; pass the same semaphore
+        to firewalls managing one network namespace.
+
+        :param ipv6
+        :param atomic_commit
+        :param backend
+        :param concurrency
+        :param semaphore
+        :return
+        """
+        netfilter.firewall.Firewall.__init__(self, auto_commit=False, ipv6=ipv6,
+                                             atomic_commit=atomic_commit, backend=backend)
+        if semaphore is None:
+            semaphore = LoopSemaphore(concurrency)
+        self.__async_tables = []
+        for table in self.tables():
+            self.__async_tables.append(AsyncTable(table.name(), ipv6=ipv6, backend=backend,
+                                                  semaphore=semaphore, table=table))
+
+    def run(self, args):
+        """
+        Can be used to start, stop, restart or reload the firewall from a shell,
+        running the coroutine to completion
+
+        :param args
+        :return 0
+        :return 1
+        """
+        prog = args[0]
+        commands = {'start': self.start, 'stop': self.stop, 'restart': self.restart, 'reload': self.reconcile}
+        if len(args) < 2 or args[1] not in commands:
+            self.usage(prog)
+            return 1
+        asyncio.run(commands[args[1]]())
+        return 0
+
+    def async_tables(self):
+        """
+        Returns the asynchronous views of the managed tables
+
+        :return list(self.__async_tables)
+        """
+        return list(self.__async_tables)
+
+    async def commit(self):
+        """
+        Commits the buffers of all tables concurrently, after the staged sets
+
+        :return
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.commit_sets)
+        await asyncio.gather(*[table.commit() for table in self.__async_tables])
+
+    async def start(self):
+        """
+        Starts the firewall
+
+        :return
+        """
+        netfilter.firewall.Firewall.start(self)
+        await self.commit()
+
+    async def stop(self):
+        """
+        Stops the firewall
+
+        :return
+        """
+        netfilter.firewall.Firewall.stop(self)
+        await self.commit()
+
+    async def restart(self):
+        """
+        Restarts the firewall
+
+        :return
+        """
+        netfilter.firewall.Firewall.stop(self)
+        netfilter.firewall.Firewall.start(self)
+        await self.commit()
+
+    async def reconcile(self, desired=None):
+        """
+        Brings the live tables to the desired state with as few operations as possible.
+        The live tables are dumped through the shared semaphore and handed to the
+        synchronous tables, so working out the changes dumps nothing on its own.
+
+        :param desired
+        :return applied
+        """
+        rulesets = await self.get_ruleset()
+        for table in self.tables():
+            table.set_snapshot(rulesets[table.name()])
+        loop = asyncio.get_running_loop()
+        applied = await loop.run_in_executor(
+            None, netfilter.firewall.Firewall.reconcile, self, desired)
+        await self.commit()
+        return applied
+
+    async def get_ruleset(self):
+        """
+        Dumps all tables concurrently
+
+        :return rulesets
+        """
+        rulesets = await asyncio.gather(*[table.get_ruleset() for table in self.__async_tables])
+        return dict((table.name(), ruleset) for table, ruleset in zip(self.__async_tables, rulesets))
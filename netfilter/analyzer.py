@@ -0,0 +1,526 @@
+from collections import namedtuple
+
+import netfilter.classifier
+
+"""
+        analyzer.py                                 Author: Zach Bricker
+
+
+        Finds rules that can never match because an earlier rule covers them, rules
+        that can be removed without changing any verdict, and runs of rules that can
+        be merged into one. Earlier rules are indexed in prefix trees on source and
+        destination and by destination port, so each rule is only compared with the
+        few earlier rules that could cover it.
+
+"""
+
+# kind is 'shadowed', 'redundant' or 'mergeable'; related is the position of the
+# covering rule (None for the chain policy) or the positions of a mergeable run
+Finding = namedtuple('Finding', ['kind', 'chain', 'position', 'rule', 'related'])
+
+# targets after which a packet leaves the chain
+terminal_targets = ['ACCEPT', 'DROP', 'REJECT', 'QUEUE', 'NFQUEUE', 'RETURN', 'TARPIT',
+                    'DNAT', 'SNAT', 'MASQUERADE', 'REDIRECT', 'NETMAP']
+
+# multiport takes at most 15 ports, a range counting twice
+multiport_limit = 15
+
+
+class Profile:
+    __slots__ = ('position', 'rule', 'terminal', 'target', 'protocol', 'source', 'destination',
+                 'interfaces', 'ports', 'icmp', 'states', 'others', 'partial', 'never')
+
+    def __init__(self, position, rule, compiled, chains):
+        """
+        Constructor. Breaks a compiled rule down into one constraint per field;
+        a field missing from a dict means the rule does not restrict it.
+
+        :param position
+        :param rule
+        :param compiled
+        :param chains
+        :return
+        """
+        self.position = position
+        self.rule = rule
+        target = rule.goto or rule.jump
+        self.target = target.name() if target is not None else None
+        self.terminal = (rule.goto is not None or
+                         (self.target is not None and self.target not in chains and
+                          (self.target in terminal_targets or
+                           compiled.action == 'verdict' and self.target.upper() == self.target)))
+        self.protocol = None
+        self.source = None
+        self.destination = None
+        self.interfaces = {}
+        self.ports = {}
+        self.icmp = None
+        self.states = None
+        self.never = False
+        for kind, attr, value, negated in compiled.conditions:
+            if kind == 'protocol':
+                self.protocol = (value, negated)
+            elif kind == 'host':
+                setattr(self, attr, (value, negated))
+            elif kind == 'interface':
+                self.interfaces[attr] = (value, negated)
+            elif kind == 'port':
+                if attr in self.ports:
+                    # two port options on one field: never compared
+                    self.ports[attr] = ((), 'both')
+                else:
+                    self.ports[attr] = (tuple(sorted(value)), negated)
+            elif kind == 'icmp':
+                self.icmp = (value, negated)
+            elif kind == 'state':
+                self.states = intersect_states(self.states, (value, negated))
+            elif kind == 'never':
+                self.never = True
+        handled = ('tcp', 'udp', 'sctp', 'multiport', 'icmp', 'icmp6', 'state', 'conntrack')
+        self.others = frozenset(match.key() for match in rule.matches
+                                if match.name() not in handled and
+                                match.name() not in netfilter.classifier.ignored_matches)
+        # handled matches carrying options the classifier does not evaluate, e.g. --tcp-flags
+        partial = set(entry.split(' --')[0] for entry in compiled.unsupported if ' --' in entry)
+        self.partial = frozenset(match.key() for match in rule.matches if match.name() in partial)
+
+    def covers(self, other):
+        """
+        Checks whether every packet matching other also matches this rule
+
+        :param other
+        :return covered
+        """
+        # options that are not understood can only be compared as they are
+        if self.partial != other.partial:
+            return False
+        if self.protocol is not None and self.protocol != other.protocol:
+            return False
+        for attr in ('source', 'destination'):
+            mine = getattr(self, attr)
+            if mine is None:
+                continue
+            theirs = getattr(other, attr)
+            if theirs is None or mine[1] != theirs[1]:
+                return False
+            if mine[1]:
+                if mine[0] != theirs[0]:
+                    return False
+            elif mine[0].version != theirs[0].version or not theirs[0].subnet_of(mine[0]):
+                return False
+        for attr, (pattern, negated) in self.interfaces.items():
+            theirs = other.interfaces.get(attr)
+            if theirs is None or theirs[1] != negated:
+                return False
+            if theirs[0] != pattern:
+                if negated or not pattern.endswith('+') or \
+                        not theirs[0].rstrip('+').startswith(pattern[:-1]):
+                    return False
+        for attr, (ranges, negated) in self.ports.items():
+            theirs = other.ports.get(attr)
+            if negated == 'both' or theirs is None or theirs[1] != negated:
+                return False
+            if negated is False:
+                if not ranges_cover(ranges, theirs[0]):
+                    return False
+            elif ranges != theirs[0]:
+                return False
+        if self.icmp is not None:
+            if other.icmp is None or other.icmp[1] != self.icmp[1]:
+                return False
+            wanted_type, wanted_code = self.icmp[0]
+            icmp_type, code = other.icmp[0]
+            if self.icmp[1]:
+                if self.icmp[0] != other.icmp[0]:
+                    return False
+            elif wanted_type is not None and (wanted_type != icmp_type or
+                                              wanted_code is not None and wanted_code != code):
+                return False
+        if self.states is not None:
+            if other.states is None or other.states[1] != self.states[1]:
+                return False
+            if self.states[1]:
+                if self.states[0] != other.states[0]:
+                    return False
+            elif not other.states[0] <= self.states[0]:
+                return False
+        return self.others <= other.others
+
+    def disjoint(self, other):
+        """
+        Checks whether no packet can match both this rule and other
+
+        :param other
+        :return disjoint
+        """
+        if self.never or other.never:
+            return True
+        if self.protocol is not None and other.protocol is not None:
+            if self.protocol[0] != other.protocol[0]:
+                if not self.protocol[1] and not other.protocol[1]:
+                    return True
+            elif self.protocol[1] != other.protocol[1]:
+                return True
+        for attr in ('source', 'destination'):
+            mine = getattr(self, attr)
+            theirs = getattr(other, attr)
+            if mine is None or theirs is None or mine[0].version != theirs[0].version:
+                continue
+            if not mine[1] and not theirs[1]:
+                if not mine[0].overlaps(theirs[0]):
+                    return True
+            elif mine[1] != theirs[1]:
+                negated, plain = (mine, theirs) if mine[1] else (theirs, mine)
+                if plain[0].subnet_of(negated[0]):
+                    return True
+        for attr, (pattern, negated) in self.interfaces.items():
+            theirs = other.interfaces.get(attr)
+            if theirs is None or negated or theirs[1]:
+                continue
+            mine_prefix = pattern[:-1] if pattern.endswith('+') else None
+            their_prefix = theirs[0][:-1] if theirs[0].endswith('+') else None
+            if mine_prefix is None and their_prefix is None:
+                if pattern != theirs[0]:
+                    return True
+            elif mine_prefix is None:
+                if not pattern.startswith(their_prefix):
+                    return True
+            elif their_prefix is None:
+                if not theirs[0].startswith(mine_prefix):
+                    return True
+            elif not (mine_prefix.startswith(their_prefix) or their_prefix.startswith(mine_prefix)):
+                return True
+        for attr in ('sport', 'dport'):
+            mine = self.ports.get(attr)
+            theirs = other.ports.get(attr)
+            if mine is None or theirs is None or mine[1] is not False or theirs[1] is not False:
+                continue
+            if not any(low <= last and first <= high
+                       for low, high in mine[0] for first, last in theirs[0]):
+                return True
+        if self.states is not None and other.states is not None and \
+                not self.states[1] and not other.states[1]:
+            if not self.states[0] & other.states[0]:
+                return True
+        if self.icmp is not None and other.icmp is not None and \
+                not self.icmp[1] and not other.icmp[1]:
+            mine_type, mine_code = self.icmp[0]
+            their_type, their_code = other.icmp[0]
+            if mine_type is not None and their_type is not None:
+                if mine_type != their_type:
+                    return True
+                if mine_code is not None and their_code is not None and mine_code != their_code:
+                    return True
+        return False
+
+    def merge_key(self):
+        """
+        Returns everything but the destination ports, for finding rules that
+        only differ in them
+
+        :return key
+        """
+        rule = self.rule
+        matches = []
+        for match in rule.matches:
+            options = tuple(option for option in match.key()[1]
+                            if option[0] not in ('dport', 'dports'))
+            matches.append((match.name(), options))
+        return (rule.protocol, rule.in_interface, rule.out_interface, rule.source,
+                rule.destination, tuple(matches), rule.key()[6], rule.key()[7])
+
+
+def intersect_states(states, others):
+    """
+    Returns the (states, negated) constraint holding when both constraints hold
+
+    :param states
+    :param others
+    :return states
+    """
+    if states is None:
+        return others
+    if states[1] and others[1]:
+        return states[0] | others[0], True
+    if not states[1] and not others[1]:
+        return states[0] & others[0], False
+    plain, negated = (others, states) if states[1] else (states, others)
+    return plain[0] - negated[0], False
+
+
+def ranges_cover(ranges, others):
+    """
+    Checks whether sorted (first, last) port ranges contain all of others
+
+    :param ranges
+    :param others
+    :return covered
+    """
+    for first, last in others:
+        if not any(low <= first and last <= high for low, high in ranges):
+            return False
+    return True
+
+
+class PrefixTree:
+    def __init__(self):
+        """
+        Constructor. Nodes are keyed by (version, prefix length, network bits);
+        the node of None holds what applies to every address.
+
+        :return
+        """
+        self.__nodes = {}
+
+    def setdefault(self, network, value):
+        """
+        Returns the value stored under a network, storing value there first if
+        there is none
+
+        :param network
+        :param value
+        :return value
+        """
+        return self.__nodes.setdefault(self.__node(network), value)
+
+    def ancestors(self, network):
+        """
+        Yields the values stored under None and every network containing network,
+        network included
+
+        :param network
+        :return values
+        """
+        value = self.__nodes.get(None)
+        if value is not None:
+            yield value
+        if network is None:
+            return
+        address = int(network.network_address)
+        bits = network.max_prefixlen
+        for length in range(network.prefixlen + 1):
+            value = self.__nodes.get((network.version, length, address >> (bits - length)))
+            if value is not None:
+                yield value
+
+    def __node(self, network):
+        """
+        Returns the key of a network
+
+        :param network
+        :return key
+        """
+        if network is None:
+            return None
+        length = network.prefixlen
+        return network.version, length, int(network.network_address) >> (network.max_prefixlen - length)
+
+
+class CoverIndex:
+    def __init__(self):
+        """
+        Constructor. Profiles are stored in a source prefix tree whose values are
+        destination prefix trees of buckets, keyed by destination port, protocol
+        and input interface, so a rule is only compared with rules that can cover it.
+
+        :return
+        """
+        self.__sources = PrefixTree()
+
+    def add(self, profile):
+        """
+        Indexes a terminal rule
+
+        :param profile
+        :return
+        """
+        tree = self.__sources.setdefault(self.__network(profile.source), PrefixTree())
+        buckets = tree.setdefault(self.__network(profile.destination), {})
+        protocol = profile.protocol
+        interface = profile.interfaces.get('in_interface')
+        # only an exact interface has to be equal to cover; wildcards and negations go to the root
+        if interface is not None and (interface[1] or interface[0].endswith('+')):
+            interface = None
+        else:
+            interface = interface and interface[0]
+        ports = profile.ports.get('dport')
+        if ports is None or ports[1] is not False:
+            buckets.setdefault(('any', protocol, interface), []).append(profile)
+            return
+        expanded = []
+        for first, last in ports[0]:
+            if last - first > 64:
+                buckets.setdefault(('any', protocol, interface), []).append(profile)
+                return
+            expanded.extend(range(first, last + 1))
+        for port in expanded:
+            buckets.setdefault((port, protocol, interface), []).append(profile)
+
+    def first_cover(self, profile):
+        """
+        Returns the earliest indexed rule covering a rule, or None
+
+        :param profile
+        :return cover
+        """
+        best = None
+        ports = profile.ports.get('dport')
+        port_keys = ['any']
+        if ports is not None and ports[1] is False:
+            port_keys.append(ports[0][0][0])
+        protocol_keys = [None]
+        if profile.protocol is not None:
+            protocol_keys.append(profile.protocol)
+        interface_keys = [None]
+        interface = profile.interfaces.get('in_interface')
+        if interface is not None and not interface[1]:
+            interface_keys.append(interface[0])
+        keys = [(port, protocol, interface) for port in port_keys
+                for protocol in protocol_keys for interface in interface_keys]
+        for tree in self.__sources.ancestors(self.__network(profile.source)):
+            for buckets in tree.ancestors(self.__network(profile.destination)):
+                for key in keys:
+                    for candidate in buckets.get(key, ()):
+                        if best is not None and candidate.position >= best.position:
+                            continue
+                        if candidate.covers(profile):
+                            best = candidate
+        return best
+
+    def __network(self, host):
+        """
+        Returns the network a host constraint is indexed under; negated ones are
+        stored at the root and compared when checking coverage
+
+        :param host
+        :return network
+        """
+        if host is None or host[1]:
+            return None
+        return host[0]
+
+
+def profile_rules(rules, chains=()):
+    """
+    Returns the Profile of every rule, or None for rules that cannot be compared,
+    e.g. rules naming a host instead of an address
+
+    :param rules
+    :param chains
+    :return profiles
+    """
+    profiles = []
+    for pos, rule in enumerate(rules):
+        try:
+            compiled = netfilter.classifier.CompiledRule(rule, chains)
+        except Exception:
+            profiles.append(None)
+            continue
+        profiles.append(Profile(pos + 1, rule, compiled, chains))
+    return profiles
+
+
+def analyze_chain(rules, chainname=None, policy=None, chains=()):
+    """
+    Returns the shadowed, redundant and mergeable rules of a chain. chains holds
+    the names of the user chains, so jumps to them are not mistaken for verdicts.
+
+    :param rules
+    :param chainname
+    :param policy
+    :param chains
+    :return findings
+    """
+    findings = []
+    index = CoverIndex()
+    profiles = profile_rules(rules, chains)
+    for profile in profiles:
+        if profile is None:
+            continue
+        pos = profile.position - 1
+        rule = profile.rule
+        if profile.never:
+            findings.append(Finding('shadowed', chainname, pos + 1, rule, None))
+            continue
+        cover = index.first_cover(profile)
+        if cover is not None:
+            if profile.terminal and cover.target == profile.target and \
+                    (cover.rule.goto is None) == (rule.goto is None):
+                findings.append(Finding('redundant', chainname, pos + 1, rule, cover.position))
+            else:
+                findings.append(Finding('shadowed', chainname, pos + 1, rule, cover.position))
+            continue
+        if profile.terminal:
+            index.add(profile)
+
+    flagged = set(finding.position for finding in findings)
+    if policy is not None:
+        # trailing rules giving the policy verdict change nothing, unless a
+        # later rule only looks dead because they shadow it
+        shadowers = dict((finding.position, finding.related) for finding in findings
+                         if finding.kind == 'shadowed')
+        skipped = set()
+        for profile in reversed(profiles):
+            if profile is None or profile.position in skipped:
+                break
+            if profile.position in flagged:
+                skipped.add(shadowers.get(profile.position))
+                continue
+            if profile.target != policy or profile.rule.goto is not None:
+                break
+            findings.append(Finding('redundant', chainname, profile.position, profile.rule, None))
+            flagged.add(profile.position)
+
+    findings.extend(mergeable_runs(profiles, chainname, flagged))
+    findings.sort(key=lambda finding: finding.position)
+    return findings
+
+
+def mergeable_runs(profiles, chainname, flagged=()):
+    """
+    Returns the runs of adjacent rules which only differ in their destination
+    ports, so they fit in one multiport rule
+
+    :param profiles
+    :param chainname
+    :param flagged
+    :return findings
+    """
+    findings = []
+    run = []
+    run_key = None
+    run_ports = 0
+    for profile in profiles + [None]:
+        key = None
+        ports = 0
+        if profile is not None and profile.position not in flagged:
+            dports = profile.ports.get('dport')
+            if dports is not None and dports[1] is False and profile.protocol is not None:
+                key = profile.merge_key()
+                ports = sum(1 if first == last else 2 for first, last in dports[0])
+        if key is not None and key == run_key and run_ports + ports <= multiport_limit:
+            run.append(profile)
+            run_ports += ports
+            continue
+        if len(run) > 1:
+            positions = tuple(member.position for member in run)
+            for member in run:
+                findings.append(Finding('mergeable', chainname, member.position, member.rule, positions))
+        run = [profile] if key is not None else []
+        run_key = key
+        run_ports = ports
+    return findings
+
+
+def analyze(chains):
+    """
+    Analyzes every chain of a ruleset as returned by Table.get_ruleset
+
+    :param chains
+    :return findings
+    """
+    findings = []
+    for name in chains.keys():
+        chain = chains[name]
+        findings.extend(analyze_chain(chain['rules'], name, chain.get('policy'), chains))
+    return findings
@@ -0,0 +1,534 @@
+import abc
+import os
+import subprocess
+import threading
+
+import netfilter.capabilities
+import netfilter.errors
+import netfilter.parser
+
+"""
+        backend.py                                  Author: Zach Bricker
+
+
+        The ways a Table can reach netfilter: by running the iptables binaries, or by
+        handling their command lines in-process
+
+"""
+
+# the tables an in-process iptables-save dumps when no table is given
+save_tables = ['raw', 'mangle', 'nat', 'filter']
+
+
+class Backend(metaclass=abc.ABCMeta):
+    @abc.abstractmethod
+    def run(self, cmd, input=None):
+        """
+        Runs an iptables, iptables-save or iptables-restore command line
+
+        :param cmd
+        :param input
+        :return out
+        """
+        raise NotImplementedError
+
+    def stream(self, cmd):
+        """
+        Runs a command and yields its output line by line
+
+        :param cmd
+        :return lines
+        """
+        return netfilter.parser.iter_lines(self.run(cmd))
+
+    def load_table(self, cmd):
+        """
+        Runs an iptables-save command and returns the parsed chains
+
+        :param cmd
+        :return netfilter.parser.parse_save(self.stream(cmd))
+        """
+        return netfilter.parser.parse_save(self.stream(cmd))
+
+    def load_tables(self, cmd):
+        """
+        Runs an iptables-save command dumping several tables and returns the parsed chains of each
+
+        :param cmd
+        :return netfilter.parser.parse_tables(self.stream(cmd))
+        """
+        return netfilter.parser.parse_tables(self.stream(cmd))
+
+    def wait_option(self, iptables):
+        """
+        Returns the options making iptables wait for the xtables lock
+
+        :param iptables
+        :return []
+        """
+        return []
+
+    def restore_wait_option(self, iptables):
+        """
+        Returns the options making iptables-restore wait for the xtables lock
+
+        :param iptables
+        :return []
+        """
+        return []
+
+
+class SubprocessBackend(Backend):
+    def run(self, cmd, input=None):
+        """
+        Runs the commands for IPTables
+
+        :param cmd
+        :param input
+        :return out
+        """
+        p = subprocess.Popen(cmd,
+                             stdin=subprocess.PIPE if input is not None else None,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             close_fds=True,
+                             universal_newlines=True)
+        out, err = p.communicate(input)
+        # check exit status
+        if p.returncode:
+            raise netfilter.errors.IptablesError(cmd, err)
+        return out
+
+    def stream(self, cmd):
+        """
+        Runs a command and yields its output line by line
+
+        :param cmd
+        :return lines
+        """
+        p = subprocess.Popen(cmd,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             close_fds=True,
+                             universal_newlines=True)
+        # stderr is drained by a thread so a flood of warnings can never block the dump
+        errors = []
+        drain = threading.Thread(target=self.__drain, args=(p.stderr, errors), daemon=True)
+        drain.start()
+        try:
+            for line in p.stdout:
+                yield line
+        finally:
+            p.stdout.close()
+            status = p.wait()
+            drain.join()
+        # check exit status
+        if status:
+            raise netfilter.errors.IptablesError(cmd, ''.join(errors))
+
+    def __drain(self, pipe, lines):
+        """
+        Collects the lines of a pipe until it is closed
+
+        :param pipe
+        :param lines
+        :return
+        """
+        try:
+            for line in pipe:
+                lines.append(line)
+        finally:
+            pipe.close()
+
+    def wait_option(self, iptables):
+        """
+        Returns the options making iptables wait for the xtables lock
+
+        :param iptables
+        :return option
+        """
+        if netfilter.capabilities.probe(iptables, self.run)['wait']:
+            return ['--wait']
+        return []
+
+    def restore_wait_option(self, iptables):
+        """
+        Returns the options making iptables-restore wait for the xtables lock
+
+        :param iptables
+        :return option
+        """
+        if netfilter.capabilities.probe(iptables, self.run)['restore_wait']:
+            return ['--wait']
+        return []
+
+
+class CommandBackend(Backend):
+    def run(self, cmd, input=None):
+        """
+        Handles an iptables, iptables-save or iptables-restore command line in-process
+
+        :param cmd
+        :param input
+        :return out
+        """
+        binary = os.path.basename(cmd[0])
+        if binary == 'ipset':
+            return self.ipset(cmd, input)
+        if binary.startswith('ip6'):
+            family = 'ipv6'
+        else:
+            family = 'ipv4'
+        if binary.endswith('-save'):
+            return ''.join(self.stream(cmd))
+        elif binary.endswith('-restore'):
+            self.restore(cmd, family, input or '', '--noflush' in cmd or '-n' in cmd)
+            return ''
+        args = [arg for arg in cmd[1:] if arg not in ('--wait', '-w')]
+        if args in (['--version'], ['-V']):
+            return self.version(binary)
+        table = 'filter'
+        if len(args) > 1 and args[0] == '-t':
+            table = args[1]
+            args = args[2:]
+        self.command(cmd, family, table, args)
+        return ''
+
+    def stream(self, cmd):
+        """
+        Yields the iptables-save output of a table, or of every table without -t
+
+        :param cmd
+        :return lines
+        """
+        args = cmd[1:]
+        family = 'ipv6' if os.path.basename(cmd[0]).startswith('ip6') else 'ipv4'
+        if '-t' not in args:
+            return self.dump_all(family)
+        table = args[args.index('-t') + 1]
+        return self.dump(family, table)
+
+    def dump_all(self, family):
+        """
+        Yields the iptables-save -c output of every table, one section after the other
+
+        :param family
+        :return lines
+        """
+        for table in save_tables:
+            for line in self.dump(family, table):
+                yield line
+
+    def ipset(self, cmd, input=None):
+        """
+        Runs an ipset command line; there is nothing to do it in-process with
+
+        :param cmd
+        :param input
+        :return out
+        """
+        return SubprocessBackend().run(cmd, input)
+
+    def version(self, binary):
+        """
+        Returns the version line of the emulated binary
+
+        :param binary
+        :return version
+        """
+        return "%s v1.8.7 (in-process)\n" % binary.split('-')[0]
+
+    def command(self, cmd, family, table, args):
+        """
+        Dispatches a single iptables command to the backend operations
+
+        :param cmd
+        :param family
+        :param table
+        :param args
+        :return
+        """
+        if not args:
+            raise netfilter.errors.IptablesError(cmd, "no command specified")
+        op = args[0]
+        chain = None
+        if len(args) > 1:
+            chain = args[1]
+        if op == '-N' and chain:
+            self.create_chain(cmd, family, table, chain)
+        elif op == '-X':
+            self.delete_chain(cmd, family, table, chain)
+        elif op == '-F':
+            self.flush_chain(cmd, family, table, chain)
+        elif op == '-E' and len(args) == 3:
+            self.rename_chain(cmd, family, table, chain, args[2])
+        elif op == '-P' and len(args) == 3:
+            self.set_policy(cmd, family, table, chain, args[2])
+        elif op == '-A' and chain:
+            self.insert_rule(cmd, family, table, chain, None, self.__rule(cmd, args[2:]))
+        elif op == '-I' and chain:
+            position = 1
+            spec = args[2:]
+            if spec and spec[0].isdigit():
+                position = int(spec[0])
+                spec = spec[1:]
+            self.insert_rule(cmd, family, table, chain, position, self.__rule(cmd, spec))
+        elif op == '-R' and len(args) > 2 and args[2].isdigit():
+            self.replace_rule(cmd, family, table, chain, int(args[2]), self.__rule(cmd, args[3:]))
+        elif op == '-D' and len(args) == 3 and args[2].isdigit():
+            self.delete_rule(cmd, family, table, chain, int(args[2]))
+        elif op == '-D' and chain:
+            self.delete_rule(cmd, family, table, chain, self.__rule(cmd, args[2:]))
+        elif op == '-C' and chain:
+            self.check_rule(cmd, family, table, chain, self.__rule(cmd, args[2:]))
+        else:
+            raise netfilter.errors.IptablesError(cmd, "unsupported command: %s" % ' '.join(args))
+
+    def restore(self, cmd, family, payload, noflush):
+        """
+        Applies an iptables-restore payload, one table transaction per COMMIT
+
+        :param cmd
+        :param family
+        :param payload
+        :param noflush
+        :return
+        """
+        table = None
+        for number, line in enumerate(netfilter.parser.iter_lines(payload)):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                if line.startswith('*'):
+                    table = line[1:]
+                    self.begin(cmd, family, table)
+                    if not noflush:
+                        self.flush_chain(cmd, family, table, None)
+                        self.delete_chain(cmd, family, table, None)
+                elif table is None:
+                    raise netfilter.errors.IptablesError(cmd, "no table specified")
+                elif line == 'COMMIT':
+                    self.commit(cmd, family, table)
+                    table = None
+                elif line.startswith(':'):
+                    m = netfilter.parser.re_chain.match(line)
+                    if not m:
+                        raise netfilter.errors.IptablesError(cmd, "bad chain line")
+                    self.declare_chain(cmd, family, table, m.group(1), m.group(2))
+                else:
+                    self.command(cmd, family, table, netfilter.parser.split_words(line))
+            except netfilter.errors.IptablesError as e:
+                if table is not None:
+                    self.abort(cmd, family, table)
+                raise netfilter.errors.IptablesError(
+                    cmd, "%s: line %d failed: %s" % (os.path.basename(cmd[0]), number + 1, e.message))
+        if table is not None:
+            self.abort(cmd, family, table)
+            raise netfilter.errors.IptablesError(cmd, "%s: COMMIT expected" % os.path.basename(cmd[0]))
+
+    def declare_chain(self, cmd, family, table, chain, policy):
+        """
+        Handles a ':chain policy [packets:bytes]' restore line
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :param policy
+        :return
+        """
+        if policy == '-':
+            try:
+                self.create_chain(cmd, family, table, chain)
+            except netfilter.errors.IptablesError:
+                self.flush_chain(cmd, family, table, chain)
+        else:
+            self.flush_chain(cmd, family, table, chain)
+            self.set_policy(cmd, family, table, chain, policy)
+
+    def check_rule(self, cmd, family, table, chain, rule):
+        """
+        Fails like iptables -C unless a chain holds the rule; looks through the table dump
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :param rule
+        :return
+        """
+        chains = netfilter.parser.parse_save(self.dump(family, table))
+        if chain not in chains:
+            raise netfilter.errors.IptablesError(cmd, "iptables: No chain/target/match by that name.")
+        if rule not in chains[chain]['rules']:
+            raise netfilter.errors.IptablesError(
+                cmd, "iptables: Bad rule (does a matching rule exist in that chain?).")
+
+    def __rule(self, cmd, spec):
+        """
+        Parses the rule part of a command
+
+        :param cmd
+        :param spec
+        :return rule
+        """
+        try:
+            return netfilter.parser.parse_rule(spec)
+        except Exception as e:
+            raise netfilter.errors.IptablesError(cmd, str(e))
+
+    def begin(self, cmd, family, table):
+        """
+        Starts a restore transaction on a table
+
+        :param cmd
+        :param family
+        :param table
+        :return
+        """
+        pass
+
+    def commit(self, cmd, family, table):
+        """
+        Commits a restore transaction on a table
+
+        :param cmd
+        :param family
+        :param table
+        :return
+        """
+        pass
+
+    def abort(self, cmd, family, table):
+        """
+        Abandons a restore transaction on a table
+
+        :param cmd
+        :param family
+        :param table
+        :return
+        """
+        pass
+
+    @abc.abstractmethod
+    def dump(self, family, table):
+        """
+        Yields the iptables-save -c output of a table
+
+        :param family
+        :param table
+        :return lines
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def create_chain(self, cmd, family, table, chain):
+        """
+        Creates a chain
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :return
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_chain(self, cmd, family, table, chain):
+        """
+        Deletes a chain, or every user chain when chain is None
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :return
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def flush_chain(self, cmd, family, table, chain):
+        """
+        Flushes a chain, or every chain when chain is None
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :return
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def rename_chain(self, cmd, family, table, chain, new_chain):
+        """
+        Renames a chain
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :param new_chain
+        :return
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_policy(self, cmd, family, table, chain, policy):
+        """
+        Sets the policy of a built-in chain
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :param policy
+        :return
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def insert_rule(self, cmd, family, table, chain, position, rule):
+        """
+        Inserts a rule at a position (starting at 1), or appends it when position is None
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :param position
+        :param rule
+        :return
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def replace_rule(self, cmd, family, table, chain, position, rule):
+        """
+        Replaces the rule at a position (starting at 1)
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :param position
+        :param rule
+        :return
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_rule(self, cmd, family, table, chain, rule):
+        """
+        Deletes a rule, given either as a Rule or as a position (starting at 1)
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :param rule
+        :return
+        """
+        raise NotImplementedError
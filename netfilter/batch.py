@@ -0,0 +1,342 @@
+import ipaddress
+
+import netfilter.classifier
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+        batch.py                                    Author: Zach Bricker
+
+
+        Classifies columns of flow records, e.g. a day of NetFlow, against a ruleset
+        with numpy. Every rule is evaluated once per chunk on all the rows still
+        undecided in its chain, instead of once per packet.
+
+"""
+
+numeric_columns = ['protocol', 'source', 'destination', 'sport', 'dport', 'icmp_type', 'icmp_code']
+string_columns = ['in_interface', 'out_interface', 'state']
+
+# conditions are checked in this order, the ones ruling out most rows first
+condition_order = ['never', 'port', 'icmp', 'host', 'interface', 'state', 'protocol']
+
+
+def addresses(values):
+    """
+    Turns IPv4 addresses given as strings into a uint32 column
+
+    :param values
+    :return column
+    """
+    return numpy.array([int(ipaddress.IPv4Address(value)) for value in values], dtype=numpy.uint32)
+
+
+def columns_from_packets(packets):
+    """
+    Turns classifier Packets into flow columns; missing ports and icmp types
+    become -1 and missing strings ''
+
+    :param packets
+    :return flows
+    """
+    flows = {}
+    for column in ('sport', 'dport'):
+        flows[column] = numpy.array([-1 if getattr(packet, column) is None else getattr(packet, column)
+                                     for packet in packets], dtype=numpy.int32)
+    flows['protocol'] = numpy.array(
+        [netfilter.classifier.protocol_numbers.get(netfilter.classifier.canonical_protocol(packet.protocol), 0)
+         for packet in packets], dtype=numpy.uint8)
+    for column in ('source', 'destination'):
+        flows[column] = addresses([getattr(packet, column) or '0.0.0.0' for packet in packets])
+    for column in string_columns:
+        flows[column] = numpy.array([getattr(packet, column) or '' for packet in packets])
+    icmp_types = [netfilter.classifier.parse_icmp_type(
+        packet.icmp_type, netfilter.classifier.canonical_protocol(packet.protocol) == 'icmpv6')
+        if packet.icmp_type is not None else (-1, -1) for packet in packets]
+    flows['icmp_type'] = numpy.array([icmp_type for icmp_type, code in icmp_types], dtype=numpy.int16)
+    flows['icmp_code'] = numpy.array([code if code is not None else 0 for icmp_type, code in icmp_types],
+                                     dtype=numpy.int16)
+    return flows
+
+
+class Columns:
+    def __init__(self, flows, start, stop):
+        """
+        Constructor. Holds one chunk of the flow columns; string columns are
+        factorized once so their predicates only run on the distinct values.
+
+        :param flows
+        :param start
+        :param stop
+        :return
+        """
+        self.size = stop - start
+        self.numeric = {}
+        self.strings = {}
+        for column in numeric_columns:
+            if column in flows:
+                self.numeric[column] = numpy.asarray(flows[column][start:stop])
+        for column in string_columns:
+            if column in flows:
+                values = numpy.asarray(flows[column][start:stop]).astype(str)
+                self.strings[column] = numpy.unique(values, return_inverse=True)
+
+
+class BatchClassifier:
+    def __init__(self, chains, chunk_size=1 << 20):
+        """
+        Constructor. chains is a ruleset as returned by Table.get_ruleset.
+
+        Flow columns are numpy arrays of equal length: protocol holds IP protocol
+        numbers, source and destination IPv4 addresses as integers, sport, dport,
+        icmp_type and icmp_code integers, where -1 means unknown, and in_interface,
+        out_interface and state strings, where '' means unknown. Missing columns
+        never match, except state which defaults to NEW like Packet does.
+
+        :param chains
+        :param chunk_size
+        :return
+        """
+        if numpy is None:
+            raise ImportError("batch classification requires numpy")
+        self.chunk_size = chunk_size
+        self.rules = []
+        self.verdicts = []
+        self.__chains = {}
+        self.__rule_ids = {}
+        self.__conditions = {}
+        self.__verdict_codes = {}
+        for name in chains.keys():
+            chain = chains[name]
+            compiled = netfilter.classifier.CompiledChain(name, chain.get('policy'), chain['rules'], chains)
+            self.__chains[name] = compiled
+            for pos, rule in enumerate(compiled.rules):
+                self.__rule_ids[(name, pos)] = len(self.rules)
+                self.__conditions[(name, pos)] = sorted(
+                    rule.conditions, key=lambda condition: condition_order.index(condition[0]))
+                self.rules.append((name, pos + 1, rule.rule))
+                if rule.action == 'verdict':
+                    self.__verdict_code(rule.target)
+            if compiled.policy is not None:
+                self.__verdict_code(compiled.policy)
+
+    def classify(self, chainname, flows):
+        """
+        Classifies flow columns entering a built-in chain. Returns the verdict of
+        every row as an index into self.verdicts, and the deciding rule as an
+        index into self.rules, or -1 when the chain policy decided.
+
+        :param chainname
+        :param flows
+        :return (verdicts, rules)
+        """
+        size = len(next(iter(flows.values())))
+        verdicts = numpy.empty(size, dtype=numpy.int16)
+        rules = numpy.empty(size, dtype=numpy.int32)
+        base = self.__chains[chainname]
+        policy = self.__verdict_code(base.policy)
+        for start in range(0, size, self.chunk_size):
+            stop = min(start + self.chunk_size, size)
+            columns = Columns(flows, start, stop)
+            chunk_verdicts = verdicts[start:stop]
+            chunk_rules = rules[start:stop]
+            returned = self.__process(base, numpy.arange(stop - start), columns,
+                                      chunk_verdicts, chunk_rules, 0)
+            chunk_verdicts[returned] = policy
+            chunk_rules[returned] = -1
+        return verdicts, rules
+
+    def verdict_names(self, verdicts):
+        """
+        Turns verdict codes into an array of names
+
+        :param verdicts
+        :return names
+        """
+        return numpy.array(self.verdicts, dtype=object)[verdicts]
+
+    def __verdict_code(self, verdict):
+        """
+        Returns the code of a verdict, allocating one the first time it is seen
+
+        :param verdict
+        :return code
+        """
+        code = self.__verdict_codes.get(verdict)
+        if code is None:
+            code = self.__verdict_codes[verdict] = len(self.verdicts)
+            self.verdicts.append(verdict)
+        return code
+
+    def __process(self, chain, rows, columns, verdicts, rules, depth):
+        """
+        Runs rows through a chain, deciding the ones that hit a verdict. Rows that
+        fall off the end of the chain or hit RETURN are handed back to the caller.
+
+        Rows stay in place and are switched off in active once a rule takes them.
+        When several rules are indexed by destination port, the rows are sorted
+        by port once so those rules only look at the rows carrying their ports.
+
+        :param chain
+        :param rows
+        :param columns
+        :param verdicts
+        :param rules
+        :param depth
+        :return returned
+        """
+        if depth > 1024:
+            raise Exception("chain loop while classifying in %s" % chain.name)
+        active = numpy.zeros(columns.size, dtype=bool)
+        active[rows] = True
+        count = rows.size
+        sorted_rows = None
+        indexed = sum(1 for compiled in chain.rules if compiled.dports is not None)
+        if indexed > 1 and 'dport' in columns.numeric:
+            dports = columns.numeric['dport'][rows]
+            order = numpy.argsort(dports, kind='stable')
+            sorted_rows = rows[order]
+            sorted_dports = dports[order]
+
+        returned = []
+        for pos, compiled in enumerate(chain.rules):
+            if not count:
+                break
+            if compiled.action == 'continue':
+                continue
+            if compiled.dports is not None and sorted_rows is not None:
+                ports = sorted(compiled.dports)
+                lows = numpy.searchsorted(sorted_dports, ports, 'left')
+                highs = numpy.searchsorted(sorted_dports, ports, 'right')
+                parts = [sorted_rows[low:high] for low, high in zip(lows, highs) if high > low]
+                if not parts:
+                    continue
+                candidates = numpy.concatenate(parts)
+                candidates = candidates[active[candidates]]
+            else:
+                if count < rows.size:
+                    rows = rows[active[rows]]
+                candidates = rows
+            matched = self.__match(chain.name, pos, candidates, columns)
+            if not matched.size:
+                continue
+            active[matched] = False
+            count -= matched.size
+            if compiled.action == 'verdict':
+                verdicts[matched] = self.__verdict_codes[compiled.target]
+                rules[matched] = self.__rule_ids[(chain.name, pos)]
+            elif compiled.action == 'return':
+                returned.append(matched)
+            else:
+                back = self.__process(self.__chains[compiled.target], matched, columns,
+                                      verdicts, rules, depth + 1)
+                if compiled.action == 'jump':
+                    # rows still holds these, compaction only drops rows that never come back
+                    active[back] = True
+                    count += back.size
+                else:
+                    # a chain entered with -g returns to our caller
+                    returned.append(back)
+        if count < rows.size:
+            rows = rows[active[rows]]
+        returned.append(rows)
+        return numpy.concatenate(returned)
+
+    def __match(self, chainname, pos, rows, columns):
+        """
+        Returns the rows matching a rule. Conditions are checked from the most
+        selective kind to the least, each on the rows still matching.
+
+        :param chainname
+        :param pos
+        :param rows
+        :param columns
+        :return matched
+        """
+        for condition in self.__conditions[(chainname, pos)]:
+            if not rows.size:
+                break
+            rows = rows[self.__condition(condition, rows, columns)]
+        return rows
+
+    def __condition(self, condition, rows, columns):
+        """
+        Evaluates a (kind, attr, value, negated) condition on rows
+
+        :param condition
+        :param rows
+        :param columns
+        :return mask
+        """
+        kind, attr, value, negated = condition
+        if kind in ('interface', 'state'):
+            return self.__string_condition(condition, rows, columns)
+        if kind == 'never':
+            return numpy.zeros(rows.size, dtype=bool)
+        if kind == 'port' and attr == 'port':
+            sport = self.__condition(('port', 'sport', value, False), rows, columns)
+            dport = self.__condition(('port', 'dport', value, False), rows, columns)
+            return (sport | dport) != negated
+        if kind == 'icmp':
+            attr = 'icmp_type'
+        if attr not in columns.numeric:
+            return numpy.zeros(rows.size, dtype=bool)
+        column = columns.numeric[attr][rows]
+
+        if kind == 'protocol':
+            number = netfilter.classifier.protocol_numbers.get(value)
+            if number is None:
+                number = int(value) if value.isdigit() else -1
+            return (column == number) != negated
+        elif kind == 'host':
+            if value.version != 4:
+                return numpy.full(rows.size, negated)
+            netmask = int(value.netmask)
+            return ((column.astype(numpy.uint32) & netmask) == int(value.network_address)) != negated
+        elif kind == 'port':
+            mask = numpy.zeros(rows.size, dtype=bool)
+            singles = [first for first, last in value if first == last]
+            if singles:
+                mask |= numpy.isin(column, singles)
+            for first, last in value:
+                if first != last:
+                    mask |= (column >= first) & (column <= last)
+            return numpy.where(column >= 0, mask != negated, False)
+        elif kind == 'icmp':
+            wanted_type, wanted_code = value
+            mask = column >= 0
+            if wanted_type is not None:
+                mask &= column == wanted_type
+            if wanted_code is not None:
+                if 'icmp_code' not in columns.numeric:
+                    return numpy.zeros(rows.size, dtype=bool)
+                mask &= columns.numeric['icmp_code'][rows] == wanted_code
+            return numpy.where(column >= 0, mask != negated, False)
+        raise Exception("unknown condition %s" % kind)
+
+    def __string_condition(self, condition, rows, columns):
+        """
+        Evaluates an interface or state condition on the distinct values of a
+        string column, then maps the result back onto rows
+
+        :param condition
+        :param rows
+        :param columns
+        :return mask
+        """
+        kind, attr, value, negated = condition
+        if attr not in columns.strings:
+            if kind == 'state':
+                return numpy.full(rows.size, ('NEW' in value) != negated)
+            return numpy.zeros(rows.size, dtype=bool)
+        uniques, inverse = columns.strings[attr]
+        if kind == 'state':
+            lookup = [((unique or None) in value) != negated for unique in uniques]
+        else:
+            lookup = [bool(unique) and
+                      netfilter.classifier.interface_matches(value, unique) != negated
+                      for unique in uniques]
+        return numpy.array(lookup, dtype=bool)[inverse[rows]]
@@ -0,0 +1,166 @@
+import json
+import os
+import re
+import subprocess
+import tempfile
+
+"""
+        capabilities.py                             Author: Zach Bricker
+
+
+        Detects what an iptables binary supports from its version string, and keeps
+        the answer on disk so later processes do not have to run it again
+
+"""
+
+re_version = re.compile(r'v([0-9]+(?:\.[0-9]+)*)(?:\s+\(([^)]+)\))?')
+
+# in-process cache, keyed by binary path
+probed = {}
+
+
+def cache_path():
+    """
+    Returns the file the probe results are persisted to
+
+    :return path
+    """
+    path = os.environ.get('NETFILTER_CAPABILITIES_CACHE')
+    if path:
+        return path
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'netfilter', 'capabilities.json')
+
+
+def find_binary(binary):
+    """
+    Resolves a binary name through PATH, following symlinks
+
+    :param binary
+    :return path
+    :return None
+    """
+    if os.sep in binary:
+        candidates = [binary]
+    else:
+        candidates = [os.path.join(directory, binary)
+                      for directory in os.environ.get('PATH', os.defpath).split(os.pathsep)]
+    for candidate in candidates:
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return os.path.realpath(candidate)
+    return None
+
+
+def parse_version(output):
+    """
+    Turns 'iptables v1.8.7 (nf_tables)' into the capabilities it implies
+
+    :param output
+    :return capabilities
+    """
+    m = re_version.search(output or '')
+    if not m:
+        return {'version': None, 'variant': None, 'wait': False, 'restore_wait': False}
+    version = tuple(int(part) for part in m.group(1).split('.'))
+    variant = m.group(2) or 'legacy'
+    return {
+        'version': m.group(1),
+        'variant': variant,
+        # iptables --wait appeared in 1.4.20, iptables-restore --wait in 1.6.2
+        'wait': version >= (1, 4, 20),
+        'restore_wait': version >= (1, 6, 2),
+    }
+
+
+def load_cache(path):
+    """
+    Reads the persisted probe results
+
+    :param path
+    :return cache
+    """
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    return cache
+
+
+def save_cache(path, cache):
+    """
+    Writes the probe results atomically, ignoring unwritable locations
+
+    :param path
+    :param cache
+    :return
+    """
+    try:
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        pass
+
+
+def probe(binary, run=None):
+    """
+    Returns the capabilities of an iptables binary. Results are cached in-process
+    and on disk, keyed by the resolved path and the size and mtime of the binary,
+    so a version query only runs when the binary changes.
+
+    :param binary
+    :param run
+    :return capabilities
+    """
+    if binary in probed:
+        return probed[binary]
+
+    path = find_binary(binary)
+    key = None
+    cache = None
+    if path is not None:
+        st = os.stat(path)
+        key = "%s:%d:%d" % (path, st.st_size, int(st.st_mtime))
+        cache = load_cache(cache_path())
+        if key in cache:
+            probed[binary] = cache[key]
+            return cache[key]
+
+    if run is None:
+        run = run_version
+    try:
+        output = run([binary, '--version'])
+    except Exception:
+        output = None
+    capabilities = parse_version(output)
+
+    if key is not None and output is not None:
+        cache[key] = capabilities
+        save_cache(cache_path(), cache)
+    probed[binary] = capabilities
+    return capabilities
+
+
+def run_version(cmd):
+    """
+    Runs a version query
+
+    :param cmd
+    :return out
+    """
+    p = subprocess.Popen(cmd,
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE,
+                         close_fds=True,
+                         universal_newlines=True)
+    out, err = p.communicate()
+    if p.returncode:
+        raise OSError(err)
+    return out
@@ -0,0 +1,172 @@
+import hashlib
+
+import netfilter.classifier
+import netfilter.parser
+import netfilter.reconcile
+from netfilter.rule import Rule
+
+"""
+        chaintree.py                                Author: Zach Bricker
+
+
+        Compiles a flat chain into a tree of user chains, dispatching first on the
+        input interface and then on the protocol, so a packet only walks the rules
+        that can possibly match it instead of the whole chain
+
+"""
+
+# the rule fields dispatched on, from the root of the tree down
+tree_keys = ['in_interface', 'protocol']
+
+# chain names are limited to 28 characters
+max_chain_name = 28
+
+
+def dispatch_value(rule, key):
+    """
+    Returns the value a rule can be dispatched on, or None when the rule has to
+    stay where it is: the field is unset, negated or a wildcard, or the rule
+    uses RETURN or -g, which would leave a different chain once moved
+
+    :param rule
+    :param key
+    :return value
+    """
+    if rule.goto is not None or (rule.jump is not None and rule.jump.name() == 'RETURN'):
+        return None
+    value = getattr(rule, key)
+    if value is None or value.startswith('!'):
+        return None
+    if key == 'protocol':
+        value = netfilter.classifier.canonical_protocol(value)
+        if value in ('all', '0'):
+            return None
+    elif value.endswith('+'):
+        return None
+    return value
+
+
+def subchain_name(parent, value, taken):
+    """
+    Returns the name of the chain holding the rules of parent matching value,
+    numbered when the value already has a chain and hashed when it is too long
+
+    :param parent
+    :param value
+    :param taken
+    :return name
+    """
+    base = "%s-%s" % (parent, value)
+    # leave room for a '-N' suffix
+    if len(base) > max_chain_name - 3:
+        digest = hashlib.blake2b(base.encode(), digest_size=4).hexdigest()
+        base = "%s-%s" % (parent[:max_chain_name - len(digest) - 4], digest)
+    name = base
+    count = 1
+    while name in taken:
+        count += 1
+        name = "%s-%d" % (base, count)
+    return name
+
+
+def compile_chain(chainname, rules, keys=None, min_rules=4, taken=()):
+    """
+    Turns the rules of a chain into a tree of chains. Within a run of rules that
+    all match one interface (or protocol), rules for different values can never
+    match the same packet, so each value with at least min_rules rules moves into
+    its own chain, reached by a single -j rule. Packets falling off that chain
+    come back and carry on after the run, which keeps first-match semantics.
+    Smaller groups stay inline, and anything else ends the run.
+
+    :param chainname
+    :param rules
+    :param keys
+    :param min_rules
+    :param taken
+    :return chains
+    """
+    if keys is None:
+        keys = tree_keys
+    tree = netfilter.parser.ODict()
+    build_tree(chainname, list(rules), list(keys), min_rules, set(taken), tree)
+    return tree
+
+
+def build_tree(chainname, rules, keys, min_rules, taken, tree):
+    """
+    Fills tree with chainname and the chains below it
+
+    :param chainname
+    :param rules
+    :param keys
+    :param min_rules
+    :param taken
+    :param tree
+    :return
+    """
+    taken.add(chainname)
+    if not keys:
+        tree[chainname] = rules
+        return
+    key = keys[0]
+    body = []
+    tree[chainname] = body
+    branched = False
+    pos = 0
+    while pos < len(rules):
+        if dispatch_value(rules[pos], key) is None:
+            body.append(rules[pos])
+            pos += 1
+            continue
+        groups = netfilter.parser.ODict()
+        while pos < len(rules):
+            value = dispatch_value(rules[pos], key)
+            if value is None:
+                break
+            groups.setdefault(value, []).append(rules[pos])
+            pos += 1
+        for value in groups.keys():
+            members = groups[value]
+            if len(members) < min_rules:
+                body.extend(members)
+                continue
+            branched = True
+            name = subchain_name(chainname, value, taken)
+            body.append(Rule(jump=name, **{key: getattr(members[0], key)}))
+            build_tree(name, members, keys[1:], min_rules, taken, tree)
+    if not branched:
+        # nothing to dispatch on at this level, try the next key instead
+        del tree[chainname]
+        build_tree(chainname, rules, keys[1:], min_rules, taken, tree)
+
+
+def compile_ruleset(ruleset, chainnames=('INPUT', 'FORWARD'), keys=None, min_rules=4):
+    """
+    Returns a DesiredTable holding a ruleset with the given chains compiled into trees
+
+    :param ruleset
+    :param chainnames
+    :param keys
+    :param min_rules
+    :return desired
+    """
+    name = ruleset.name() if hasattr(ruleset, 'name') else 'filter'
+    chains = ruleset.get_ruleset() if hasattr(ruleset, 'get_ruleset') else ruleset
+    desired = netfilter.reconcile.DesiredTable(name)
+    taken = set(chains.keys())
+    for chainname in chains.keys():
+        chain = chains[chainname]
+        desired.create_chain(chainname)
+        if chain['policy'] is not None:
+            desired.set_policy(chainname, chain['policy'])
+        if chainname not in chainnames:
+            for rule in chain['rules']:
+                desired.append_rule(chainname, rule)
+            continue
+        tree = compile_chain(chainname, chain['rules'], keys, min_rules, taken - set([chainname]))
+        for treename in tree.keys():
+            taken.add(treename)
+            desired.create_chain(treename)
+            for rule in tree[treename]:
+                desired.append_rule(treename, rule)
+    return desired
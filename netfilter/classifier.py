@@ -0,0 +1,639 @@
+import heapq
+import ipaddress
+import socket
+from collections import namedtuple
+
+"""
+        classifier.py                               Author: Zach Bricker
+
+
+        Works out which verdict a packet gets from a set of parsed chains. Rules are
+        compiled once into predicates and indexed by destination port, input
+        interface, destination host or protocol, so a lookup only evaluates the
+        rules that can possibly match.
+
+"""
+
+Packet = namedtuple('Packet', ['protocol', 'source', 'destination', 'sport', 'dport',
+                               'in_interface', 'out_interface', 'state', 'icmp_type'])
+Packet.__new__.__defaults__ = (None, None, None, None, None, None, None, 'NEW', None)
+
+protocol_numbers = {'icmp': 1, 'tcp': 6, 'udp': 17, 'gre': 47, 'esp': 50, 'ah': 51,
+                    'icmpv6': 58, 'ipv6-icmp': 58, 'sctp': 132, 'udplite': 136}
+protocol_names = dict((number, name) for name, number in protocol_numbers.items())
+protocol_names[58] = 'icmpv6'
+
+# icmp type names as (type, code), where a code of None matches every code
+icmp_types = {'any': (None, None), 'echo-reply': (0, None), 'destination-unreachable': (3, None),
+              'network-unreachable': (3, 0), 'host-unreachable': (3, 1),
+              'protocol-unreachable': (3, 2), 'port-unreachable': (3, 3),
+              'fragmentation-needed': (3, 4), 'source-quench': (4, None), 'redirect': (5, None),
+              'echo-request': (8, None), 'time-exceeded': (11, None),
+              'parameter-problem': (12, None), 'timestamp-request': (13, None),
+              'timestamp-reply': (14, None)}
+
+# icmpv6 type names, as ip6tables --icmpv6-type takes them
+icmpv6_types = {'any': (None, None), 'destination-unreachable': (1, None), 'no-route': (1, 0),
+                'communication-prohibited': (1, 1), 'beyond-scope': (1, 2), 'address-unreachable': (1, 3),
+                'port-unreachable': (1, 4), 'failed-policy': (1, 5), 'reject-route': (1, 6),
+                'packet-too-big': (2, None), 'time-exceeded': (3, None), 'ttl-exceeded': (3, None),
+                'ttl-zero-during-transit': (3, 0), 'ttl-zero-during-reassembly': (3, 1),
+                'parameter-problem': (4, None), 'bad-header': (4, 0), 'unknown-header-type': (4, 1),
+                'unknown-option': (4, 2), 'echo-request': (128, None), 'ping': (128, None),
+                'echo-reply': (129, None), 'pong': (129, None), 'mld-listener-query': (130, None),
+                'mld-listener-report': (131, None), 'mld-listener-done': (132, None),
+                'mld-listener-reduction': (132, None), 'router-solicitation': (133, None),
+                'router-advertisement': (134, None), 'neighbour-solicitation': (135, None),
+                'neighbor-solicitation': (135, None), 'neighbour-advertisement': (136, None),
+                'neighbor-advertisement': (136, None), 'redirect': (137, None)}
+
+# targets that let the packet carry on down the chain
+non_terminating_targets = ['LOG', 'ULOG', 'NFLOG', 'MARK', 'CONNMARK', 'TRACE', 'TOS', 'TTL',
+                           'HL', 'DSCP', 'CLASSIFY', 'SET', 'AUDIT', 'CT', 'NOTRACK', 'TCPMSS']
+
+# matches that never change the outcome
+ignored_matches = ['comment']
+
+# chains with more rules than this are indexed
+index_threshold = 8
+
+
+def canonical_protocol(value):
+    """
+    Returns the lower case name of a protocol given by name or number
+
+    :param value
+    :return protocol
+    """
+    if value is None:
+        return None
+    value = str(value).lower()
+    if value.isdigit():
+        return protocol_names.get(int(value), value)
+    if value == 'ipv6-icmp':
+        return 'icmpv6'
+    return value
+
+
+def split_negation(value):
+    """
+    Splits a '! value' option into its value and whether it is negated
+
+    :param value
+    :return value, negated
+    """
+    if value.startswith('!'):
+        return value[1:].strip(), True
+    return value, False
+
+
+def parse_port(value, protocol):
+    """
+    Returns a port given by number or service name
+
+    :param value
+    :param protocol
+    :return port
+    """
+    if value.isdigit():
+        return int(value)
+    try:
+        return socket.getservbyname(value, protocol or 'tcp')
+    except (socket.error, OverflowError):
+        raise Exception("unknown port '%s'" % value)
+
+
+def parse_ports(values, protocol):
+    """
+    Parses comma separated ports and 'first:last' ranges into (first, last) pairs
+
+    :param values
+    :param protocol
+    :return ranges
+    """
+    ranges = []
+    for value in ','.join(values).split(','):
+        if ':' in value:
+            first, last = value.split(':', 1)
+            first = parse_port(first, protocol) if first else 0
+            last = parse_port(last, protocol) if last else 65535
+        else:
+            first = last = parse_port(value, protocol)
+        ranges.append((first, last))
+    return ranges
+
+
+def port_test(attr, ranges, negated):
+    """
+    Returns a predicate checking a packet port against ranges; an attr of 'port'
+    matches when either port is in ranges
+
+    :param attr
+    :param ranges
+    :param negated
+    :return test
+    """
+    if attr == 'port':
+        sport = port_test('sport', ranges, False)
+        dport = port_test('dport', ranges, False)
+
+        def test(packet):
+            return (sport(packet) or dport(packet)) != negated
+        return test
+
+    def test(packet):
+        port = getattr(packet, attr)
+        if port is None:
+            return False
+        for first, last in ranges:
+            if first <= port <= last:
+                return not negated
+        return negated
+    return test
+
+
+def host_test(attr, network, negated):
+    """
+    Returns a predicate checking a packet address against a network
+
+    :param attr
+    :param network
+    :param negated
+    :return test
+    """
+    def test(packet):
+        address = getattr(packet, attr)
+        if address is None:
+            return False
+        if address.version != network.version:
+            return negated
+        return (address in network) != negated
+    return test
+
+
+def interface_matches(pattern, interface):
+    """
+    Checks an interface name against a pattern, where a trailing '+' matches any suffix
+
+    :param pattern
+    :param interface
+    :return matched
+    """
+    if pattern.endswith('+'):
+        return interface.startswith(pattern[:-1])
+    return interface == pattern
+
+
+def interface_test(attr, pattern, negated):
+    """
+    Returns a predicate checking a packet interface against a pattern
+
+    :param attr
+    :param pattern
+    :param negated
+    :return test
+    """
+    def test(packet):
+        interface = getattr(packet, attr)
+        if interface is None:
+            return False
+        return interface_matches(pattern, interface) != negated
+    return test
+
+
+def parse_icmp_type(value, icmpv6=False):
+    """
+    Returns the (type, code) of an icmp type given by name, 'type' or 'type/code';
+    names are looked up among the icmpv6 types for ip6tables rules and packets
+
+    :param value
+    :param icmpv6
+    :return (type, code)
+    """
+    names = icmpv6_types if icmpv6 else icmp_types
+    if value in names:
+        return names[value]
+    if isinstance(value, int):
+        return value, None
+    try:
+        if '/' in value:
+            icmp_type, code = value.split('/', 1)
+            return int(icmp_type), int(code)
+        return int(value), None
+    except ValueError:
+        raise Exception("unknown %s type '%s'" % ('icmpv6' if icmpv6 else 'icmp', value))
+
+
+def icmp_test(wanted, negated):
+    """
+    Returns a predicate checking the (type, code) icmp type of a packet
+
+    :param wanted
+    :param negated
+    :return test
+    """
+    wanted_type, wanted_code = wanted
+
+    def test(packet):
+        if packet.icmp_type is None:
+            return False
+        icmp_type, code = packet.icmp_type
+        matched = ((wanted_type is None or wanted_type == icmp_type) and
+                   (wanted_code is None or wanted_code == code))
+        return matched != negated
+    return test
+
+
+def state_test(states, negated):
+    """
+    Returns a predicate checking the connection tracking state of a packet
+
+    :param states
+    :param negated
+    :return test
+    """
+    def test(packet):
+        return (packet.state in states) != negated
+    return test
+
+
+def protocol_test(protocol, negated):
+    """
+    Returns a predicate checking the protocol of a packet
+
+    :param protocol
+    :param negated
+    :return test
+    """
+    def test(packet):
+        return (packet.protocol == protocol) != negated
+    return test
+
+
+def never_test(packet):
+    """
+    A predicate that matches no packet
+
+    :param packet
+    :return False
+    """
+    return False
+
+
+def condition_test(condition):
+    """
+    Returns the predicate for a (kind, attr, value, negated) condition
+
+    :param condition
+    :return test
+    """
+    kind, attr, value, negated = condition
+    if kind == 'protocol':
+        return protocol_test(value, negated)
+    elif kind == 'host':
+        return host_test(attr, value, negated)
+    elif kind == 'interface':
+        return interface_test(attr, value, negated)
+    elif kind == 'port':
+        return port_test(attr, value, negated)
+    elif kind == 'icmp':
+        return icmp_test(value, negated)
+    elif kind == 'state':
+        return state_test(value, negated)
+    return never_test
+
+
+class CompiledRule:
+    __slots__ = ('rule', 'conditions', 'tests', 'action', 'target', 'protocol', 'dports',
+                 'interface', 'host', 'unsupported')
+
+    def __init__(self, rule, chains=()):
+        """
+        Constructor. The rule is broken down into (kind, attr, value, negated)
+        conditions which all have to hold; action is 'verdict', 'jump', 'goto',
+        'return' or 'continue'. Matches the classifier cannot evaluate are listed
+        in unsupported and assumed to match.
+
+        :param rule
+        :param chains
+        :return
+        """
+        self.rule = rule
+        self.conditions = []
+        self.protocol = None
+        self.dports = None
+        self.interface = None
+        self.host = None
+        self.unsupported = []
+
+        protocol = rule.protocol
+        if protocol is not None:
+            protocol, negated = split_negation(protocol)
+            protocol = canonical_protocol(protocol)
+            if protocol != 'all':
+                if not negated:
+                    self.protocol = protocol
+                self.conditions.append(('protocol', 'protocol', protocol, negated))
+            elif negated:
+                self.conditions.append(('never', None, None, False))
+        for attr in ('source', 'destination'):
+            value = getattr(rule, attr)
+            if value is not None:
+                value, negated = split_negation(value)
+                network = ipaddress.ip_network(value, strict=False)
+                if attr == 'destination' and not negated and network.prefixlen == network.max_prefixlen:
+                    self.host = network.network_address
+                self.conditions.append(('host', attr, network, negated))
+        for attr in ('in_interface', 'out_interface'):
+            value = getattr(rule, attr)
+            if value is not None:
+                value, negated = split_negation(value)
+                if attr == 'in_interface' and not negated and not value.endswith('+'):
+                    self.interface = value
+                self.conditions.append(('interface', attr, value, negated))
+        for match in rule.matches:
+            self.__compile_match(match)
+        self.tests = [condition_test(condition) for condition in self.conditions]
+
+        self.action = 'continue'
+        self.target = None
+        if rule.goto is not None:
+            self.action = 'goto'
+            self.target = rule.goto.name()
+        elif rule.jump is not None:
+            name = rule.jump.name()
+            self.target = name
+            if name == 'RETURN':
+                self.action = 'return'
+            elif name in chains:
+                self.action = 'jump'
+            elif name not in non_terminating_targets:
+                self.action = 'verdict'
+
+    def matches(self, packet):
+        """
+        Checks whether a packet matches the rule
+
+        :param packet
+        :return matched
+        """
+        for test in self.tests:
+            if not test(packet):
+                return False
+        return True
+
+    def __compile_match(self, match):
+        """
+        Turns a match extension into conditions
+
+        :param match
+        :return
+        """
+        name = match.name()
+        options = match.options()
+        if name in ignored_matches:
+            return
+        if name not in ('tcp', 'udp', 'sctp', 'multiport', 'icmp', 'icmp6', 'state', 'conntrack'):
+            self.unsupported.append(name)
+            return
+        for option, values in options.items():
+            option, negated = split_negation(option)
+            if name in ('tcp', 'udp', 'sctp', 'multiport') and \
+                    option in ('sport', 'sports', 'dport', 'dports', 'port', 'ports'):
+                ranges = parse_ports(values, self.protocol)
+                attr = option.rstrip('s')
+                self.conditions.append(('port', attr, ranges, negated))
+                if attr == 'dport' and not negated:
+                    self.__index_ports(ranges)
+            elif name in ('icmp', 'icmp6') and option in ('icmp-type', 'icmpv6-type'):
+                icmp_type = parse_icmp_type(values[0], name == 'icmp6' or option == 'icmpv6-type')
+                self.conditions.append(('icmp', 'icmp_type', icmp_type, negated))
+            elif name in ('state', 'conntrack') and option in ('state', 'ctstate'):
+                states = frozenset(','.join(values).upper().split(','))
+                self.conditions.append(('state', 'state', states, negated))
+            else:
+                self.unsupported.append('%s --%s' % (name, option))
+
+    def __index_ports(self, ranges):
+        """
+        Records the destination ports the rule is restricted to, when there are few
+
+        :param ranges
+        :return
+        """
+        ports = set()
+        for first, last in ranges:
+            if last - first > 64:
+                return
+            ports.update(range(first, last + 1))
+        if self.dports is not None:
+            ports &= self.dports
+        self.dports = ports
+
+
+class CompiledChain:
+    __slots__ = ('name', 'policy', 'rules', 'wild', 'by_protocol', 'by_port', 'by_interface', 'by_host')
+
+    def __init__(self, name, policy, rules, chains):
+        """
+        Constructor. Every rule goes into one bucket, by the most selective field
+        it requires: (protocol, destination port), input interface, destination
+        host, protocol, or else the wildcard list. Every bucket keeps the rules in
+        chain order.
+
+        :param name
+        :param policy
+        :param rules
+        :param chains
+        :return
+        """
+        self.name = name
+        self.policy = policy
+        self.rules = [CompiledRule(rule, chains) for rule in rules]
+        self.wild = []
+        self.by_protocol = {}
+        self.by_port = {}
+        self.by_interface = {}
+        self.by_host = {}
+        for pos, compiled in enumerate(self.rules):
+            if compiled.dports is not None and compiled.protocol is not None:
+                for port in compiled.dports:
+                    self.by_port.setdefault((compiled.protocol, port), []).append(pos)
+            elif compiled.interface is not None:
+                self.by_interface.setdefault(compiled.interface, []).append(pos)
+            elif compiled.host is not None:
+                self.by_host.setdefault(compiled.host, []).append(pos)
+            elif compiled.protocol is not None:
+                self.by_protocol.setdefault(compiled.protocol, []).append(pos)
+            else:
+                self.wild.append(pos)
+
+    def candidates(self, packet, indexed=True):
+        """
+        Yields the positions of the rules that may match a packet, in chain order
+
+        :param packet
+        :param indexed
+        :return positions
+        """
+        if not indexed or len(self.rules) <= index_threshold:
+            return range(len(self.rules))
+        lists = [positions for positions in (self.wild,
+                                             self.by_port.get((packet.protocol, packet.dport)),
+                                             self.by_interface.get(packet.in_interface),
+                                             self.by_host.get(packet.destination),
+                                             self.by_protocol.get(packet.protocol)) if positions]
+        if len(lists) == 1:
+            return lists[0]
+        return heapq.merge(*lists)
+
+
+class Classifier:
+    def __init__(self, chains, indexed=True):
+        """
+        Constructor. chains is a ruleset as returned by Table.get_ruleset, i.e.
+        chain name -> {'policy': ..., 'rules': [...]}; chains without a policy
+        are user chains.
+
+        :param chains
+        :param indexed
+        :return
+        """
+        self.indexed = indexed
+        self.__chains = {}
+        for name in chains.keys():
+            chain = chains[name]
+            self.__chains[name] = CompiledChain(name, chain.get('policy'), chain['rules'], chains)
+        self.__cache = {}
+
+    def unsupported(self):
+        """
+        Returns (chain, position, match) for every match that is assumed to match
+
+        :return unsupported
+        """
+        unsupported = []
+        for name, chain in self.__chains.items():
+            for pos, compiled in enumerate(chain.rules):
+                for match in compiled.unsupported:
+                    unsupported.append((name, pos + 1, match))
+        return unsupported
+
+    def classify(self, chainname, packet):
+        """
+        Returns the verdict of a packet entering a built-in chain, with the chain
+        and position (starting at 1) of the deciding rule; the position is None
+        when the chain policy decided
+
+        :param chainname
+        :param packet
+        :return (verdict, chainname, position)
+        """
+        packet = self.__prepare(packet)
+        key = (chainname, packet)
+        result = self.__cache.get(key)
+        if result is None:
+            result = self.__walk(chainname, packet)
+            if len(self.__cache) >= 65536:
+                self.__cache.clear()
+            self.__cache[key] = result
+        return result
+
+    def verdict(self, chainname, packet):
+        """
+        Returns the verdict of a packet entering a built-in chain
+
+        :param chainname
+        :param packet
+        :return verdict
+        """
+        return self.classify(chainname, packet)[0]
+
+    def classify_many(self, chainname, packets):
+        """
+        Returns the verdicts of many packets, e.g. a list of recorded flows
+
+        :param chainname
+        :param packets
+        :return verdicts
+        """
+        return [self.classify(chainname, packet)[0] for packet in packets]
+
+    def matching_rule(self, chainname, packet):
+        """
+        Returns the rule that decided the verdict of a packet, or None for a policy
+
+        :param chainname
+        :param packet
+        :return rule
+        """
+        verdict, name, position = self.classify(chainname, packet)
+        if position is None:
+            return None
+        return self.__chains[name].rules[position - 1].rule
+
+    def __prepare(self, packet):
+        """
+        Normalizes the protocol, addresses and icmp type of a packet
+
+        :param packet
+        :return packet
+        """
+        if not isinstance(packet, Packet):
+            packet = Packet(*packet)
+        protocol = canonical_protocol(packet.protocol)
+        icmp_type = packet.icmp_type
+        if icmp_type is not None and not isinstance(icmp_type, tuple):
+            icmp_type = parse_icmp_type(icmp_type, protocol == 'icmpv6')
+            if icmp_type[1] is None:
+                icmp_type = (icmp_type[0], 0)
+        source = packet.source
+        if isinstance(source, str):
+            source = ipaddress.ip_address(source)
+        destination = packet.destination
+        if isinstance(destination, str):
+            destination = ipaddress.ip_address(destination)
+        return packet._replace(protocol=protocol,
+                               source=source, destination=destination, icmp_type=icmp_type)
+
+    def __walk(self, chainname, packet):
+        """
+        Runs a packet through a built-in chain and the user chains it jumps to
+
+        :param chainname
+        :param packet
+        :return (verdict, chainname, position)
+        """
+        base = self.__chains[chainname]
+        # frames of (chain, candidate iterator)
+        stack = []
+        hops = 0
+        chain = base
+        candidates = iter(chain.candidates(packet, self.indexed))
+        while True:
+            decided = None
+            for pos in candidates:
+                compiled = chain.rules[pos]
+                if not compiled.matches(packet):
+                    continue
+                action = compiled.action
+                if action == 'continue':
+                    continue
+                if action == 'verdict':
+                    return compiled.target, chain.name, pos + 1
+                decided = (action, compiled.target)
+                break
+            if decided is None or decided[0] == 'return':
+                # fell off the end of the chain, or hit RETURN
+                if not stack:
+                    return base.policy, base.name, None
+                chain, candidates = stack.pop()
+                continue
+            action, target = decided
+            hops += 1
+            if hops > 1024:
+                raise Exception("chain loop while classifying in %s" % chainname)
+            if action == 'jump':
+                stack.append((chain, candidates))
+            chain = self.__chains[target]
+            candidates = iter(chain.candidates(packet, self.indexed))
@@ -0,0 +1,28 @@
+"""
+        errors.py                                   Author: Zach Bricker
+
+
+        The errors raised when iptables, or a backend standing in for it, rejects a command
+
+"""
+
+
+class IptablesError(Exception):
+    def __init__(self, command, message):
+        """
+        Constructor
+
+        :param command
+        :param message
+        :return
+        """
+        self.command = command
+        self.message = message
+
+    def __str__(self):
+        """
+        Rewrites the built-in string method
+
+        :return "command: %s\nmessage: %s" % (self.command, self.message)
+        """
+        return "command: %s\nmessage: %s" % (self.command, self.message)
@@ -1,9 +1,13 @@
 import os
 import subprocess
 import sys
-import iptc
+from concurrent.futures import ThreadPoolExecutor
 
 from netfilter.rule import Rule, Match, Target
+import netfilter.backend
+import netfilter.chaintree
+import netfilter.ipset
+import netfilter.reconcile
 import netfilter.table
 
 """
@@ -14,27 +18,74 @@ import netfilter.table
 
 """
 
+# the chain of each table carrying the fingerprint stamp
+stamp_chains = {'filter': 'INPUT', 'nat': 'PREROUTING'}
 
-class Firewall:
-    def __init__(self, auto_commit=True, ipv6=False):
+
+class CommitError(Exception):
+    def __init__(self, errors):
         """
         Constructor
 
+        :param errors
+        :return
+        """
+        self.errors = errors
+
+    def __str__(self):
+        """
+        Rewrites the built-in string method
+
+        :return message
+        """
+        return "\n".join("%s: %s" % (name, self.errors[name]) for name in sorted(self.errors))
+
+
+class Firewall:
+    def __init__(self, auto_commit=True, ipv6=False, atomic_commit=False, backend=None, chain_tree=False,
+                 fingerprint=False, session=None):
+        """
+        Constructor. With chain_tree, start and reload compile the INPUT and FORWARD
+        rules into a tree of chains dispatching by interface and protocol. With
+        fingerprint, every table is stamped with a hash of its desired state, and
+        start and restart do nothing while the live stamps still match. A
+        RestoreSession given as session applies the commands of every table.
+
         :param auto_commit
         :param ipv6
+        :param atomic_commit
+        :param backend
+        :param chain_tree
+        :param fingerprint
+        :param session
         :return
         """
+        if backend is None:
+            backend = netfilter.backend.SubprocessBackend()
         self.filter = netfilter.table.Table(
             name='filter',
             auto_commit=auto_commit,
-            ipv6=ipv6)
+            ipv6=ipv6,
+            atomic_commit=atomic_commit,
+            backend=backend,
+            session=session)
         self.__ipv6 = ipv6
+        self.__backend = backend
+        self.__chain_tree = chain_tree
+        self.__fingerprint = fingerprint
+        self.__sets = {}
+        self.__staged_sets = {}
+        self.__auto_commit = auto_commit
+        self.__recording = False
         self.__tables = [self.filter]
         if not ipv6:
             self.nat = netfilter.table.Table(
                 name='nat',
                 auto_commit=auto_commit,
-                ipv6=ipv6)
+                ipv6=ipv6,
+                atomic_commit=atomic_commit,
+                backend=backend,
+                session=session)
             self.__tables.append(self.nat)
 
     def clear(self):
@@ -49,13 +100,55 @@ class Firewall:
 
     def commit(self):
         """
-        Commits all chains that were created during the session
+        Commits all chains that were created during the session, after the sets
+        their rules match on
 
         :return
         """
+        self.commit_sets()
         for table in self.__tables:
             table.commit()
 
+    def commit_sets(self):
+        """
+        Brings the sets staged by accept_protocol_set up to date. ipset has no
+        transaction shared with iptables, so the sets are applied before the rules
+        referencing them rather than atomically with them.
+
+        :return
+        """
+        staged = self.__staged_sets
+        self.__staged_sets = {}
+        for setname, entries in staged.items():
+            self.__sets[setname].update(entries)
+
+    def tables(self):
+        """
+        Returns the tables managed by the firewall
+
+        :return list(self.__tables)
+        """
+        return list(self.__tables)
+
+    def snapshot(self):
+        """
+        Dumps every table with a single iptables-save -c and serves the next read
+        of each managed table from it (every read until they change, on caching
+        tables). Tables missing from the dump are not loaded in the kernel; any
+        earlier snapshot of theirs is dropped and they dump on their own.
+
+        :return tables
+        """
+        cmd = ['ip6tables-save' if self.__ipv6 else 'iptables-save', '-c']
+        tables = self.__backend.load_tables(cmd)
+        for table in self.__tables:
+            chains = tables.get(table.name())
+            if chains is not None:
+                table.set_snapshot(chains)
+            else:
+                table.invalidate_cache()
+        return tables
+
     def get_buffer(self):
         """
         Gets the buffer from the table
@@ -86,8 +179,9 @@ class Firewall:
         elif command == "stop":
             self.stop()
         elif command == "restart":
-            self.stop()
-            self.start()
+            self.restart()
+        elif command == "reload":
+            self.reconcile()
         else:
             self.usage(prog)
             return 1
@@ -99,11 +193,117 @@ class Firewall:
 
         :return
         """
+        if self.__chain_tree or self.__fingerprint:
+            self.__converge('start')
+            return
         self.clear()
+        self.configure()
+
+    def restart(self):
+        """
+        Restarts the shell program; a fingerprinted firewall only converges, and
+        not at all when the ruleset is unchanged
+
+        :return
+        """
+        if self.__fingerprint:
+            self.__converge('restart')
+            return
+        self.stop()
+        self.start()
+
+    def __converge(self, command):
+        """
+        Builds the desired state once and reconciles the live tables to it,
+        unless their stamps show they already match
+
+        :param command
+        :return
+        """
+        desired = self.desired_state()
+        if self.__fingerprint and self.unchanged(desired):
+            self.__staged_sets.clear()
+            self.print_message("ruleset unchanged, nothing to %s" % command, None)
+            return
+        # converge from the live tables, which keeps the counters of unchanged rules;
+        # called on Firewall since subclasses may turn reconcile into a coroutine
+        Firewall.reconcile(self, desired)
+
+    def unchanged(self, desired=None):
+        """
+        Checks whether every live table carries the stamp of its desired state,
+        with one iptables -C per table instead of dumping and parsing the tables
+
+        :param desired
+        :return unchanged
+        """
+        if desired is None:
+            desired = self.desired_state()
+        for table in self.__tables:
+            chainname = stamp_chains[table.name()]
+            stamp = desired[table.name()].list_rules(chainname)[-1]
+            if not table.check_rule(chainname, stamp):
+                return False
+        return True
+
+    def configure(self):
+        """
+        Adds the rules the firewall is made of on top of the current tables
+
+        :return
+        """
         self.set_default_policy()
         self.accept_icmp()
         self.accept_input('lo')
 
+    def desired_state(self):
+        """
+        Records what configure() would build, without touching the live tables,
+        compiled into a chain tree and stamped when the firewall does so. Set
+        contents are only staged, and applied by reconcile().
+
+        :return desired
+        """
+        desired = {}
+        tables = {}
+        for table in self.__tables:
+            desired[table.name()] = netfilter.reconcile.DesiredTable(table.name())
+            tables[table.name()] = getattr(self, table.name())
+            setattr(self, table.name(), desired[table.name()])
+        self.__recording = True
+        try:
+            self.configure()
+        finally:
+            self.__recording = False
+            for name, table in tables.items():
+                setattr(self, name, table)
+        if self.__chain_tree:
+            desired['filter'] = netfilter.chaintree.compile_ruleset(desired['filter'])
+        if self.__fingerprint:
+            for name in desired:
+                # the filter rules match on the staged sets, so their members count too
+                digest = netfilter.reconcile.fingerprint(
+                    desired[name], self.__staged_sets if name == 'filter' else None)
+                desired[name].append_rule(stamp_chains[name], netfilter.reconcile.stamp_rule(digest))
+        return desired
+
+    def reconcile(self, desired=None):
+        """
+        Brings the live tables to the desired state with as few operations as possible,
+        keeping the counters of unchanged rules
+
+        :param desired
+        :return applied
+        """
+        if desired is None:
+            desired = self.desired_state()
+        self.commit_sets()
+        applied = []
+        for table in self.__tables:
+            if table.name() in desired:
+                applied.extend(netfilter.reconcile.reconcile_table(table, desired[table.name()]))
+        return applied
+
     def stop(self):
         """
         Stops the shell program
@@ -120,7 +320,7 @@ class Firewall:
         :param prog
         :return
         """
-        sys.stderr.write("Usage: %s {start|stop|restart}\n" % prog)
+        sys.stderr.write("Usage: %s {start|stop|restart|reload}\n" % prog)
 
     def accept_forward(self, in_interface=None, out_interface=None):
         """
@@ -198,6 +398,96 @@ class Firewall:
                      Match('multiport', "--destination-port %s" % port_str)],
             jump='ACCEPT'))
 
+    def accept_protocol_set(self, interface, protocol, ports, destinations=None, sources=None, name=None):
+        """
+        Accepts a protocol on the selected ports from or to large lists of networks.
+        The lists are kept in ipsets named after name, so a single rule matches them
+        in constant time; more ports than multiport takes go into a bitmap:port set.
+
+        :param interface
+        :param protocol
+        :param ports
+        :param destinations
+        :param sources
+        :param name
+        :return
+        """
+        if name is None:
+            name = "%s-%s" % (protocol, interface or 'any')
+        ports = [str(port) for port in ports]
+        port_str = ','.join(ports)
+        self.print_message("allow selected %s INPUT (ports: %s, set: %s)" % (protocol, port_str, name), interface)
+        matches = [Match('state', '--state NEW')]
+        if netfilter.ipset.port_count(ports) > netfilter.ipset.multiport_limit:
+            port_set = self.__update_set(name + '-ports', 'bitmap:port', None, netfilter.ipset.expand_ports(ports))
+            matches.append(port_set.match('dst'))
+        else:
+            matches.append(Match('multiport', "--destination-port %s" % port_str))
+        for direction, entries in (('src', sources), ('dst', destinations)):
+            if entries is not None:
+                matches.append(self.__update_set(self.__set_name(name, direction), 'hash:net',
+                                                 'inet6' if self.__ipv6 else 'inet', entries).match(direction))
+        self.filter.append_rule('INPUT', Rule(
+            in_interface=interface,
+            protocol=protocol,
+            matches=matches,
+            jump='ACCEPT'))
+
+    def update_protocol_set(self, name, destinations=None, sources=None, ports=None):
+        """
+        Changes the members of the sets behind an accept_protocol_set rule through
+        ipset restore right away, without touching any chain
+
+        :param name
+        :param destinations
+        :param sources
+        :param ports
+        :return changes
+        """
+        changes = {}
+        wanted = [(self.__set_name(name, 'src'), sources),
+                  (self.__set_name(name, 'dst'), destinations),
+                  (name + '-ports', None if ports is None else netfilter.ipset.expand_ports(ports))]
+        for setname, entries in wanted:
+            if entries is None:
+                continue
+            if setname not in self.__sets:
+                raise Exception("no set %s was created by accept_protocol_set" % setname)
+            changes[setname] = self.__sets[setname].update(entries)
+        return changes
+
+    def __set_name(self, name, direction):
+        """
+        Returns the name of an address set; IPv6 sets get their own name since
+        ipset names are shared by both families
+
+        :param name
+        :param direction
+        :return setname
+        """
+        return "%s-%s%s" % (name, direction, '6' if self.__ipv6 else '')
+
+    def __update_set(self, setname, set_type, family, entries):
+        """
+        Creates a set the first time it is used and stages its members, which are
+        applied right away on an auto-committing firewall and by commit() otherwise.
+        Nothing runs while desired_state() records configure().
+
+        :param setname
+        :param set_type
+        :param family
+        :param entries
+        :return ipset
+        """
+        ipset = self.__sets.get(setname)
+        if ipset is None:
+            ipset = self.__sets[setname] = netfilter.ipset.IPSet(
+                setname, set_type, family=family, backend=self.__backend)
+        self.__staged_sets[setname] = list(entries)
+        if self.__auto_commit and not self.__recording:
+            self.commit_sets()
+        return ipset
+
     def get_node(self):
         """
         Gets and returns a node
@@ -293,5 +583,151 @@ class Firewall:
             jump='MASQUERADE'))
 
 
+class DualStackFirewall:
+    def __init__(self, atomic_commit=False, backend=None, ipv6_backend=None, max_workers=None):
+        """
+        Constructor. Owns an IPv4 and an IPv6 Firewall whose tables are only
+        committed by commit(), which applies them in parallel.
+
+        :param atomic_commit
+        :param backend
+        :param ipv6_backend
+        :param max_workers
+        :return
+        """
+        if ipv6_backend is None:
+            ipv6_backend = backend
+        self.ipv4 = Firewall(auto_commit=False, ipv6=False,
+                             atomic_commit=atomic_commit, backend=backend)
+        self.ipv6 = Firewall(auto_commit=False, ipv6=True,
+                             atomic_commit=atomic_commit, backend=ipv6_backend)
+        self.max_workers = max_workers
+
+    def __getattr__(self, name):
+        """
+        Forwards the Firewall helpers (accept_input, source_nat, ...) to both stacks
+
+        :param name
+        :return forward
+        """
+        if name.startswith('_') or not callable(getattr(Firewall, name, None)):
+            raise AttributeError(name)
+
+        def forward(*args, **kwargs):
+            return [getattr(self.ipv4, name)(*args, **kwargs),
+                    getattr(self.ipv6, name)(*args, **kwargs)]
+        return forward
+
+    def tables(self):
+        """
+        Returns the tables of both stacks, named after their family
+
+        :return tables
+        """
+        tables = []
+        for family, stack in (('ipv4', self.ipv4), ('ipv6', self.ipv6)):
+            for table in stack.tables():
+                tables.append(("%s/%s" % (family, table.name()), table))
+        return tables
+
+    def commit(self):
+        """
+        Commits every table of both stacks in parallel, after the sets their rules
+        match on, reporting all failures at once. The tables of a stack whose sets
+        failed are left buffered.
+
+        :return
+        """
+        tables = self.tables()
+        errors = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers or len(tables)) as pool:
+            futures = [("%s/sets" % family, pool.submit(stack.commit_sets))
+                       for family, stack in (('ipv4', self.ipv4), ('ipv6', self.ipv6))]
+            for name, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors[name] = e
+            tables = [(name, table) for name, table in tables
+                      if "%s/sets" % name.split('/')[0] not in errors]
+            futures = [(name, pool.submit(table.commit)) for name, table in tables]
+            for name, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors[name] = e
+        if errors:
+            raise CommitError(errors)
+
+    def run(self, args):
+        """
+        Can be used to start, stop, restart or reload both stacks
+
+        :param args
+        :return 0
+        :return 1
+        """
+        prog = args[0]
+        if len(args) < 2:
+            self.ipv4.usage(prog)
+            return 1
+
+        command = args[1]
+        if command == "start":
+            self.start()
+        elif command == "stop":
+            self.stop()
+        elif command == "restart":
+            self.restart()
+        elif command == "reload":
+            self.reconcile()
+        else:
+            self.ipv4.usage(prog)
+            return 1
+        return 0
+
+    def start(self):
+        """
+        Starts both stacks
+
+        :return
+        """
+        self.ipv4.start()
+        self.ipv6.start()
+        self.commit()
+
+    def stop(self):
+        """
+        Stops both stacks
+
+        :return
+        """
+        self.ipv4.stop()
+        self.ipv6.stop()
+        self.commit()
+
+    def restart(self):
+        """
+        Restarts both stacks
+
+        :return
+        """
+        self.ipv4.stop()
+        self.ipv4.start()
+        self.ipv6.stop()
+        self.ipv6.start()
+        self.commit()
+
+    def reconcile(self):
+        """
+        Reconciles both stacks against their desired state
+
+        :return applied
+        """
+        applied = self.ipv4.reconcile() + self.ipv6.reconcile()
+        self.commit()
+        return applied
+
+
 if __name__ == "__main__":
     sys.exit(Firewall().run(sys.argv))
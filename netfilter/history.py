@@ -0,0 +1,325 @@
+import hashlib
+import mmap
+import os
+import struct
+import time
+
+"""
+        history.py                                  Author: Zach Bricker
+
+
+        Keeps packet and byte counter history per rule in fixed size ring buffers
+        inside a memory mapped file. Every tier keeps the last counter value seen in
+        each of its buckets, so coarser tiers are downsampled as samples come in.
+
+"""
+
+# (seconds per bucket, buckets): a minute of seconds, an hour of minutes, a week of hours
+default_tiers = [(1, 60), (60, 60), (3600, 168)]
+
+magic = b'NFHIST01'
+header = struct.Struct('<8sIII')
+tier_header = struct.Struct('<IIIIq')
+header_size = 64
+tier_header_size = 32
+max_tiers = 8
+digest_size = 16
+
+# marks a bucket in which a rule was not seen
+missing = 0xffffffffffffffff
+
+
+def rule_digest(chainname, rule):
+    """
+    Returns the identity of a rule in a chain, stable across processes
+
+    :param chainname
+    :param rule
+    :return digest
+    """
+    return hashlib.blake2b(repr((chainname, rule.key())).encode(), digest_size=digest_size).digest()
+
+
+class HistoryStore:
+    def __init__(self, path, capacity=16384, tiers=None):
+        """
+        Constructor. An existing file is mapped as is and keeps its own capacity
+        and tiers; a new one is sized for capacity rules.
+
+        :param path
+        :param capacity
+        :param tiers
+        :return
+        """
+        if tiers is None:
+            tiers = default_tiers
+        if len(tiers) > max_tiers:
+            raise Exception("At most %d tiers are supported" % max_tiers)
+        self.path = path
+        self.__fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self.__fd).st_size
+        if size == 0:
+            size = self.__layout(capacity, tiers)
+            os.ftruncate(self.__fd, size)
+            self.__map = mmap.mmap(self.__fd, size)
+            self.__format(capacity, tiers)
+        else:
+            self.__map = mmap.mmap(self.__fd, size)
+            name, version, capacity, count = header.unpack_from(self.__map, 0)
+            if name != magic or version != 1:
+                self.__map.close()
+                os.close(self.__fd)
+                raise Exception("%s is not a history store" % path)
+            tiers = [tier_header.unpack_from(self.__map, header_size + i * tier_header_size)[:2]
+                     for i in range(count)]
+            if self.__layout(capacity, tiers) != size:
+                self.__map.close()
+                os.close(self.__fd)
+                raise Exception("%s is truncated" % path)
+        self.capacity = capacity
+        self.tiers = [tuple(tier) for tier in tiers]
+        self.__views()
+        self.__slots = {}
+        for slot in range(capacity):
+            digest = bytes(self.__digests[slot * digest_size:(slot + 1) * digest_size])
+            if digest != bytes(digest_size):
+                self.__slots[digest] = slot
+
+    def __len__(self):
+        """
+        Returns the number of rules with history
+
+        :return len(self.__slots)
+        """
+        return len(self.__slots)
+
+    def record(self, table, now=None):
+        """
+        Records the counters of every rule of a table
+
+        :param table
+        :param now
+        :return
+        """
+        if now is None:
+            now = time.time()
+        chains = table.get_ruleset()
+        for chainname in chains.keys():
+            self.record_rules(chainname, chains[chainname]['rules'], now)
+
+    def record_rules(self, chainname, rules, now=None):
+        """
+        Records the counters of rules, e.g. a Table.list_rules snapshot
+
+        :param chainname
+        :param rules
+        :param now
+        :return
+        """
+        if now is None:
+            now = time.time()
+        rows = [self.__advance(tier, now) for tier in range(len(self.tiers))]
+        stamp = int(now)
+        for rule in rules:
+            slot = self.__slot(rule_digest(chainname, rule), stamp)
+            self.__last_seen[slot] = stamp
+            for values, row in zip(self.__values, rows):
+                pos = (row * self.capacity + slot) * 2
+                values[pos] = rule.packets
+                values[pos + 1] = rule.bytes
+
+    def history(self, chainname, rule, tier=0):
+        """
+        Returns the (timestamp, packets, bytes) samples of a rule, oldest first
+
+        :param chainname
+        :param rule
+        :param tier
+        :return samples
+        """
+        slot = self.__slots.get(rule_digest(chainname, rule))
+        if slot is None:
+            return []
+        length = self.tiers[tier][1]
+        head = self.__head(tier)
+        stamps = self.__stamps[tier]
+        values = self.__values[tier]
+        samples = []
+        for i in range(1, length + 1):
+            row = (head + i) % length
+            pos = (row * self.capacity + slot) * 2
+            if stamps[row] >= 0 and values[pos] != missing:
+                samples.append((stamps[row], values[pos], values[pos + 1]))
+        return samples
+
+    def rates(self, chainname, rule, tier=0):
+        """
+        Returns the (timestamp, pps, bps) rates between consecutive samples of a rule
+
+        :param chainname
+        :param rule
+        :param tier
+        :return rates
+        """
+        samples = self.history(chainname, rule, tier)
+        rates = []
+        for before, after in zip(samples, samples[1:]):
+            elapsed = after[0] - before[0]
+            packets = after[1] - before[1]
+            nbytes = after[2] - before[2]
+            if packets < 0 or nbytes < 0:
+                # counters were zeroed in between
+                packets, nbytes = after[1], after[2]
+            rates.append((after[0], packets / elapsed, nbytes / elapsed))
+        return rates
+
+    def flush(self):
+        """
+        Writes the mapped pages back to the file
+
+        :return
+        """
+        self.__map.flush()
+
+    def close(self):
+        """
+        Flushes and unmaps the file
+
+        :return
+        """
+        if self.__map is None:
+            return
+        self.__map.flush()
+        self.__digests.release()
+        self.__last_seen.release()
+        for view in self.__stamps + self.__values:
+            view.release()
+        self.__map.close()
+        os.close(self.__fd)
+        self.__map = None
+
+    def __layout(self, capacity, tiers):
+        """
+        Returns the file size for capacity rules and the given tiers
+
+        :param capacity
+        :param tiers
+        :return size
+        """
+        size = header_size + max_tiers * tier_header_size + capacity * (digest_size + 8)
+        for resolution, length in tiers:
+            size += length * 8 + length * capacity * 16
+        return size
+
+    def __format(self, capacity, tiers):
+        """
+        Writes the headers of a new file and marks every bucket as empty
+
+        :param capacity
+        :param tiers
+        :return
+        """
+        header.pack_into(self.__map, 0, magic, 1, capacity, len(tiers))
+        offset = header_size + max_tiers * tier_header_size + capacity * (digest_size + 8)
+        for i, (resolution, length) in enumerate(tiers):
+            tier_header.pack_into(self.__map, header_size + i * tier_header_size,
+                                  resolution, length, 0, 0, -1)
+            self.__map[offset:offset + length * 8] = b'\xff' * (length * 8)
+            offset += length * 8
+            self.__map[offset:offset + length * capacity * 16] = b'\xff' * (length * capacity * 16)
+            offset += length * capacity * 16
+
+    def __views(self):
+        """
+        Maps the digests, last seen times, timestamps and counters as typed views
+
+        :return
+        """
+        view = memoryview(self.__map)
+        offset = header_size + max_tiers * tier_header_size
+        self.__digests = view[offset:offset + self.capacity * digest_size]
+        offset += self.capacity * digest_size
+        self.__last_seen = view[offset:offset + self.capacity * 8].cast('q')
+        offset += self.capacity * 8
+        self.__stamps = []
+        self.__values = []
+        for resolution, length in self.tiers:
+            self.__stamps.append(view[offset:offset + length * 8].cast('q'))
+            offset += length * 8
+            self.__values.append(view[offset:offset + length * self.capacity * 16].cast('Q'))
+            offset += length * self.capacity * 16
+        view.release()
+
+    def __head(self, tier):
+        """
+        Returns the position of the newest bucket of a tier
+
+        :param tier
+        :return head
+        """
+        return tier_header.unpack_from(self.__map, header_size + tier * tier_header_size)[2]
+
+    def __advance(self, tier, now):
+        """
+        Moves the head of a tier to the bucket holding now, clearing the buckets
+        it passes over
+
+        :param tier
+        :param now
+        :return head
+        """
+        offset = header_size + tier * tier_header_size
+        resolution, length, head, unused, bucket = tier_header.unpack_from(self.__map, offset)
+        current = int(now // resolution)
+        if current > bucket:
+            row_size = self.capacity * 2
+            values = self.__values[tier]
+            for i in range(min(current - bucket, length)):
+                head = (head + 1) % length
+                values[head * row_size:(head + 1) * row_size] = self.__missing_row()
+                self.__stamps[tier][head] = -1
+            self.__stamps[tier][head] = current * resolution
+            tier_header.pack_into(self.__map, offset, resolution, length, head, 0, current)
+        return head
+
+    def __missing_row(self):
+        """
+        Returns a row of missing counters
+
+        :return row
+        """
+        try:
+            return self.__missing
+        except AttributeError:
+            self.__missing = memoryview(b'\xff' * (self.capacity * 16)).cast('Q')
+            return self.__missing
+
+    def __slot(self, digest, now):
+        """
+        Returns the slot of a rule, allocating one the first time it is seen. Once
+        the store is full, the slot of a rule that aged out of every tier is reused.
+
+        :param digest
+        :param now
+        :return slot
+        """
+        slot = self.__slots.get(digest)
+        if slot is not None:
+            return slot
+        if len(self.__slots) < self.capacity:
+            slot = len(self.__slots)
+        else:
+            span = max(resolution * length for resolution, length in self.tiers)
+            slot = min(range(self.capacity), key=lambda i: self.__last_seen[i])
+            if now - self.__last_seen[slot] <= span:
+                raise Exception("History store %s is full" % self.path)
+            old = bytes(self.__digests[slot * digest_size:(slot + 1) * digest_size])
+            del self.__slots[old]
+            for values, (resolution, length) in zip(self.__values, self.tiers):
+                for row in range(length):
+                    pos = (row * self.capacity + slot) * 2
+                    values[pos] = missing
+                    values[pos + 1] = missing
+        self.__digests[slot * digest_size:(slot + 1) * digest_size] = digest
+        self.__slots[digest] = slot
+        return slot
@@ -0,0 +1,217 @@
+import ipaddress
+
+import netfilter.backend
+from netfilter.rule import Match
+
+"""
+        ipset.py                                    Author: Zach Bricker
+
+
+        Manages ipsets, so one rule can match thousands of addresses or ports with a
+        constant time lookup, and membership can change without touching any chain
+
+"""
+
+# ipset names are limited to 31 characters
+max_name_length = 31
+
+# the multiport match takes up to 15 ports
+multiport_limit = 15
+
+
+def canonical_entry(set_type, entry):
+    """
+    Returns an entry the way ipset save prints it, so live and wanted members compare
+
+    :param set_type
+    :param entry
+    :return entry
+    """
+    entry = str(entry).strip()
+    if set_type.endswith(':port'):
+        return str(int(entry))
+    if set_type.startswith('hash:net') or set_type.startswith('hash:ip'):
+        network = ipaddress.ip_network(entry, strict=False)
+        if network.prefixlen == network.max_prefixlen:
+            return str(network.network_address)
+        return str(network)
+    return entry
+
+
+def port_count(ports):
+    """
+    Returns how many of the multiport slots ports take; iptables stores a
+    'first:last' range as two ports
+
+    :param ports
+    :return count
+    """
+    count = 0
+    for port in ports:
+        bits = str(port).replace(':', '-').split('-')
+        count += 1 if bits[0] == bits[-1] else 2
+    return count
+
+
+def expand_ports(ports):
+    """
+    Turns ports and 'first:last' or 'first-last' ranges into single ports, which is
+    how a bitmap:port set holds them
+
+    :param ports
+    :return ports
+    """
+    expanded = []
+    for port in ports:
+        bits = str(port).replace(':', '-').split('-')
+        expanded.extend(str(number) for number in range(int(bits[0]), int(bits[-1]) + 1))
+    return expanded
+
+
+class IPSet:
+    def __init__(self, name, set_type='hash:net', family=None, options=None, backend=None):
+        """
+        Constructor. family is 'inet' or 'inet6' for address sets; options are
+        extra create options, e.g. ['range', '0-65535'] for a bitmap:port set.
+
+        :param name
+        :param set_type
+        :param family
+        :param options
+        :param backend
+        :return
+        """
+        if len(name) > max_name_length:
+            raise Exception("ipset name '%s' is longer than %d characters" % (name, max_name_length))
+        if options is None:
+            options = []
+            if set_type == 'bitmap:port':
+                options = ['range', '0-65535']
+        if backend is None:
+            backend = netfilter.backend.SubprocessBackend()
+        self.__name = name
+        self.__type = set_type
+        self.__family = family
+        self.__options = options
+        self.__backend = backend
+
+    def name(self):
+        """
+        Returns the set name
+
+        :return self.__name
+        """
+        return self.__name
+
+    def create(self):
+        """
+        Creates the set unless it already exists
+
+        :return
+        """
+        self.__restore([self.__create_line(self.__name)])
+
+    def destroy(self):
+        """
+        Destroys the set; it must not be referenced by any rule
+
+        :return
+        """
+        self.__backend.run(['ipset', 'destroy', self.__name])
+
+    def members(self):
+        """
+        Returns the live members of the set
+
+        :return members
+        """
+        members = set()
+        for line in self.__backend.run(['ipset', 'save', self.__name]).splitlines():
+            bits = line.split()
+            if len(bits) >= 3 and bits[0] == 'add' and bits[1] == self.__name:
+                members.add(bits[2])
+        return members
+
+    def add(self, entries):
+        """
+        Adds entries in a single ipset restore call
+
+        :param entries
+        :return
+        """
+        self.__restore(['add %s %s' % (self.__name, canonical_entry(self.__type, entry))
+                        for entry in entries])
+
+    def remove(self, entries):
+        """
+        Removes entries in a single ipset restore call
+
+        :param entries
+        :return
+        """
+        self.__restore(['del %s %s' % (self.__name, canonical_entry(self.__type, entry))
+                        for entry in entries])
+
+    def update(self, entries):
+        """
+        Makes the set hold exactly entries, adding and deleting only the difference.
+        The set is created first when it does not exist.
+
+        :param entries
+        :return (added, removed)
+        """
+        wanted = set(canonical_entry(self.__type, entry) for entry in entries)
+        self.create()
+        live = self.members()
+        added = sorted(wanted - live)
+        removed = sorted(live - wanted)
+        lines = ['del %s %s' % (self.__name, entry) for entry in removed]
+        lines.extend('add %s %s' % (self.__name, entry) for entry in added)
+        self.__restore(lines)
+        return added, removed
+
+    def replace(self, entries):
+        """
+        Swaps in a freshly filled copy of the set, for rewriting most of a large set at once
+
+        :param entries
+        :return
+        """
+        temporary = (self.__name[:max_name_length - 4] + '-new')
+        lines = [self.__create_line(self.__name), self.__create_line(temporary), 'flush %s' % temporary]
+        lines.extend('add %s %s' % (temporary, canonical_entry(self.__type, entry)) for entry in entries)
+        lines.extend(['swap %s %s' % (temporary, self.__name), 'destroy %s' % temporary])
+        self.__restore(lines)
+
+    def match(self, direction='src'):
+        """
+        Returns the match testing a packet against the set, e.g. 'src', 'dst' or 'src,dst'
+
+        :param direction
+        :return Match('set', '--match-set name direction')
+        """
+        return Match('set', ['--match-set', self.__name, direction])
+
+    def __create_line(self, name):
+        """
+        Returns the restore line creating a set like this one
+
+        :param name
+        :return line
+        """
+        bits = ['create', name, self.__type]
+        if self.__family is not None:
+            bits.extend(['family', self.__family])
+        bits.extend(self.__options)
+        return ' '.join(bits)
+
+    def __restore(self, lines):
+        """
+        Runs lines through ipset restore, ignoring entries and sets that already exist
+
+        :param lines
+        :return
+        """
+        if not lines:
+            return
+        self.__backend.run(['ipset', 'restore', '-exist'], '\n'.join(lines) + '\n')
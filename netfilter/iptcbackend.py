@@ -0,0 +1,462 @@
+import socket
+import struct
+
+import netfilter.backend
+import netfilter.errors
+import netfilter.parser
+import netfilter.rule
+
+try:
+    import iptc
+except ImportError:
+    iptc = None
+
+"""
+        iptcbackend.py                              Author: Zach Bricker
+
+
+        A Table backend performing chain and rule operations in-process through python-iptc
+
+"""
+
+
+def prefix_length(family, mask):
+    """
+    Turns a dotted or colon netmask into a prefix length
+
+    :param family
+    :param mask
+    :return length
+    """
+    if mask.isdigit():
+        return int(mask)
+    if family == 'ipv6':
+        packed = socket.inet_pton(socket.AF_INET6, mask)
+    else:
+        packed = socket.inet_pton(socket.AF_INET, mask)
+    length = 0
+    for byte in struct.unpack('%dB' % len(packed), packed):
+        length += bin(byte).count('1')
+    return length
+
+
+def host_from_iptc(family, value):
+    """
+    Turns a python-iptc address into the canonical form used by Rule
+
+    :param family
+    :param value
+    :return host
+    """
+    if not value:
+        return None
+    negated = value.startswith('!')
+    value = value.lstrip('!').strip()
+    address, _, mask = value.partition('/')
+    if mask:
+        length = prefix_length(family, mask)
+        if length == 0:
+            return None
+        value = "%s/%d" % (address, length)
+    if negated:
+        value = '! ' + value
+    return value
+
+
+def value_to_iptc(value):
+    """
+    Turns a Rule field into the python-iptc form, where negation is a '!' prefix
+
+    :param value
+    :return value
+    """
+    if value.startswith('!'):
+        return '!' + value[1:].strip()
+    return value
+
+
+class IptcBackend(netfilter.backend.CommandBackend):
+    def __init__(self):
+        """
+        Constructor
+
+        :return
+        """
+        if iptc is None:
+            raise ImportError("the iptc backend requires python-iptc")
+
+    def load_table(self, cmd):
+        """
+        Builds the parsed chains of a table straight from libiptc, with counters
+
+        :param cmd
+        :return chains
+        """
+        family, table = self.__save_target(cmd)
+        handle = self.__table(family, table)
+        handle.refresh()
+        chains = netfilter.parser.ODict()
+        for chain in handle.chains:
+            policy = None
+            packets = 0
+            nbytes = 0
+            if chain.is_builtin():
+                policy = chain.get_policy().name
+                packets, nbytes = chain.get_counters()
+            rules = []
+            for entry in chain.rules:
+                rule = self.__rule_from_iptc(family, entry)
+                rule.packets, rule.bytes = entry.get_counters()
+                rules.append(rule)
+            chains[chain.name] = {
+                'policy': policy,
+                'packets': packets,
+                'bytes': nbytes,
+                'rules': rules,
+            }
+        return chains
+
+    def dump(self, family, table):
+        """
+        Yields the iptables-save -c output of a table
+
+        :param family
+        :param table
+        :return lines
+        """
+        chains = self.load_table(['iptables-save' if family == 'ipv4' else 'ip6tables-save', '-t', table])
+        yield '*%s\n' % table
+        for name in chains.keys():
+            chain = chains[name]
+            yield ':%s %s [%d:%d]\n' % (name, chain['policy'] or '-', chain['packets'], chain['bytes'])
+        for name in chains.keys():
+            for rule in chains[name]['rules']:
+                yield '[%d:%d] -A %s %s\n' % (rule.packets, rule.bytes, name, rule.specline())
+        yield 'COMMIT\n'
+
+    def begin(self, cmd, family, table):
+        """
+        Starts a restore transaction on a table
+
+        :param cmd
+        :param family
+        :param table
+        :return
+        """
+        handle = self.__table(family, table)
+        handle.refresh()
+        handle.autocommit = False
+
+    def commit(self, cmd, family, table):
+        """
+        Commits a restore transaction on a table
+
+        :param cmd
+        :param family
+        :param table
+        :return
+        """
+        handle = self.__table(family, table)
+        try:
+            handle.commit()
+        except iptc.IPTCError as e:
+            raise netfilter.errors.IptablesError(cmd, str(e))
+        finally:
+            handle.autocommit = True
+
+    def abort(self, cmd, family, table):
+        """
+        Abandons a restore transaction on a table
+
+        :param cmd
+        :param family
+        :param table
+        :return
+        """
+        handle = self.__table(family, table)
+        handle.refresh()
+        handle.autocommit = True
+
+    def create_chain(self, cmd, family, table, chain):
+        """
+        Creates a chain
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :return
+        """
+        handle = self.__table(family, table)
+        if handle.is_chain(chain):
+            raise netfilter.errors.IptablesError(cmd, "iptables: Chain already exists.")
+        self.__call(cmd, handle.create_chain, chain)
+
+    def delete_chain(self, cmd, family, table, chain):
+        """
+        Deletes a chain, or every user chain when chain is None
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :return
+        """
+        handle = self.__table(family, table)
+        if chain is None:
+            for entry in list(handle.chains):
+                if not entry.is_builtin():
+                    self.__call(cmd, entry.delete)
+        else:
+            self.__call(cmd, self.__chain(cmd, handle, chain).delete)
+
+    def flush_chain(self, cmd, family, table, chain):
+        """
+        Flushes a chain, or every chain when chain is None
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :return
+        """
+        handle = self.__table(family, table)
+        if chain is None:
+            for entry in handle.chains:
+                self.__call(cmd, entry.flush)
+        else:
+            self.__call(cmd, self.__chain(cmd, handle, chain).flush)
+
+    def rename_chain(self, cmd, family, table, chain, new_chain):
+        """
+        Renames a chain
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :param new_chain
+        :return
+        """
+        handle = self.__table(family, table)
+        self.__call(cmd, self.__chain(cmd, handle, chain).rename, new_chain)
+
+    def set_policy(self, cmd, family, table, chain, policy):
+        """
+        Sets the policy of a built-in chain
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :param policy
+        :return
+        """
+        handle = self.__table(family, table)
+        self.__call(cmd, self.__chain(cmd, handle, chain).set_policy, policy)
+
+    def insert_rule(self, cmd, family, table, chain, position, rule):
+        """
+        Inserts a rule at a position (starting at 1), or appends it when position is None
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :param position
+        :param rule
+        :return
+        """
+        handle = self.__table(family, table)
+        entry = self.__chain(cmd, handle, chain)
+        if position is None:
+            self.__call(cmd, entry.append_rule, self.__rule_to_iptc(cmd, family, rule))
+        else:
+            self.__call(cmd, entry.insert_rule, self.__rule_to_iptc(cmd, family, rule), position - 1)
+
+    def replace_rule(self, cmd, family, table, chain, position, rule):
+        """
+        Replaces the rule at a position (starting at 1)
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :param position
+        :param rule
+        :return
+        """
+        handle = self.__table(family, table)
+        entry = self.__chain(cmd, handle, chain)
+        self.__call(cmd, entry.replace_rule, self.__rule_to_iptc(cmd, family, rule), position - 1)
+
+    def delete_rule(self, cmd, family, table, chain, rule):
+        """
+        Deletes a rule, given either as a Rule or as a position (starting at 1)
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :param rule
+        :return
+        """
+        handle = self.__table(family, table)
+        entry = self.__chain(cmd, handle, chain)
+        if isinstance(rule, int):
+            rules = entry.rules
+            if rule < 1 or rule > len(rules):
+                raise netfilter.errors.IptablesError(cmd, "iptables: Index of deletion too big.")
+            self.__call(cmd, entry.delete_rule, rules[rule - 1])
+        else:
+            self.__call(cmd, entry.delete_rule, self.__rule_to_iptc(cmd, family, rule))
+
+    def __save_target(self, cmd):
+        """
+        Returns the family and table of an iptables-save command line
+
+        :param cmd
+        :return family, table
+        """
+        if '-t' not in cmd:
+            raise netfilter.errors.IptablesError(cmd, "a table is required")
+        family = 'ipv4'
+        if cmd[0].split('/')[-1].startswith('ip6'):
+            family = 'ipv6'
+        return family, cmd[cmd.index('-t') + 1]
+
+    def __table(self, family, table):
+        """
+        Returns the python-iptc table
+
+        :param family
+        :param table
+        :return table
+        """
+        if family == 'ipv6':
+            return iptc.Table6(table)
+        return iptc.Table(table)
+
+    def __chain(self, cmd, handle, chain):
+        """
+        Returns the python-iptc chain of a table
+
+        :param cmd
+        :param handle
+        :param chain
+        :return chain
+        """
+        if not handle.is_chain(chain):
+            raise netfilter.errors.IptablesError(cmd, "iptables: No chain/target/match by that name.")
+        return iptc.Chain(handle, chain)
+
+    def __call(self, cmd, func, *args):
+        """
+        Calls python-iptc, turning its errors into IptablesError
+
+        :param cmd
+        :param func
+        :param *args
+        :return func(*args)
+        """
+        try:
+            return func(*args)
+        except iptc.IPTCError as e:
+            raise netfilter.errors.IptablesError(cmd, str(e))
+
+    def __rule_to_iptc(self, cmd, family, rule):
+        """
+        Translates a Rule into a python-iptc rule
+
+        :param cmd
+        :param family
+        :param rule
+        :return entry
+        """
+        if family == 'ipv6':
+            entry = iptc.Rule6()
+        else:
+            entry = iptc.Rule()
+        try:
+            if rule.protocol:
+                entry.protocol = value_to_iptc(rule.protocol)
+            if rule.in_interface:
+                entry.in_interface = value_to_iptc(rule.in_interface)
+            if rule.out_interface:
+                entry.out_interface = value_to_iptc(rule.out_interface)
+            if rule.source:
+                entry.src = value_to_iptc(rule.source)
+            if rule.destination:
+                entry.dst = value_to_iptc(rule.destination)
+            for match in rule.matches:
+                self.__set_options(entry.create_match(match.name()), match)
+            if rule.goto:
+                self.__set_options(entry.create_target(rule.goto.name(), goto=True), rule.goto)
+            elif rule.jump:
+                self.__set_options(entry.create_target(rule.jump.name()), rule.jump)
+        except (iptc.IPTCError, ValueError) as e:
+            raise netfilter.errors.IptablesError(cmd, str(e))
+        return entry
+
+    def __set_options(self, module, extension):
+        """
+        Copies the options of a Match or Target onto a python-iptc module
+
+        :param module
+        :param extension
+        :return
+        """
+        for opt, vals in sorted(extension.options().items()):
+            value = ' '.join(vals)
+            if opt.startswith('! '):
+                opt = opt[2:]
+                value = '!' + value
+            setattr(module, opt.replace('-', '_'), value)
+
+    def __rule_from_iptc(self, family, entry):
+        """
+        Translates a python-iptc rule into a Rule
+
+        :param family
+        :param entry
+        :return rule
+        """
+        rule = netfilter.rule.Rule()
+        protocol = entry.protocol
+        if protocol and protocol.lstrip('!') not in ('ip', 'all', '0'):
+            rule.protocol = protocol.replace('!', '! ', 1) if protocol.startswith('!') else protocol
+        if entry.in_interface:
+            rule.in_interface = entry.in_interface.replace('!', '! ', 1) \
+                if entry.in_interface.startswith('!') else entry.in_interface
+        if entry.out_interface:
+            rule.out_interface = entry.out_interface.replace('!', '! ', 1) \
+                if entry.out_interface.startswith('!') else entry.out_interface
+        rule.source = host_from_iptc(family, entry.src)
+        rule.destination = host_from_iptc(family, entry.dst)
+        for match in entry.matches:
+            rule.matches.append(netfilter.rule.Match(match.name, self.__option_bits(match)))
+        target = entry.target
+        if target is not None and target.name:
+            extension = netfilter.rule.Target(target.name, self.__option_bits(target))
+            if getattr(target, 'goto', False):
+                rule.goto = extension
+            else:
+                rule.jump = extension
+        return rule
+
+    def __option_bits(self, module):
+        """
+        Returns the options of a python-iptc module as iptables words
+
+        :param module
+        :return bits
+        """
+        bits = []
+        for opt, vals in sorted(module.get_all_parameters().items()):
+            vals = list(vals)
+            if vals and vals[0] == '!':
+                bits.append('!')
+                vals = vals[1:]
+            bits.append('--%s' % opt)
+            bits.extend(vals)
+        return bits
@@ -0,0 +1,199 @@
+import time
+from array import array
+
+import netfilter.parser
+
+"""
+        monitor.py                                  Author: Zach Bricker
+
+
+        Turns the packet and byte counters of a table into per-rule and per-chain rates
+
+"""
+
+# parsed rules are cached by their iptables-save text, bounded like the parser caches
+spec_cache_limit = 65536
+
+
+class RateMonitor:
+    def __init__(self, table, interval=1.0, chains=None, clock=time.time):
+        """
+        Constructor. Rules are matched across samples by chain, canonical key and
+        occurrence, and their counters live in flat arrays indexed by slot.
+
+        :param table
+        :param interval
+        :param chains
+        :param clock
+        :return
+        """
+        self.table = table
+        self.interval = interval
+        self.chains = chains
+        self.clock = clock
+        self.__specs = {}
+        self.__slots = {}
+        self.__rules = []
+        self.__chain_names = []
+        self.__packets = array('Q')
+        self.__bytes = array('Q')
+        self.__pps = array('d')
+        self.__bps = array('d')
+        self.__seen = array('L')
+        self.__generation = 0
+        self.__last_time = None
+
+    def sample(self):
+        """
+        Reads the table counters once and updates the rates
+
+        :return
+        """
+        now = self.clock()
+        elapsed = None
+        if self.__last_time is not None:
+            elapsed = now - self.__last_time
+        self.__generation += 1
+        generation = self.__generation
+        occurrences = {}
+        seen = 0
+        for chain, packets, nbytes, spec in self.table.iter_counters():
+            if self.chains is not None and chain not in self.chains:
+                continue
+            key = self.__key(spec)
+            occurrence = occurrences.get((chain, key), 0)
+            occurrences[(chain, key)] = occurrence + 1
+            seen += 1
+            slot = self.__slots.get((chain, key, occurrence))
+            if slot is None:
+                self.__add(chain, key, occurrence, spec, packets, nbytes, generation)
+                continue
+            if elapsed and self.__seen[slot] == generation - 1:
+                delta = packets - self.__packets[slot]
+                if delta < 0:
+                    # counters were zeroed in between
+                    delta = packets
+                self.__pps[slot] = delta / elapsed
+                delta = nbytes - self.__bytes[slot]
+                if delta < 0:
+                    delta = nbytes
+                self.__bps[slot] = delta / elapsed
+            else:
+                self.__pps[slot] = 0.0
+                self.__bps[slot] = 0.0
+            self.__packets[slot] = packets
+            self.__bytes[slot] = nbytes
+            self.__seen[slot] = generation
+        self.__last_time = now
+        stale = len(self.__seen) - seen
+        if stale and stale * 2 > len(self.__seen):
+            self.prune()
+
+    def rule_rates(self, chain=None):
+        """
+        Returns (chain, rule, pps, bps) for every rule seen in the last sample
+
+        :param chain
+        :return rates
+        """
+        rates = []
+        for slot in range(len(self.__seen)):
+            if self.__seen[slot] != self.__generation:
+                continue
+            if chain is not None and self.__chain_names[slot] != chain:
+                continue
+            rates.append((self.__chain_names[slot], self.__rules[slot],
+                          self.__pps[slot], self.__bps[slot]))
+        return rates
+
+    def chain_rates(self):
+        """
+        Returns the summed rule rates of every chain seen in the last sample
+
+        :return {chain: (pps, bps)}
+        """
+        rates = {}
+        for slot in range(len(self.__seen)):
+            if self.__seen[slot] != self.__generation:
+                continue
+            pps, bps = rates.get(self.__chain_names[slot], (0.0, 0.0))
+            rates[self.__chain_names[slot]] = (pps + self.__pps[slot], bps + self.__bps[slot])
+        return rates
+
+    def run(self, callback=None, count=None):
+        """
+        Samples every interval seconds, calling callback(monitor) after each sample
+
+        :param callback
+        :param count
+        :return
+        """
+        samples = 0
+        next_time = time.time()
+        while count is None or samples < count:
+            self.sample()
+            samples += 1
+            if callback is not None:
+                callback(self)
+            if count is not None and samples >= count:
+                break
+            next_time += self.interval
+            delay = next_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_time = time.time()
+
+    def prune(self):
+        """
+        Drops the rules that disappeared from the table
+
+        :return
+        """
+        keep = [slot for slot in range(len(self.__seen)) if self.__seen[slot] == self.__generation]
+        idents = dict((slot, ident) for ident, slot in self.__slots.items())
+        self.__slots = dict((idents[slot], pos) for pos, slot in enumerate(keep))
+        self.__rules = [self.__rules[slot] for slot in keep]
+        self.__chain_names = [self.__chain_names[slot] for slot in keep]
+        self.__packets = array('Q', [self.__packets[slot] for slot in keep])
+        self.__bytes = array('Q', [self.__bytes[slot] for slot in keep])
+        self.__pps = array('d', [self.__pps[slot] for slot in keep])
+        self.__bps = array('d', [self.__bps[slot] for slot in keep])
+        self.__seen = array('L', [self.__seen[slot] for slot in keep])
+
+    def __key(self, spec):
+        """
+        Returns the canonical key of a rule from its iptables-save text
+
+        :param spec
+        :return key
+        """
+        entry = self.__specs.get(spec)
+        if entry is None:
+            if len(self.__specs) >= spec_cache_limit:
+                self.__specs.clear()
+            rule = netfilter.parser.parse_rule(spec)
+            entry = self.__specs[spec] = (rule.key(), rule)
+        return entry[0]
+
+    def __add(self, chain, key, occurrence, spec, packets, nbytes, generation):
+        """
+        Allocates a slot for a rule seen for the first time
+
+        :param chain
+        :param key
+        :param occurrence
+        :param spec
+        :param packets
+        :param nbytes
+        :param generation
+        :return
+        """
+        self.__slots[(chain, key, occurrence)] = len(self.__seen)
+        self.__rules.append(self.__specs[spec][1])
+        self.__chain_names.append(chain)
+        self.__packets.append(packets)
+        self.__bytes.append(nbytes)
+        self.__pps.append(0.0)
+        self.__bps.append(0.0)
+        self.__seen.append(generation)
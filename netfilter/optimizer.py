@@ -0,0 +1,183 @@
+import netfilter.analyzer
+import netfilter.reconcile
+from netfilter.rule import Match, Rule
+
+"""
+        optimizer.py                                Author: Zach Bricker
+
+
+        Rewrites chains so packets traverse fewer rules: adjacent rules differing only
+        in destination ports are merged into multiport rules, and busy rules are moved
+        ahead of quieter ones when that cannot change any verdict
+
+"""
+
+
+def traversal_cost(rules):
+    """
+    Returns how many rule evaluations the counted packets cost, i.e. the sum of
+    the packets matched by each rule times its position
+
+    :param rules
+    :return cost
+    """
+    return sum(rule.packets * (pos + 1) for pos, rule in enumerate(rules))
+
+
+def can_swap(first, second):
+    """
+    Checks whether two adjacent rules can trade places without changing any
+    verdict: either no packet matches both, or both give the same verdict
+
+    :param first
+    :param second
+    :return swappable
+    """
+    if first is None or second is None:
+        return False
+    if first.disjoint(second):
+        return True
+    return (first.terminal and second.terminal and
+            first.rule.goto is None and second.rule.goto is None and
+            first.rule.jump.key() == second.rule.jump.key())
+
+
+def format_ports(ranges):
+    """
+    Turns (first, last) ranges into a multiport port list
+
+    :param ranges
+    :return ports
+    """
+    return ','.join(str(first) if first == last else '%d:%d' % (first, last) for first, last in ranges)
+
+
+def merge_rules(profiles):
+    """
+    Returns one rule matching the destination ports of all the given rules,
+    which only differ in them, with their counters summed
+
+    :param profiles
+    :return rule
+    """
+    base = profiles[0].rule
+    ranges = []
+    for profile in profiles:
+        for port_range in profile.ports['dport'][0]:
+            if port_range not in ranges:
+                ranges.append(port_range)
+    matches = []
+    for match in base.matches:
+        bits = []
+        for option, values in match.key()[1]:
+            if option in ('dport', 'dports'):
+                continue
+            if option.startswith('! '):
+                bits.extend(['!', '--' + option[2:]])
+            else:
+                bits.append('--' + option)
+            bits.extend(values)
+        if match.name() in ('tcp', 'udp', 'sctp', 'multiport') and not bits:
+            continue
+        matches.append(Match(match.name(), bits))
+    matches.append(Match('multiport', ['--dports', format_ports(ranges)]))
+    rule = Rule(protocol=base.protocol,
+                in_interface=base.in_interface,
+                out_interface=base.out_interface,
+                source=base.source,
+                destination=base.destination,
+                matches=matches,
+                goto=base.goto,
+                jump=base.jump)
+    rule.packets = sum(profile.rule.packets for profile in profiles)
+    rule.bytes = sum(profile.rule.bytes for profile in profiles)
+    return rule
+
+
+def merge_ports(rules, chains=()):
+    """
+    Merges runs of adjacent rules which only differ in their destination ports
+    into multiport rules
+
+    :param rules
+    :param chains
+    :return rules
+    """
+    profiles = netfilter.analyzer.profile_rules(rules, chains)
+    runs = {}
+    for finding in netfilter.analyzer.mergeable_runs(profiles, None):
+        runs[finding.related[0]] = finding.related
+    merged = []
+    pos = 1
+    while pos <= len(rules):
+        run = runs.get(pos)
+        if run is None:
+            merged.append(rules[pos - 1])
+            pos += 1
+            continue
+        merged.append(merge_rules([profiles[member - 1] for member in run]))
+        pos += len(run)
+    return merged
+
+
+def reorder_by_hits(rules, chains=()):
+    """
+    Moves every rule ahead of the less busy rules before it, as long as it can
+    swap with each rule it passes. Rules that cannot be compared stay barriers.
+
+    :param rules
+    :param chains
+    :return rules
+    """
+    profiles = netfilter.analyzer.profile_rules(rules, chains)
+    ordered = []
+    for profile, rule in zip(profiles, rules):
+        pos = len(ordered)
+        while pos > 0:
+            previous, previous_rule = ordered[pos - 1]
+            if previous_rule.packets >= rule.packets or not can_swap(previous, profile):
+                break
+            pos -= 1
+        ordered.insert(pos, (profile, rule))
+    return [rule for profile, rule in ordered]
+
+
+def optimize_chain(rules, chains=()):
+    """
+    Merges port rules, reorders by hit counters and merges again, since moving
+    rules can make compatible ones adjacent
+
+    :param rules
+    :param chains
+    :return rules
+    """
+    rules = merge_ports(rules, chains)
+    rules = reorder_by_hits(rules, chains)
+    return merge_ports(rules, chains)
+
+
+def optimize_table(table, chainnames=None):
+    """
+    Optimizes the chains of a table and applies the result through reconcile,
+    so only the rules that changed are touched. Use an atomic_commit table to
+    switch over in one transaction.
+
+    :param table
+    :param chainnames
+    :return applied
+    """
+    live = table.get_ruleset()
+    desired = netfilter.reconcile.DesiredTable(table.name())
+    for chainname in live.keys():
+        chain = live[chainname]
+        desired.create_chain(chainname)
+        if chain['policy'] is not None:
+            desired.set_policy(chainname, chain['policy'])
+        rules = chain['rules']
+        if chainnames is None or chainname in chainnames:
+            rules = optimize_chain(rules, live)
+        for rule in rules:
+            desired.append_rule(chainname, rule)
+    applied = netfilter.reconcile.reconcile_table(table, desired)
+    table.commit()
+    return applied
@@ -1,3 +1,4 @@
+import io
 import re
 
 try:
@@ -15,10 +16,12 @@ import netfilter.rule
 """
 
 # define useful regexps
+re_table = re.compile(r'^\*([^\s]+)$')
 re_chain = re.compile(r'^:*([^\s]+) ([^\s]+) \[([0-9]+):([0-9]+)\]$')
 re_rule = re.compile(r'^\[([0-9]+):([0-9]+)\] -A ([^\s]+) (.*)$')
 re_word = re.compile(r'("[^"]*"|[^\s]+)')
 re_main_opt = re.compile(r'^-([^-])$')
+re_space = re.compile(r'\s')
 
 
 class ODict(UserDict):
@@ -36,6 +39,10 @@ class ODict(UserDict):
         UserDict.__setitem__(self, key, item)
         if key not in self._keys: self._keys.append(key)
 
+    def __delitem__(self, key):
+        UserDict.__delitem__(self, key)
+        self._keys.remove(key)
+
     def keys(self):
         return self._keys
 
@@ -68,6 +75,45 @@ def split_words(line):
         return line.split()
 
 
+# extensions are immutable, so identical ones are shared between parsed rules
+shared_extensions = {}
+shared_extensions_limit = 65536
+
+
+def share_extension(cls, name, opts):
+    """
+    Returns the shared extension built from a name and its option words
+
+    :param cls
+    :param name
+    :param opts
+    :return extension
+    """
+    key = (cls, name, tuple(opts))
+    extension = shared_extensions.get(key)
+    if extension is None:
+        if len(shared_extensions) >= shared_extensions_limit:
+            shared_extensions.clear()
+        extension = shared_extensions[key] = cls(name, opts)
+    return extension
+
+
+def join_words(bits):
+    """
+    Takes in a list of words and returns a line that split_words turns back into the same list
+
+    :param bits
+    :return line
+    """
+    words = []
+    for bit in bits:
+        if not bit or re_space.search(bit):
+            words.append('"%s"' % bit)
+        else:
+            words.append(bit)
+    return ' '.join(words)
+
+
 def pull_extension_opts(bits, pos):
     """
     Returns a modify bits
@@ -101,13 +147,16 @@ def pull_main_opt(bits, pos):
 
 def parse_rule(spec):
     """
-    Parse a rule together
+    Parse a rule together, from a string or a list of words
 
     :param spec
     :return rule
     """
     rule = netfilter.rule.Rule()
-    bits = split_words(spec)
+    if isinstance(spec, list):
+        bits = list(spec)
+    else:
+        bits = split_words(spec)
     pos = 0
     while pos < len(bits):
         # in iptables 1.4.3, negation moved before the match option
@@ -123,16 +172,16 @@ def parse_rule(spec):
         elif bit == '-g':
             target_name = bits[pos]
             opts, pos = pull_extension_opts(bits, pos + 1)
-            rule.goto = netfilter.rule.Target(target_name, opts)
+            rule.goto = share_extension(netfilter.rule.Target, target_name, opts)
         elif bit == '-j':
             target_name = bits[pos]
             opts, pos = pull_extension_opts(bits, pos + 1)
-            rule.jump = netfilter.rule.Target(target_name, opts)
+            rule.jump = share_extension(netfilter.rule.Target, target_name, opts)
         elif bit == '-m':
             match_name = bits[pos]
             opts, pos = pull_extension_opts(bits, pos + 1)
             rule.matches.append(
-                netfilter.rule.Match(match_name, opts))
+                share_extension(netfilter.rule.Match, match_name, opts))
         elif bit == '-o':
             rule.out_interface, pos = pull_main_opt(bits, pos)
         elif bit == '-p':
@@ -144,6 +193,60 @@ def parse_rule(spec):
     return rule
 
 
+def iter_lines(data):
+    """
+    Iterates over the lines of a dump without copying it, the dump being either
+    a string or any iterable of lines such as a pipe
+
+    :param data
+    :return lines
+    """
+    if isinstance(data, str):
+        return io.StringIO(data)
+    return data
+
+
+def iter_save(data):
+    """
+    Parse a dump incrementally, yielding ('table', name),
+    ('chain', name, policy, packets, bytes) and ('rule', chain, rule) events
+
+    :param data
+    :return events
+    """
+    for line in iter_lines(data):
+        m = re_rule.match(line)
+        if m:
+            rule = parse_rule(m.group(4))
+            rule.packets = int(m.group(1))
+            rule.bytes = int(m.group(2))
+            yield 'rule', m.group(3), rule
+            continue
+        m = re_chain.match(line)
+        if m:
+            policy = None
+            if m.group(2) != '-':
+                policy = m.group(2)
+            yield 'chain', m.group(1), policy, int(m.group(3)), int(m.group(4))
+            continue
+        m = re_table.match(line)
+        if m:
+            yield 'table', m.group(1)
+
+
+def iter_counters(data):
+    """
+    Yields (chain, packets, bytes, spec) for every rule of a dump without parsing the rules
+
+    :param data
+    :return counters
+    """
+    for line in iter_lines(data):
+        m = re_rule.match(line)
+        if m:
+            yield m.group(3), int(m.group(1)), int(m.group(2)), m.group(4).rstrip()
+
+
 def parse_chains(data):
     """
     Parse together a chain
@@ -152,7 +255,7 @@ def parse_chains(data):
     :return chain
     """
     chains = ODict()
-    for line in data.splitlines(True):
+    for line in iter_lines(data):
         m = re_chain.match(line)
         if m:
             policy = None
@@ -175,7 +278,7 @@ def parse_rules(data, chain):
     :return rules
     """
     rules = []
-    for line in data.splitlines(True):
+    for line in iter_lines(data):
         m = re_rule.match(line)
         if m and m.group(3) == chain:
             rule = parse_rule(m.group(4))
@@ -183,3 +286,63 @@ def parse_rules(data, chain):
             rule.bytes = int(m.group(2))
             rules.append(rule)
     return rules
+
+
+def index_event(chains, event):
+    """
+    Adds a parser event to a per-chain index as built by parse_save
+
+    :param chains
+    :param event
+    :return
+    """
+    if event[0] == 'rule':
+        chain = chains.get(event[1])
+        if chain is None:
+            chain = chains[event[1]] = {
+                'policy': None,
+                'packets': 0,
+                'bytes': 0,
+                'rules': [],
+            }
+        chain['rules'].append(event[2])
+    elif event[0] == 'chain':
+        chains[event[1]] = {
+            'policy': event[2],
+            'packets': event[3],
+            'bytes': event[4],
+            'rules': [],
+        }
+
+
+def parse_save(data):
+    """
+    Parse a whole table dump in a single pass, indexing every chain at once
+
+    :param data
+    :return chains
+    """
+    chains = ODict()
+    for event in iter_save(data):
+        index_event(chains, event)
+    return chains
+
+
+def parse_tables(data):
+    """
+    Parse a dump of several tables, as printed by iptables-save without -t,
+    in a single pass, indexing the chains of every table
+
+    :param data
+    :return tables
+    """
+    tables = ODict()
+    chains = None
+    for event in iter_save(data):
+        if event[0] == 'table':
+            chains = tables[event[1]] = ODict()
+        elif chains is None:
+            raise ParseError("%s %s found before any table" % (event[0], event[1]))
+        else:
+            index_event(chains, event)
+    return tables
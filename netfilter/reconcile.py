@@ -0,0 +1,284 @@
+import difflib
+import hashlib
+
+import netfilter.parser
+from netfilter.rule import Match, Rule
+
+"""
+        reconcile.py                                Author: Zach Bricker
+
+
+        Compares a desired ruleset against the live one and applies only the operations needed
+
+"""
+
+# comment carried by the rule stamping a table with the fingerprint of its desired state
+fingerprint_prefix = 'netfilter-fingerprint:'
+
+
+class DesiredTable:
+    def __init__(self, name):
+        """
+        Constructor
+
+        :param name
+        :return
+        """
+        self.__name = name
+        self.__chains = netfilter.parser.ODict()
+
+    def name(self):
+        """
+        Returns the table name
+
+        :return self.__name
+        """
+        return self.__name
+
+    def create_chain(self, chainname):
+        """
+        Creates a chain
+
+        :param chainname
+        :return
+        """
+        self.__chain(chainname)
+
+    def delete_chain(self, chainname=None):
+        """
+        Deletes a chain, or every chain without a policy
+
+        :param chainname
+        :return
+        """
+        if chainname:
+            del self.__chains[chainname]
+        else:
+            for name in list(self.__chains.keys()):
+                if self.__chains[name]['policy'] is None:
+                    self.delete_chain(name)
+
+    def flush_chain(self, chainname=None):
+        """
+        Flushes a chain, or every chain
+
+        :param chainname
+        :return
+        """
+        if chainname:
+            del self.__chain(chainname)['rules'][:]
+        else:
+            for name in self.__chains.keys():
+                del self.__chains[name]['rules'][:]
+
+    def list_chains(self):
+        """
+        Lists all chains
+
+        :return self.__chains.keys()
+        """
+        return self.__chains.keys()
+
+    def get_policy(self, chainname):
+        """
+        Returns a policy
+
+        :param chainname
+        :return self.__chains[chainname]['policy']
+        """
+        return self.__chains[chainname]['policy']
+
+    def set_policy(self, chainname, policy):
+        """
+        Sets a policy
+
+        :param chainname
+        :param policy
+        :return
+        """
+        self.__chain(chainname)['policy'] = policy
+
+    def append_rule(self, chainname, rule):
+        """
+        Adds a rule to the end of a chain
+
+        :param chainname
+        :param rule
+        :return
+        """
+        self.__chain(chainname)['rules'].append(rule)
+
+    def prepend_rule(self, chainname, rule):
+        """
+        Adds a rule to the beginning of a chain
+
+        :param chainname
+        :param rule
+        :return
+        """
+        self.__chain(chainname)['rules'].insert(0, rule)
+
+    def list_rules(self, chainname):
+        """
+        List all rules under a chain
+
+        :param chainname
+        :return rules
+        """
+        if chainname not in self.__chains:
+            return []
+        return self.__chains[chainname]['rules']
+
+    def get_ruleset(self):
+        """
+        Returns the policy and rules of every chain
+
+        :return self.__chains
+        """
+        return self.__chains
+
+    def commit(self):
+        """
+        Nothing to commit, the desired state only lives in memory
+
+        :return
+        """
+        pass
+
+    def get_buffer(self):
+        """
+        Returns the buffer, which is always empty
+
+        :return []
+        """
+        return []
+
+    def __chain(self, chainname):
+        """
+        Returns a chain, creating it if needed
+
+        :param chainname
+        :return chain
+        """
+        chain = self.__chains.get(chainname)
+        if chain is None:
+            chain = self.__chains[chainname] = {
+                'policy': None,
+                'rules': [],
+            }
+        return chain
+
+
+def fingerprint(desired, sets=None):
+    """
+    Returns a digest of the chains, policies and rules of a desired table, and of
+    the members of the sets given as a dict of set names to entries
+
+    :param desired
+    :param sets
+    :return digest
+    """
+    digest = hashlib.blake2b(desired.name().encode(), digest_size=16)
+    chains = desired.get_ruleset()
+    for chainname in chains.keys():
+        chain = chains[chainname]
+        digest.update((':%s %s\n' % (chainname, chain['policy'] or '-')).encode())
+        for rule in chain['rules']:
+            digest.update((rule.specline() + '\n').encode())
+    for setname in sorted(sets or ()):
+        digest.update(('set %s %s\n' % (setname, ' '.join(sorted(str(entry) for entry in sets[setname])))).encode())
+    return digest.hexdigest()
+
+
+def stamp_rule(digest):
+    """
+    Returns the rule recording a fingerprint in a chain; it has no target, so it
+    only counts the packets reaching it
+
+    :param digest
+    :return rule
+    """
+    return Rule(matches=[Match('comment', ['--comment', fingerprint_prefix + digest])])
+
+
+def diff_rules(live, desired):
+    """
+    Returns the operations turning the live rules of a chain into the desired
+    ones. Positions start at 1 and are valid when the operations are applied in
+    the order they are returned.
+
+    :param live
+    :param desired
+    :return ops
+    """
+    matcher = difflib.SequenceMatcher(None,
+                                      [rule.key() for rule in live],
+                                      [rule.key() for rule in desired],
+                                      autojunk=False)
+    ops = []
+    # walk backwards so that earlier positions stay valid
+    for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+        if tag == 'equal':
+            continue
+        common = 0
+        if tag == 'replace':
+            common = min(i2 - i1, j2 - j1)
+            for k in range(common):
+                ops.append(('replace', i1 + k + 1, desired[j1 + k]))
+        for pos in range(i2, i1 + common, -1):
+            ops.append(('delete', pos))
+        for k in range(j2 - j1 - common):
+            ops.append(('insert', i1 + common + k + 1, desired[j1 + common + k]))
+    return ops
+
+
+def reconcile_table(table, desired):
+    """
+    Applies the minimal set of operations to make a table match the desired one.
+    Chains missing from the desired table are flushed, and deleted unless they
+    are built-in.
+
+    :param table
+    :param desired
+    :return applied
+    """
+    live = table.get_ruleset()
+    wanted = desired.get_ruleset()
+    applied = []
+
+    for chainname in wanted.keys():
+        if chainname not in live:
+            table.create_chain(chainname)
+            applied.append((chainname, 'create'))
+
+    for chainname in wanted.keys():
+        chain = wanted[chainname]
+        current = live.get(chainname)
+        current_rules = []
+        current_policy = None
+        if current is not None:
+            current_rules = current['rules']
+            current_policy = current['policy']
+        for op in diff_rules(current_rules, chain['rules']):
+            if op[0] == 'delete':
+                table.delete_rule_at(chainname, op[1])
+            elif op[0] == 'insert':
+                table.insert_rule(chainname, op[1], op[2])
+            else:
+                table.replace_rule(chainname, op[1], op[2])
+            applied.append((chainname,) + op)
+        if chain['policy'] and chain['policy'] != current_policy:
+            table.set_policy(chainname, chain['policy'])
+            applied.append((chainname, 'policy', chain['policy']))
+
+    # chains nobody wants any more: flush first so no references remain
+    stale = [name for name in live.keys() if name not in wanted]
+    for chainname in stale:
+        if live[chainname]['rules']:
+            table.flush_chain(chainname)
+            applied.append((chainname, 'flush'))
+    for chainname in stale:
+        if live[chainname]['policy'] is None:
+            table.delete_chain(chainname)
+            applied.append((chainname, 'delete_chain'))
+    return applied
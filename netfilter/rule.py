@@ -1,5 +1,6 @@
 import logging
 import re
+from sys import intern
 
 import netfilter.parser
 
@@ -13,9 +14,57 @@ import netfilter.parser
 
 re_extension_opt = re.compile(r'^--(.*)$')
 
+# option tuples are immutable, so identical ones are shared between extensions
+shared_options = {}
+shared_options_limit = 65536
+
+
+def share_options(options):
+    """
+    Returns the shared copy of an option tuple
+
+    :param options
+    :return options
+    """
+    shared = shared_options.get(options)
+    if shared is None:
+        if len(shared_options) >= shared_options_limit:
+            shared_options.clear()
+        shared = shared_options[options] = options
+    return shared
+
+
+def intern_value(value):
+    """
+    Interns a string value, leaving None and other objects untouched
+
+    :param value
+    :return value
+    """
+    if isinstance(value, str):
+        return intern(value)
+    return value
+
+
+def canonical_host(value):
+    """
+    Produces the "canonical" form of a source / destination
+
+    :param value
+    :return value
+    """
+    # FIXME: we need to handle arbitrary netmasks here
+    if value is not None and value.endswith('/32'):
+        value = value[:-3]
+    return intern_value(value)
+
 
 class Extension:
-    def __init__(self, name, options, rewrite_options={}):
+    __slots__ = ('__name', '__options', '__bits')
+
+    rewrite_options = {}
+
+    def __init__(self, name, options, rewrite_options=None):
         """
         Constructor
 
@@ -24,11 +73,14 @@ class Extension:
         :param rewrite_options
         :return
         """
-        self.__name = name
-        self.__options = {}
-        self.__rewrite_options = rewrite_options
+        self.__name = intern(name)
+        self.__bits = None
+        if rewrite_options is None:
+            rewrite_options = self.rewrite_options
         if options:
-            self.__parse_options(options)
+            self.__options = self.__parse_options(options, rewrite_options)
+        else:
+            self.__options = ()
 
     def __eq__(self, other):
         """
@@ -57,18 +109,36 @@ class Extension:
             return result
         return not result
 
-    def __parse_options(self, options):
+    def __hash__(self):
+        """
+        Rewrites built-in hash function
+
+        :return hash(self.key())
+        """
+        return hash(self.key())
+
+    def key(self):
         """
-        Parses options
+        Returns a canonical, hashable form of the extension
+
+        :return (self.__name, self.__options)
+        """
+        return self.__name, self.__options
+
+    def __parse_options(self, options, rewrite_options):
+        """
+        Parses options into a sorted tuple of (option, values) pairs
 
         :param options
-        :return
+        :param rewrite_options
+        :return options
         """
         if isinstance(options, list):
             bits = options
         else:
             bits = netfilter.parser.split_words(options)
 
+        parsed = {}
         pos = 0
         cur_opt = []
         while pos < len(bits):
@@ -84,33 +154,34 @@ class Extension:
             pos += 1
             # rewrite option to its canonical name
             tmp_opt = m.group(1)
-            if tmp_opt in self.__rewrite_options:
-                tmp_opt = self.__rewrite_options[tmp_opt]
+            if tmp_opt in rewrite_options:
+                tmp_opt = rewrite_options[tmp_opt]
             cur_opt.append(tmp_opt)
 
             # collect value(s)
             vals = []
             while pos < len(bits) and not re_extension_opt.match(bits[pos]):
-                vals.append(bits[pos])
+                vals.append(intern(bits[pos]))
                 pos += 1
 
             # store option
-            opt = ' '.join(cur_opt)
-            self.__options[opt] = vals
+            opt = intern(' '.join(cur_opt))
+            parsed[opt] = tuple(vals)
 
             # reset current option name
             cur_opt = []
+        return share_options(tuple(sorted(parsed.items())))
 
     def log(self, level, prefix=''):
         """
-        Will log level and prefix with self.__name and self.__options
+        Will log level and prefix with self.__name and self.options()
 
         :param level
         :param prefix
         :return
         """
         logging.log(level, "%sname: %s", prefix, self.__name)
-        logging.log(level, "%soptions: %s", prefix, self.__options)
+        logging.log(level, "%soptions: %s", prefix, self.options())
 
     def name(self):
         """
@@ -122,36 +193,49 @@ class Extension:
 
     def options(self):
         """
-        Returns options
+        Returns a copy of the options as a dictionary of lists
 
-        :return self.__options
+        :return options
         """
-        return self.__options
+        return dict((opt, list(vals)) for opt, vals in self.__options)
 
     def specbits(self):
         """
-        Returns bits
+        Returns bits, built once since extensions never change
+
+        :return bits
+        """
+        if self.__bits is None:
+            self.__bits = self.__build_specbits()
+        return list(self.__bits)
+
+    def __build_specbits(self):
+        """
+        Builds bits
 
         :return bits
         """
         bits = []
-        for opt in sorted(self.__options):
+        for opt, optval in self.__options:
             # handle the case where this is a negated option
             m = re.match(r'^! (.*)', opt)
             if m:
                 bits.extend(['!', "--%s" % m.group(1)])
             else:
                 bits.append("--%s" % opt)
-
-            optval = self.__options[opt]
-            if isinstance(optval, list):
-                bits.extend(optval)
-            else:
-                bits.append(optval)
-        return bits
+            bits.extend(optval)
+        return tuple(bits)
 
 
 class Match(Extension):
+    __slots__ = ()
+
+    rewrite_options = {
+        'destination-port': 'dport',
+        'destination-ports': 'dports',
+        'source-port': 'sport',
+        'source-ports': 'sports'}
+
     def __init__(self, name, options=None):
         """
         Constructor
@@ -160,14 +244,12 @@ class Match(Extension):
         :param options
         :return
         """
-        Extension.__init__(self, name, options, {
-            'destination-port': 'dport',
-            'destination-ports': 'dports',
-            'source-port': 'sport',
-            'source-ports': 'sports'})
+        Extension.__init__(self, name, options)
 
 
 class Target(Extension):
+    __slots__ = ()
+
     def __init__(self, name, options=None):
         """
         Constructor
@@ -180,6 +262,10 @@ class Target(Extension):
 
 
 class Rule:
+    __slots__ = ('__protocol', '__destination', '__source', '__goto', '__jump',
+                 '__in_interface', '__out_interface', '__matches', 'packets', 'bytes',
+                 '__key', '__bits', '__bits_matches', '__line')
+
     def __init__(self, **kwargs):
         """
         Constructor
@@ -188,20 +274,22 @@ class Rule:
         :return
         """
         # initialise rule definition
-        self.protocol = None
-        self.destination = None
-        self.source = None
-        self.goto = None
-        self.jump = None
-        self.in_interface = None
-        self.out_interface = None
-        self.matches = []
+        self.__protocol = None
+        self.__destination = None
+        self.__source = None
+        self.__goto = None
+        self.__jump = None
+        self.__in_interface = None
+        self.__out_interface = None
+        self.__matches = []
+        # initialise serialization cache
+        self.__changed()
         # initialise counters
         self.packets = 0
         self.bytes = 0
         # assign supplied arguments
         for k, v in kwargs.items():
-            self.__setattr__(k, v)
+            setattr(self, k, v)
 
     def __eq__(self, other):
         """
@@ -243,26 +331,155 @@ class Rule:
             return result
         return not result
 
-    def __setattr__(self, name, value):
+    def __hash__(self):
         """
-        Rewrites built-in attribute assignment function
+        Rewrites built-in hash function
+
+        :return hash(self.key())
+        """
+        return hash(self.key())
+
+    @property
+    def protocol(self):
+        """
+        Returns the protocol
+
+        :return self.__protocol
+        """
+        return self.__protocol
+
+    @protocol.setter
+    def protocol(self, value):
+        self.__changed()
+        self.__protocol = intern_value(value)
+
+    @property
+    def in_interface(self):
+        """
+        Returns the input interface
+
+        :return self.__in_interface
+        """
+        return self.__in_interface
+
+    @in_interface.setter
+    def in_interface(self, value):
+        self.__changed()
+        self.__in_interface = intern_value(value)
+
+    @property
+    def out_interface(self):
+        """
+        Returns the output interface
+
+        :return self.__out_interface
+        """
+        return self.__out_interface
+
+    @out_interface.setter
+    def out_interface(self, value):
+        self.__changed()
+        self.__out_interface = intern_value(value)
+
+    @property
+    def source(self):
+        """
+        Returns the source
+
+        :return self.__source
+        """
+        return self.__source
+
+    @source.setter
+    def source(self, value):
+        self.__changed()
+        self.__source = canonical_host(value)
+
+    @property
+    def destination(self):
+        """
+        Returns the destination
+
+        :return self.__destination
+        """
+        return self.__destination
+
+    @destination.setter
+    def destination(self, value):
+        self.__changed()
+        self.__destination = canonical_host(value)
+
+    @property
+    def goto(self):
+        """
+        Returns the goto target
+
+        :return self.__goto
+        """
+        return self.__goto
+
+    @goto.setter
+    def goto(self, value):
+        self.__changed()
+        if value is not None and not isinstance(value, Target):
+            value = Target(value)
+        self.__goto = value
+
+    @property
+    def jump(self):
+        """
+        Returns the jump target
+
+        :return self.__jump
+        """
+        return self.__jump
+
+    @jump.setter
+    def jump(self, value):
+        self.__changed()
+        if value is not None and not isinstance(value, Target):
+            value = Target(value)
+        self.__jump = value
+
+    @property
+    def matches(self):
+        """
+        Returns the list of matches
+
+        :return self.__matches
+        """
+        return self.__matches
+
+    @matches.setter
+    def matches(self, value):
+        self.__changed()
+        if not isinstance(value, list):
+            raise Exception("matches attribute requires a list")
+        self.__matches = value
+
+    def __changed(self):
+        """
+        Drops the cached key and serialized forms after a field changed
 
-        :param name
-        :param value
         :return
         """
-        if name == 'source' or name == 'destination':
-            # produce "canonical" form of a source / destination
-            # FIXME: we need to handle arbitrary netmasks here
-            if value is not None and value.endswith('/32'):
-                value = value[:-3]
-        elif name == 'goto' or name == 'jump':
-            if value is not None and not isinstance(value, Target):
-                value = Target(value)
-        elif name == 'matches':
-            if not isinstance(value, list):
-                raise Exception("matches attribute requires a list")
-        self.__dict__[name] = value
+        self.__key = None
+        self.__bits = None
+        self.__bits_matches = None
+        self.__line = None
+
+    def __matches_changed(self):
+        """
+        Checks whether the matches list was modified since the cache was built
+
+        :return changed
+        """
+        # extensions are immutable, so comparing the list items is enough
+        if tuple(self.__matches) != self.__bits_matches:
+            self.__changed()
+            self.__bits_matches = tuple(self.__matches)
+            return True
+        return False
 
     def find(self, rules):
         """
@@ -272,11 +489,36 @@ class Rule:
         :return rule
         :return None
         """
+        if isinstance(rules, RuleIndex):
+            return rules.find(self)
         for rule in rules:
             if self == rule:
                 return rule
         return None
 
+    def key(self):
+        """
+        Returns a canonical, hashable form of the rule which compares the same way as __eq__
+
+        :return key
+        """
+        if self.__matches_changed() or self.__key is None:
+            goto = self.goto
+            if goto is not None:
+                goto = goto.key()
+            jump = self.jump
+            if jump is not None:
+                jump = jump.key()
+            self.__key = (self.protocol,
+                          self.in_interface,
+                          self.out_interface,
+                          self.source,
+                          self.destination,
+                          tuple(match.key() for match in self.matches),
+                          goto,
+                          jump)
+        return self.__key
+
     def log(self, level, prefix=''):
         """
         Logs the rule
@@ -298,7 +540,29 @@ class Rule:
 
     def specbits(self):
         """
-        Returns bits
+        Returns bits, rebuilt only when a field or match changed
+
+        :return bits
+        """
+        if self.__matches_changed() or self.__bits is None:
+            self.__bits = self.__build_specbits()
+        return list(self.__bits)
+
+    def specline(self):
+        """
+        Returns bits as a single line, as used in iptables-restore payloads
+
+        :return line
+        """
+        if self.__matches_changed() or self.__line is None:
+            if self.__bits is None:
+                self.__bits = self.__build_specbits()
+            self.__line = netfilter.parser.join_words(self.__bits)
+        return self.__line
+
+    def __build_specbits(self):
+        """
+        Builds bits
 
         :return bits
         """
@@ -338,4 +602,88 @@ class Rule:
         elif self.jump:
             bits.extend(['-j', self.jump.name()])
             bits.extend(self.jump.specbits())
-        return bits
+        return tuple(bits)
+
+
+class RuleIndex:
+    def __init__(self, rules=None):
+        """
+        Constructor
+
+        :param rules
+        :return
+        """
+        self.__rules = []
+        self.__positions = {}
+        if rules:
+            for rule in rules:
+                self.append(rule)
+
+    def __contains__(self, rule):
+        """
+        Rewrites built-in membership test
+
+        :param rule
+        :return rule.key() in self.__positions
+        """
+        return rule.key() in self.__positions
+
+    def __iter__(self):
+        """
+        Iterates over the indexed rules in order
+
+        :return iter(self.__rules)
+        """
+        return iter(self.__rules)
+
+    def __len__(self):
+        """
+        Returns the number of indexed rules
+
+        :return len(self.__rules)
+        """
+        return len(self.__rules)
+
+    def append(self, rule):
+        """
+        Adds a rule to the end of the index
+
+        :param rule
+        :return
+        """
+        self.__positions.setdefault(rule.key(), []).append(len(self.__rules))
+        self.__rules.append(rule)
+
+    def find(self, rule):
+        """
+        Returns the first indexed rule equal to the given one
+
+        :param rule
+        :return rule
+        :return None
+        """
+        positions = self.__positions.get(rule.key())
+        if positions:
+            return self.__rules[positions[0]]
+        return None
+
+    def index(self, rule):
+        """
+        Returns the position of the first indexed rule equal to the given one
+
+        :param rule
+        :return position
+        """
+        positions = self.__positions.get(rule.key())
+        if not positions:
+            raise ValueError("rule is not in the index")
+        return positions[0]
+
+    def positions(self, rule):
+        """
+        Returns the positions of every indexed rule equal to the given one
+
+        :param rule
+        :return positions
+        """
+        return list(self.__positions.get(rule.key(), []))
@@ -0,0 +1,185 @@
+import queue
+import shutil
+import subprocess
+import threading
+
+import netfilter.backend
+import netfilter.errors
+
+"""
+        session.py                                  Author: Zach Bricker
+
+
+        Keeps one iptables-restore --noflush process open and streams small
+        transactions to it, so adding or removing a rule does not pay for a fork,
+        an exec and the xtables lock every time
+
+"""
+
+# seconds to wait for iptables-restore to acknowledge a transaction
+default_timeout = 30
+
+
+class RestoreSession:
+    def __init__(self, ipv6=False, backend=None, command=None, timeout=default_timeout):
+        """
+        Constructor. Transactions are acknowledged by a comment line written after
+        each one, which iptables-restore --verbose echoes once it got past the
+        COMMIT. A failed transaction makes iptables-restore exit; the next one
+        starts a new process. Backends running commands in-process get every
+        transaction as its own restore call instead.
+
+        The echo goes through stdio, and not every iptables-restore flushes it:
+        the legacy parser of iptables 1.6 and earlier writes comments with a
+        bare fputs, so on a pipe the marker waits in the stdio buffer until the
+        process exits. The default command therefore runs under stdbuf -oL when
+        coreutils provides it, and a transaction that is not acknowledged within
+        timeout seconds kills the process and raises IptablesError.
+
+        :param ipv6
+        :param backend
+        :param command
+        :param timeout
+        :return
+        """
+        if backend is None:
+            backend = netfilter.backend.SubprocessBackend()
+        iptables = 'ip6tables' if ipv6 else 'iptables'
+        self.__persistent = isinstance(backend, netfilter.backend.SubprocessBackend)
+        self.__prefix = []
+        if command is None:
+            command = ['%s-restore' % iptables, '--noflush', '--verbose'] + \
+                backend.restore_wait_option(iptables)
+            stdbuf = shutil.which('stdbuf')
+            if stdbuf is not None and self.__persistent:
+                self.__prefix = [stdbuf, '-oL']
+        self.command = command
+        self.timeout = timeout
+        self.started = 0
+        self.transactions = 0
+        self.__backend = backend
+        self.__lock = threading.Lock()
+        self.__process = None
+        self.__lines = None
+        self.__errors = None
+        self.__errors_done = None
+
+    def transaction(self, payload):
+        """
+        Applies a payload of one or more '*table ... COMMIT' blocks, raising
+        IptablesError with the iptables-restore error when it fails
+
+        :param payload
+        :return
+        """
+        if not payload.endswith('\n'):
+            payload += '\n'
+        with self.__lock:
+            self.transactions += 1
+            if not self.__persistent:
+                self.__backend.run(self.command, payload)
+                return
+            marker = '# netfilter-session %d' % self.transactions
+            process = self.__start()
+            try:
+                process.stdin.write(payload + marker + '\n')
+                process.stdin.flush()
+            except (BrokenPipeError, OSError):
+                pass
+            while True:
+                try:
+                    line = self.__lines.get(timeout=self.timeout)
+                except queue.Empty:
+                    self.__stop(kill=True)
+                    raise netfilter.errors.IptablesError(self.command, "no answer within %s seconds" % self.timeout)
+                if line is None:
+                    raise netfilter.errors.IptablesError(self.command, self.__stop())
+                if line.rstrip('\n') == marker:
+                    return
+
+    def commit(self, table):
+        """
+        Applies the commands buffered by a table as one transaction, dropping
+        them from the buffer once it went through
+
+        :param table
+        :return
+        """
+        buffer = table.get_buffer()
+        if not buffer:
+            return
+        self.transaction(table.get_restore_payload())
+        del buffer[:]
+        table.invalidate_cache()
+
+    def close(self):
+        """
+        Ends the iptables-restore process once it applied what it was sent
+
+        :return
+        """
+        with self.__lock:
+            if self.__process is not None:
+                self.__stop()
+
+    def __start(self):
+        """
+        Returns the running iptables-restore process, starting one if the last
+        one is gone
+
+        :return process
+        """
+        if self.__process is not None:
+            if self.__process.poll() is None:
+                return self.__process
+            self.__stop()
+        self.__process = subprocess.Popen(self.__prefix + self.command,
+                                          stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE,
+                                          stderr=subprocess.PIPE,
+                                          close_fds=True,
+                                          universal_newlines=True)
+        self.started += 1
+        # both pipes are drained by threads so a chatty --verbose can never block the writes
+        self.__lines = queue.Queue()
+        self.__errors = []
+        threading.Thread(target=self.__drain, args=(self.__process.stdout, self.__lines.put), daemon=True).start()
+        self.__errors_done = threading.Thread(target=self.__drain,
+                                              args=(self.__process.stderr, self.__errors.append), daemon=True)
+        self.__errors_done.start()
+        return self.__process
+
+    def __stop(self, kill=False):
+        """
+        Ends the process and returns what it wrote to stderr
+
+        :param kill
+        :return errors
+        """
+        process = self.__process
+        self.__process = None
+        if kill:
+            process.kill()
+        try:
+            process.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+        status = process.wait()
+        self.__errors_done.join()
+        errors = ''.join(line for line in self.__errors if line is not None)
+        return errors or "%s exited with status %d" % (self.command[0], status)
+
+    def __drain(self, pipe, put):
+        """
+        Hands every line of a pipe to put, then None once it is closed
+
+        :param pipe
+        :param put
+        :return
+        """
+        try:
+            for line in pipe:
+                put(line)
+        finally:
+            pipe.close()
+            put(None)
@@ -0,0 +1,613 @@
+import os
+import threading
+import time
+
+import netfilter.backend
+import netfilter.errors
+import netfilter.ipset
+import netfilter.parser
+
+"""
+        simulator.py                                Author: Zach Bricker
+
+
+        An in-memory netfilter that handles the iptables command lines a Table sends,
+        so tables and firewalls can be exercised without root
+
+"""
+
+builtin_chains = {
+    'filter': ['INPUT', 'FORWARD', 'OUTPUT'],
+    'nat': ['PREROUTING', 'INPUT', 'OUTPUT', 'POSTROUTING'],
+    'mangle': ['PREROUTING', 'INPUT', 'FORWARD', 'OUTPUT', 'POSTROUTING'],
+    'raw': ['PREROUTING', 'OUTPUT'],
+    'security': ['INPUT', 'FORWARD', 'OUTPUT'],
+}
+
+standard_targets = ['ACCEPT', 'DROP', 'RETURN', 'QUEUE']
+
+
+class SimulatorBackend(netfilter.backend.CommandBackend):
+    def __init__(self, latency=0.0):
+        """
+        Constructor. With a latency, the (start, end) times of every simulated
+        call are kept in intervals, so tests can tell whether calls overlapped.
+
+        :param latency
+        :return
+        """
+        self.latency = latency
+        self.calls = 0
+        self.intervals = []
+        self.__lock = threading.Lock()
+        self.__tables = {}
+        self.__saved = {}
+        self.__sets = {}
+
+    def run(self, cmd, input=None):
+        """
+        Handles a command line while holding the simulated xtables lock
+
+        :param cmd
+        :param input
+        :return out
+        """
+        with self.__lock:
+            self.__wait()
+            if os.path.basename(cmd[0]).endswith('-save'):
+                # CommandBackend.run would go through stream, which takes the lock again
+                return ''.join(netfilter.backend.CommandBackend.stream(self, cmd))
+            return netfilter.backend.CommandBackend.run(self, cmd, input)
+
+    def stream(self, cmd):
+        """
+        Yields the iptables-save output of a table, taken while holding the lock
+
+        :param cmd
+        :return lines
+        """
+        with self.__lock:
+            self.__wait()
+            lines = list(netfilter.backend.CommandBackend.stream(self, cmd))
+        return iter(lines)
+
+    def add_counters(self, chain, position, packets, nbytes, table='filter', family='ipv4'):
+        """
+        Accounts traffic to the rule at a position (starting at 1), or to the chain
+        policy when position is None
+
+        :param chain
+        :param position
+        :param packets
+        :param nbytes
+        :param table
+        :param family
+        :return
+        """
+        with self.__lock:
+            entry = self.__chain(None, family, table, chain)
+            if position is None:
+                entry['packets'] += packets
+                entry['bytes'] += nbytes
+            else:
+                rule = entry['rules'][position - 1]
+                rule.packets += packets
+                rule.bytes += nbytes
+
+    def ipset(self, cmd, input=None):
+        """
+        Handles an ipset command line, or an ipset restore payload line by line
+
+        :param cmd
+        :param input
+        :return out
+        """
+        args = [arg for arg in cmd[1:] if arg not in ('-exist', '-!')]
+        exist = len(args) != len(cmd) - 1
+        if not args:
+            raise netfilter.errors.IptablesError(cmd, "ipset v7.15: No command specified.")
+        if args[0] in ('version', '--version', '-v'):
+            return "ipset v7.15, protocol version: 7\n"
+        if args[0] in ('save', 'list'):
+            return ''.join(self.__save_sets(cmd, args[1:2]))
+        if args[0] != 'restore':
+            try:
+                self.__set_command(cmd, args, exist)
+            except netfilter.errors.IptablesError as e:
+                raise netfilter.errors.IptablesError(cmd, "ipset v7.15: %s" % e.message)
+            return ''
+        for lineno, line in enumerate((input or '').splitlines(), 1):
+            bits = line.split()
+            if not bits or bits[0].startswith('#') or bits[0] == 'COMMIT':
+                continue
+            try:
+                self.__set_command(cmd, bits, exist)
+            except netfilter.errors.IptablesError as e:
+                raise netfilter.errors.IptablesError(cmd, "ipset v7.15: Error in line %d: %s" % (lineno, e.message))
+        return ''
+
+    def dump(self, family, table):
+        """
+        Yields the iptables-save -c output of a table
+
+        :param family
+        :param table
+        :return lines
+        """
+        chains = self.__table(None, family, table)
+        yield '# Generated by netfilter simulator\n'
+        yield '*%s\n' % table
+        for name in chains.keys():
+            chain = chains[name]
+            yield ':%s %s [%d:%d]\n' % (name, chain['policy'] or '-', chain['packets'], chain['bytes'])
+        for name in chains.keys():
+            for rule in chains[name]['rules']:
+                yield '[%d:%d] -A %s %s\n' % (rule.packets, rule.bytes, name, rule.specline())
+        yield 'COMMIT\n'
+        yield '# Completed\n'
+
+    def begin(self, cmd, family, table):
+        """
+        Starts a restore transaction on a table
+
+        :param cmd
+        :param family
+        :param table
+        :return
+        """
+        self.__saved[(family, table)] = self.__copy(self.__table(cmd, family, table))
+
+    def commit(self, cmd, family, table):
+        """
+        Commits a restore transaction on a table
+
+        :param cmd
+        :param family
+        :param table
+        :return
+        """
+        self.__saved.pop((family, table), None)
+
+    def abort(self, cmd, family, table):
+        """
+        Abandons a restore transaction on a table
+
+        :param cmd
+        :param family
+        :param table
+        :return
+        """
+        saved = self.__saved.pop((family, table), None)
+        if saved is not None:
+            self.__tables[(family, table)] = saved
+
+    def create_chain(self, cmd, family, table, chain):
+        """
+        Creates a chain
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :return
+        """
+        chains = self.__table(cmd, family, table)
+        if chain in chains:
+            raise netfilter.errors.IptablesError(cmd, "iptables: Chain already exists.")
+        chains[chain] = self.__new_chain(None)
+
+    def delete_chain(self, cmd, family, table, chain):
+        """
+        Deletes a chain, or every user chain when chain is None
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :return
+        """
+        chains = self.__table(cmd, family, table)
+        if chain is None:
+            names = [name for name in chains.keys() if chains[name]['policy'] is None]
+        else:
+            self.__chain(cmd, family, table, chain)
+            if chains[chain]['policy'] is not None:
+                raise netfilter.errors.IptablesError(cmd, "iptables: Invalid argument.")
+            names = [chain]
+        for name in names:
+            if chains[name]['rules']:
+                raise netfilter.errors.IptablesError(cmd, "iptables: Directory not empty.")
+            for other in chains.keys():
+                if other not in names and self.__references(chains[other], name):
+                    raise netfilter.errors.IptablesError(cmd, "iptables: Too many links.")
+        for name in names:
+            del chains[name]
+
+    def flush_chain(self, cmd, family, table, chain):
+        """
+        Flushes a chain, or every chain when chain is None
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :return
+        """
+        if chain is None:
+            chains = self.__table(cmd, family, table)
+            for name in chains.keys():
+                del chains[name]['rules'][:]
+        else:
+            del self.__chain(cmd, family, table, chain)['rules'][:]
+
+    def rename_chain(self, cmd, family, table, chain, new_chain):
+        """
+        Renames a chain
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :param new_chain
+        :return
+        """
+        chains = self.__table(cmd, family, table)
+        entry = self.__chain(cmd, family, table, chain)
+        if entry['policy'] is not None:
+            raise netfilter.errors.IptablesError(cmd, "iptables: Invalid argument.")
+        if new_chain in chains:
+            raise netfilter.errors.IptablesError(cmd, "iptables: File exists.")
+        renamed = netfilter.parser.ODict()
+        for name in chains.keys():
+            if name == chain:
+                renamed[new_chain] = entry
+            else:
+                renamed[name] = chains[name]
+        for name in renamed.keys():
+            for rule in renamed[name]['rules']:
+                for attr in ('jump', 'goto'):
+                    target = getattr(rule, attr)
+                    if target is not None and target.name() == chain:
+                        setattr(rule, attr, new_chain)
+        self.__tables[(family, table)] = renamed
+
+    def set_policy(self, cmd, family, table, chain, policy):
+        """
+        Sets the policy of a built-in chain
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :param policy
+        :return
+        """
+        entry = self.__chain(cmd, family, table, chain)
+        if entry['policy'] is None:
+            raise netfilter.errors.IptablesError(cmd, "iptables: Bad built-in chain name.")
+        if policy not in ('ACCEPT', 'DROP'):
+            raise netfilter.errors.IptablesError(cmd, "iptables: Bad policy name.")
+        entry['policy'] = policy
+
+    def insert_rule(self, cmd, family, table, chain, position, rule):
+        """
+        Inserts a rule at a position (starting at 1), or appends it when position is None
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :param position
+        :param rule
+        :return
+        """
+        rules = self.__chain(cmd, family, table, chain)['rules']
+        self.__check_target(cmd, family, table, rule)
+        self.__check_sets(cmd, rule)
+        if position is None:
+            rules.append(rule)
+        elif position < 1 or position > len(rules) + 1:
+            raise netfilter.errors.IptablesError(cmd, "iptables: Index of insertion too big.")
+        else:
+            rules.insert(position - 1, rule)
+
+    def replace_rule(self, cmd, family, table, chain, position, rule):
+        """
+        Replaces the rule at a position (starting at 1)
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :param position
+        :param rule
+        :return
+        """
+        rules = self.__chain(cmd, family, table, chain)['rules']
+        self.__check_target(cmd, family, table, rule)
+        self.__check_sets(cmd, rule)
+        if position < 1 or position > len(rules):
+            raise netfilter.errors.IptablesError(cmd, "iptables: Index of replacement too big.")
+        rules[position - 1] = rule
+
+    def delete_rule(self, cmd, family, table, chain, rule):
+        """
+        Deletes a rule, given either as a Rule or as a position (starting at 1)
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :param rule
+        :return
+        """
+        rules = self.__chain(cmd, family, table, chain)['rules']
+        if isinstance(rule, int):
+            if rule < 1 or rule > len(rules):
+                raise netfilter.errors.IptablesError(cmd, "iptables: Index of deletion too big.")
+            del rules[rule - 1]
+            return
+        key = rule.key()
+        for pos, entry in enumerate(rules):
+            if entry.key() == key:
+                del rules[pos]
+                return
+        raise netfilter.errors.IptablesError(
+            cmd, "iptables: Bad rule (does a matching rule exist in that chain?).")
+
+    def check_rule(self, cmd, family, table, chain, rule):
+        """
+        Fails unless a chain holds the rule
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :param rule
+        :return
+        """
+        key = rule.key()
+        for entry in self.__chain(cmd, family, table, chain)['rules']:
+            if entry.key() == key:
+                return
+        raise netfilter.errors.IptablesError(
+            cmd, "iptables: Bad rule (does a matching rule exist in that chain?).")
+
+    def __wait(self):
+        """
+        Counts a call and sleeps for the configured latency
+
+        :return
+        """
+        self.calls += 1
+        if self.latency:
+            start = time.time()
+            time.sleep(self.latency)
+            self.intervals.append((start, time.time()))
+
+    def __table(self, cmd, family, table):
+        """
+        Returns the chains of a table, creating the built-in ones on first use
+
+        :param cmd
+        :param family
+        :param table
+        :return chains
+        """
+        chains = self.__tables.get((family, table))
+        if chains is None:
+            if table not in builtin_chains:
+                raise netfilter.errors.IptablesError(
+                    cmd, "iptables v1.8.7: can't initialize iptables table `%s': "
+                         "Table does not exist (do you need to insmod?)" % table)
+            chains = netfilter.parser.ODict()
+            for name in builtin_chains[table]:
+                chains[name] = self.__new_chain('ACCEPT')
+            self.__tables[(family, table)] = chains
+        return chains
+
+    def __chain(self, cmd, family, table, chain):
+        """
+        Returns a chain of a table
+
+        :param cmd
+        :param family
+        :param table
+        :param chain
+        :return chain
+        """
+        entry = self.__table(cmd, family, table).get(chain)
+        if entry is None:
+            raise netfilter.errors.IptablesError(cmd, "iptables: No chain/target/match by that name.")
+        return entry
+
+    def __new_chain(self, policy):
+        """
+        Returns an empty chain
+
+        :param policy
+        :return chain
+        """
+        return {'policy': policy, 'packets': 0, 'bytes': 0, 'rules': []}
+
+    def __copy(self, chains):
+        """
+        Returns a copy of the chains of a table
+
+        :param chains
+        :return copy
+        """
+        copy = netfilter.parser.ODict()
+        for name in chains.keys():
+            entry = dict(chains[name])
+            entry['rules'] = list(entry['rules'])
+            copy[name] = entry
+        return copy
+
+    def __references(self, chain, name):
+        """
+        Checks whether a chain jumps to another one
+
+        :param chain
+        :param name
+        :return referenced
+        """
+        for rule in chain['rules']:
+            for target in (rule.jump, rule.goto):
+                if target is not None and target.name() == name:
+                    return True
+        return False
+
+    def __set_command(self, cmd, bits, exist):
+        """
+        Runs a single ipset command
+
+        :param cmd
+        :param bits
+        :param exist
+        :return
+        """
+        op = bits[0]
+        name = bits[1] if len(bits) > 1 else None
+        if op in ('create', 'n', '-N'):
+            if len(bits) < 3:
+                raise netfilter.errors.IptablesError(cmd, "Missing set type.")
+            existing = self.__sets.get(name)
+            if existing is not None:
+                if not exist or existing['type'] != bits[2]:
+                    raise netfilter.errors.IptablesError(
+                        cmd, "Set cannot be created: set with the same name already exists")
+                return
+            self.__sets[name] = {'type': bits[2], 'options': bits[3:], 'members': {}}
+        elif op in ('add', 'del', 'test', '-A', '-D', '-T'):
+            entries = self.__set(cmd, name)
+            if len(bits) < 3:
+                raise netfilter.errors.IptablesError(cmd, "Missing element.")
+            entry = netfilter.ipset.canonical_entry(entries['type'], bits[2])
+            members = entries['members']
+            if op in ('add', '-A'):
+                if entry in members and not exist:
+                    raise netfilter.errors.IptablesError(
+                        cmd, "Element cannot be added to the set: it's already added")
+                members[entry] = True
+            elif op in ('del', '-D'):
+                if entry not in members:
+                    if exist:
+                        return
+                    raise netfilter.errors.IptablesError(
+                        cmd, "Element cannot be deleted from the set: it's not added")
+                del members[entry]
+            elif entry not in members:
+                raise netfilter.errors.IptablesError(cmd, "%s is NOT in set %s." % (bits[2], name))
+        elif op in ('flush', '-F'):
+            for entries in ([self.__set(cmd, name)] if name else self.__sets.values()):
+                entries['members'].clear()
+        elif op in ('destroy', 'x', '-X'):
+            names = [name] if name else list(self.__sets.keys())
+            for name in names:
+                self.__set(cmd, name)
+                if self.__set_in_use(name):
+                    raise netfilter.errors.IptablesError(
+                        cmd, "Set cannot be destroyed: it is in use by a kernel component")
+            for name in names:
+                del self.__sets[name]
+        elif op in ('swap', 'w', '-W') and len(bits) == 3:
+            first = self.__set(cmd, name)
+            second = self.__set(cmd, bits[2])
+            if first['type'] != second['type']:
+                raise netfilter.errors.IptablesError(
+                    cmd, "The sets cannot be swapped: their type does not match")
+            self.__sets[name], self.__sets[bits[2]] = second, first
+        else:
+            raise netfilter.errors.IptablesError(cmd, "Unknown command %s" % op)
+
+    def __set(self, cmd, name):
+        """
+        Returns a set
+
+        :param cmd
+        :param name
+        :return set
+        """
+        entries = self.__sets.get(name)
+        if entries is None:
+            raise netfilter.errors.IptablesError(
+                cmd, "The set with the given name does not exist")
+        return entries
+
+    def __save_sets(self, cmd, names):
+        """
+        Yields the ipset save output of the named set, or of every set
+
+        :param cmd
+        :param names
+        :return lines
+        """
+        for name in names or list(self.__sets.keys()):
+            entries = self.__set(cmd, name)
+            yield ' '.join(['create', name, entries['type']] + entries['options']) + '\n'
+            for entry in entries['members']:
+                yield 'add %s %s\n' % (name, entry)
+
+    def __set_in_use(self, name):
+        """
+        Checks whether any rule matches against a set
+
+        :param name
+        :return used
+        """
+        for chains in self.__tables.values():
+            for chain in chains.keys():
+                for rule in chains[chain]['rules']:
+                    if name in self.__rule_sets(rule):
+                        return True
+        return False
+
+    def __rule_sets(self, rule):
+        """
+        Returns the names of the sets a rule matches against
+
+        :param rule
+        :return names
+        """
+        names = []
+        for match in rule.matches:
+            if match.name() == 'set':
+                for option, values in match.options().items():
+                    if option.endswith('match-set') and values:
+                        names.append(values[0])
+        return names
+
+    def __check_target(self, cmd, family, table, rule):
+        """
+        Checks that the target of a rule is a chain, a standard target or an extension
+
+        :param cmd
+        :param family
+        :param table
+        :param rule
+        :return
+        """
+        target = rule.goto or rule.jump
+        if target is None:
+            return
+        name = target.name()
+        if name in self.__table(cmd, family, table) or name in standard_targets:
+            return
+        if rule.goto is None and name.upper() == name:
+            # upper case names are treated as target extensions
+            return
+        raise netfilter.errors.IptablesError(
+            cmd, "iptables v1.8.7: Couldn't load target `%s':No such file or directory" % name)
+
+    def __check_sets(self, cmd, rule):
+        """
+        Checks that the sets a rule matches against exist
+
+        :param cmd
+        :param rule
+        :return
+        """
+        for name in self.__rule_sets(rule):
+            if name not in self.__sets:
+                raise netfilter.errors.IptablesError(cmd, "iptables v1.8.7: Set %s doesn't exist." % name)
@@ -1,8 +1,9 @@
-import os
 import re
-import subprocess
+import time
 
+import netfilter.backend
 import netfilter.parser
+from netfilter.errors import IptablesError
 
 """
             table.py                                                Author: Zach Bricker
@@ -11,49 +12,107 @@ import netfilter.parser
 
 """
 
-class IptablesError(Exception):
-    def __init__(self, command, message):
-        """
-        Constructor
-
-        :param command
-        :param message
-        :return
-        """
-        self.command = command
-        self.message = message
-
-    def __str__(self):
-        """
-        Rewrites the built-in string method
-
-        :return "command: %s\nmessage: %s" % (self.command, self.message)
-        """
-        return "command: %s\nmessage: %s" % (self.command, self.message)
+def format_restore(name, commands, existing=None):
+    """
+    Turns buffered iptables commands for a table into a single iptables-restore payload.
+    Chains are created with ':chain - [0:0]' declarations rather than -N, which would
+    abort the whole transaction when the chain exists. A declaration flushes a chain
+    that already exists, so chains in existing, the user chains of the live table,
+    are not declared again and keep their rules, as with iptables -N.
+
+    :param name
+    :param commands
+    :param existing
+    :return payload
+    """
+    if existing is not None:
+        existing = set(existing)
+    lines = ['*%s' % name]
+    for cmd in commands:
+        # strip the binary, --wait and -t <table> prefix from the command
+        pos = cmd.index('-t') + 2
+        if cmd[pos - 1] != name:
+            raise IptablesError(cmd, "command does not belong to table %s" % name)
+        args = cmd[pos:]
+        if args[0] == '-N' and len(args) == 2:
+            if existing is None or args[1] not in existing:
+                lines.append(':%s - [0:0]' % args[1])
+                if existing is not None:
+                    existing.add(args[1])
+            continue
+        if existing is not None:
+            # follow the chains deleted and renamed earlier in the same transaction
+            if args[0] == '-X':
+                if len(args) > 1:
+                    existing.discard(args[1])
+                else:
+                    existing.clear()
+            elif args[0] == '-E':
+                existing.discard(args[1])
+                existing.add(args[2])
+        lines.append(netfilter.parser.join_words(args))
+    lines.append('COMMIT')
+    return '\n'.join(lines) + '\n'
+
+
+def creates_chains(commands):
+    """
+    Checks whether buffered commands create a chain, i.e. whether a restore payload
+    for them needs the chains of the live table
+
+    :param commands
+    :return creates
+    """
+    return any(cmd[cmd.index('-t') + 2] == '-N' for cmd in commands)
 
 
 class Table:
-
-    __iptables_wait_option = None
-
-    def __init__(self, name, auto_commit=True, ipv6=False):
+    def __init__(self, name, auto_commit=True, ipv6=False, atomic_commit=False,
+                 cache=False, cache_ttl=None, backend=None, session=None):
         """
-        Constructor
+        Constructor. With a RestoreSession, commands are applied through its
+        iptables-restore process instead of forking iptables for each one;
+        creating a chain still runs iptables -N, which tolerates an existing chain.
 
         :param name
         :param auto_commit
         :param ipv6
+        :param atomic_commit
+        :param cache
+        :param cache_ttl
+        :param backend
+        :param session
         :return
         """
+        if backend is None:
+            backend = netfilter.backend.SubprocessBackend()
+        self.__backend = backend
+        self.__session = session
         self.auto_commit = auto_commit
+        self.atomic_commit = atomic_commit
+        self.cache = cache
+        self.cache_ttl = cache_ttl
         self.__name = name
         self.__buffer = []
+        self.__snapshot = None
+        self.__snapshot_time = None
+        self.__shared = False
         if ipv6:
             self.__iptables = 'ip6tables'
             self.__iptables_save = 'ip6tables-save'
+            self.__iptables_restore = 'ip6tables-restore'
         else:
             self.__iptables = 'iptables'
             self.__iptables_save = 'iptables-save'
+            self.__iptables_restore = 'iptables-restore'
+
+    def name(self):
+        """
+        Returns the table name
+
+        :return self.__name
+        """
+        return self.__name
 
     def create_chain(self, chainname):
         """
@@ -91,9 +150,9 @@ class Table:
         Lists all chains
 
         :param
-        :return self.__get_chains().keys()
+        :return self.__get_ruleset().keys()
         """
-        return self.__get_chains().keys()
+        return self.__get_ruleset().keys()
 
     def rename_chain(self, old_chain_name, new_chain_name):
         """
@@ -110,9 +169,9 @@ class Table:
         Returns a policy
 
         :param chainname
-        :return self.__get_chains()[chainname]['policy']
+        :return self.__get_ruleset()[chainname]['policy']
         """
-        return self.__get_chains()[chainname]['policy']
+        return self.__get_ruleset()[chainname]['policy']
 
     def set_policy(self, chainname, policy):
         """
@@ -154,25 +213,132 @@ class Table:
         """
         self.__run_iptables(['-I', chainname, '1'] + rule.specbits())
 
+    def insert_rule(self, chainname, position, rule):
+        """
+        Inserts a rule at a position (starting at 1) in a chain
+
+        :param chainname
+        :param position
+        :param rule
+        :return
+        """
+        self.__run_iptables(['-I', chainname, str(position)] + rule.specbits())
+
+    def replace_rule(self, chainname, position, rule):
+        """
+        Replaces the rule at a position (starting at 1) in a chain
+
+        :param chainname
+        :param position
+        :param rule
+        :return
+        """
+        self.__run_iptables(['-R', chainname, str(position)] + rule.specbits())
+
+    def delete_rule_at(self, chainname, position):
+        """
+        Deletes the rule at a position (starting at 1) in a chain
+
+        :param chainname
+        :param position
+        :return
+        """
+        self.__run_iptables(['-D', chainname, str(position)])
+
+    def check_rule(self, chainname, rule):
+        """
+        Checks whether a chain holds a rule with iptables -C, without dumping the
+        table. Runs straight away, even when commands are buffered.
+
+        :param chainname
+        :param rule
+        :return found
+        """
+        cmd = [self.__iptables] + self.__backend.wait_option(self.__iptables) + \
+            ['-t', self.__name, '-C', chainname] + rule.specbits()
+        try:
+            self.__backend.run(cmd)
+        except IptablesError:
+            return False
+        return True
+
     def list_rules(self, chainname):
         """
         List all rules under a chain
 
         :param chainname
-        :return netfilter.parser.parse_rules(data, chainname)
+        :return rules
+        """
+        chain = self.__get_ruleset().get(chainname)
+        if chain is None:
+            return []
+        # a copy, so callers cannot change the cached snapshot
+        return list(chain['rules'])
+
+    def iter_save(self):
+        """
+        Streams the table dump, yielding parser events while iptables-save is still writing
+
+        :param
+        :return netfilter.parser.iter_save(lines)
+        """
+        return netfilter.parser.iter_save(
+            self.__stream(self.get_save_command()))
+
+    def iter_counters(self):
+        """
+        Streams (chainname, packets, bytes, spec) for every rule without building Rule objects
+
+        :param
+        :return netfilter.parser.iter_counters(lines)
         """
-        data = self.__run([self.__iptables_save, '-t', self.__name, '-c'])
-        return netfilter.parser.parse_rules(data, chainname)
+        return netfilter.parser.iter_counters(self.__stream(self.get_save_command()))
+
+    def iter_rules(self, chainname=None):
+        """
+        Streams the rules of a chain, or (chainname, rule) pairs for every chain
+
+        :param chainname
+        :return rules
+        """
+        for event in self.iter_save():
+            if event[0] != 'rule':
+                continue
+            if chainname is None:
+                yield event[1], event[2]
+            elif event[1] == chainname:
+                yield event[2]
+
+    def get_ruleset(self):
+        """
+        Returns the policy, counters and rules of every chain from a single dump
+
+        :param
+        :return self.__get_ruleset()
+        """
+        return self.__get_ruleset()
 
     def commit(self):
         """
-        Commits all changes
+        Commits all changes, either one command at a time or as a single
+        iptables-restore transaction when atomic_commit is set
 
         :param
         :return
         """
+        self.invalidate_cache()
+        if self.atomic_commit:
+            if self.__buffer:
+                if self.__session is not None:
+                    self.__session.transaction(self.get_restore_payload())
+                else:
+                    self.__run(self.get_restore_command(),
+                               self.get_restore_payload())
+                # the buffer is only dropped once the whole transaction applied
+                del self.__buffer[:]
+            return
         while len(self.__buffer) > 0:
-            self.__run(self.__buffer.pop(0))
+            self.__apply(self.__buffer.pop(0))
 
     def get_buffer(self):
         """
@@ -183,15 +349,85 @@ class Table:
         """
         return self.__buffer
 
-    def __get_chains(self):
+    def invalidate_cache(self):
         """
-        Returns a chain
+        Drops the cached snapshot so the next read dumps the table again
 
         :param
-        :return netfilter.parser.parse_chains(data)
+        :return
+        """
+        self.__snapshot = None
+        self.__snapshot_time = None
+        self.__shared = False
+
+    def set_snapshot(self, chains):
         """
-        data = self.__run([self.__iptables_save, '-t', self.__name, '-c'])
-        return netfilter.parser.parse_chains(data)
+        Serves reads from chains, e.g. this table's part of a dump of every table:
+        the next read only, unless the table caches, in which case every read until
+        the table changes, the cache expires or it is invalidated
+
+        :param chains
+        :return
+        """
+        self.__snapshot = chains
+        self.__snapshot_time = time.time()
+        self.__shared = True
+
+    def get_save_command(self):
+        """
+        Returns the command dumping the table with its counters
+
+        :param
+        :return [self.__iptables_save, '-t', self.__name, '-c']
+        """
+        return [self.__iptables_save, '-t', self.__name, '-c']
+
+    def get_restore_command(self):
+        """
+        Returns the command applying a restore payload on top of the current rules
+
+        :param
+        :return [self.__iptables_restore, '--noflush'] + wait option
+        """
+        return [self.__iptables_restore, '--noflush'] + \
+            self.__backend.restore_wait_option(self.__iptables)
+
+    def get_restore_payload(self, chains=None):
+        """
+        Returns the buffer as an iptables-restore payload. When the buffer creates
+        chains, the live chains are taken from chains, or dumped, so existing
+        chains are left as they are.
+
+        :param chains
+        :return format_restore(self.__name, self.__buffer, existing)
+        """
+        existing = None
+        if creates_chains(self.__buffer):
+            if chains is None:
+                chains = self.__get_ruleset()
+            existing = [chainname for chainname in chains.keys() if chains[chainname]['policy'] is None]
+        return format_restore(self.__name, self.__buffer, existing)
+
+    def __get_ruleset(self):
+        """
+        Returns every chain of the table
+
+        :param
+        :return snapshot
+        """
+        if (self.cache or self.__shared) and self.__snapshot is not None:
+            if self.cache_ttl is None or \
+                    time.time() - self.__snapshot_time < self.cache_ttl:
+                snapshot = self.__snapshot
+                if not self.cache:
+                    # a table that does not cache only takes a shared dump for one read
+                    self.invalidate_cache()
+                return snapshot
+        snapshot = self.__backend.load_table(self.get_save_command())
+        if self.cache:
+            self.__snapshot = snapshot
+            self.__snapshot_time = time.time()
+        return snapshot
 
     def __run_iptables(self, args):
         """
@@ -200,35 +436,45 @@ class Table:
         :param args
         :return
         """
-        if Table.__iptables_wait_option is None:
-            # check whether iptables supports --wait
-            try:
-                self.__run([self.__iptables, '-L', '-n', '--wait'])
-                Table.__iptables_wait_option = ['--wait']
-            except:
-                Table.__iptables_wait_option = []
-
-        cmd = [self.__iptables] + Table.__iptables_wait_option + ['-t', self.__name] + args
+        self.invalidate_cache()
+        cmd = [self.__iptables] + self.__backend.wait_option(self.__iptables) + ['-t', self.__name] + args
         if self.auto_commit:
-            self.__run(cmd)
+            self.__apply(cmd)
         else:
             self.__buffer.append(cmd)
 
-    def __run(self, cmd):
+    def __apply(self, cmd):
+        """
+        Applies a single command, through the restore session when there is one
+
+        :param cmd
+        :return
+        """
+        if self.__session is not None and cmd[cmd.index('-t') + 2] != '-N':
+            self.__session.transaction(format_restore(self.__name, [cmd]))
+        else:
+            self.__run(cmd)
+
+    def __run(self, cmd, input=None):
         """
-        Runs the commands for IPTables
+        Runs the commands for IPTables through the backend
 
         :param cmd
+        :param input
         :return out
         """
-        p = subprocess.Popen(cmd,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             close_fds=True)
-        out, err = p.communicate()
-        status = p.wait()
-        # check exit status
-        if not os.WIFEXITED(status) or os.WEXITSTATUS(status):
-            if not re.match(r'(iptables|ip6tables): Chain already exists', err):
-                raise IptablesError(cmd, err)
-        return out
+        try:
+            return self.__backend.run(cmd, input)
+        except IptablesError as e:
+            if not re.match(r'(iptables|ip6tables): Chain already exists', e.message):
+                raise
+        return ''
+
+    def __stream(self, cmd):
+        """
+        Runs a command through the backend and yields its output line by line
+
+        :param cmd
+        :return lines
+        """
+        return self.__backend.stream(cmd)
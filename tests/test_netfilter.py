@@ -1,9 +1,33 @@
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
 import unittest
 import logging
-
+import time
+
+import netfilter.aio
+import netfilter.backend
+import netfilter.capabilities
+import netfilter.analyzer
+import netfilter.batch
+import netfilter.chaintree
+import netfilter.classifier
+import netfilter.errors
+import netfilter.firewall
+import netfilter.history
+import netfilter.ipset
+import netfilter.monitor
+import netfilter.optimizer
+import netfilter.simulator
+import netfilter.iptcbackend
 import netfilter.table
+import netfilter.rule
 from netfilter.rule import Rule, Target, Match
 import netfilter.parser
+import netfilter.reconcile
+import netfilter.session
 
 iptables_data = """# Generated by iptables-save v1.4.8
 *filter
@@ -48,6 +72,15 @@ class ParserTestCase(unittest.TestCase):
                          ['a', 'some text', 'b'])
         print('...Done')
 
+    def testJoinWords(self):
+        print('Running Test Join Words...')
+        bits = ['-j', 'LOG', '--log-prefix', 'ICMP accepted : ']
+        line = netfilter.parser.join_words(bits)
+        print('\tLine: ' + line)
+        self.assertEqual(line, '-j LOG --log-prefix "ICMP accepted : "')
+        self.assertEqual(netfilter.parser.split_words(line), bits)
+        print('...Done')
+
     def testParseChains(self):
         print('Test Parse Chains...')
         chains = netfilter.parser.parse_chains(iptables_data)
@@ -88,6 +121,34 @@ class ParserTestCase(unittest.TestCase):
         self.assertEquals(rules, [])
         print('...Done')
 
+    def testIterSave(self):
+        print('Running Test Iter Save...')
+        events = list(netfilter.parser.iter_save(iter(iptables_data.splitlines(True))))
+        self.assertEqual(events[0], ('table', 'filter'))
+        self.assertEqual(events[1], ('chain', 'INPUT', 'DROP', 556, 75796))
+        self.assertEqual(events[4], ('chain', 'firewall_forward_filter', None, 0, 0))
+        self.assertEqual(events[6][:2], ('rule', 'INPUT'))
+        self.assertEqual(events[6][2].jump.name(), 'firewall_input_filter')
+        self.assertEqual(len(events), 20)
+        print('...Done')
+
+    def testParseSave(self):
+        print('Running Test Parse Save...')
+        chains = netfilter.parser.parse_save(iptables_data)
+        print('\tChains: ' + str(chains))
+        self.assertEqual(chains.keys(),
+                         ['INPUT', 'FORWARD', 'OUTPUT', 'firewall_forward_filter', 'firewall_input_filter'])
+        self.assertEqual(chains['INPUT']['policy'], 'DROP')
+        self.assertEqual(chains['INPUT']['packets'], 556)
+        self.assertEqual(chains['firewall_input_filter']['policy'], None)
+        for name in chains.keys():
+            self.assertEqual(chains[name]['rules'], netfilter.parser.parse_rules(iptables_data, name))
+        rules = chains['firewall_input_filter']['rules']
+        self.assertEqual(len(rules), 11)
+        self.assertEqual(rules[0].packets, 112148)
+        self.assertEqual(rules[0].bytes, 127429710)
+        print('...Done')
+
 
 class TargetTestCase(unittest.TestCase):
     def testInit(self):
@@ -289,6 +350,37 @@ class RuleTestCase(unittest.TestCase):
         self.assertEqual(rule.specbits(), ['!', '-i', 'eth0', '!', '-o', 'eth2', '-j', 'REJECT'])
         print('...Done')
 
+    def testCompact(self):
+        print('Running Test Compact...')
+        rules = netfilter.parser.parse_rules(iptables_data, 'firewall_input_filter')
+        print('\tRules: ' + str(rules))
+        self.assertFalse(hasattr(rules[0], '__dict__'))
+        self.assertFalse(hasattr(rules[0].jump, '__dict__'))
+        self.assertTrue(rules[0].jump is rules[1].jump)
+        self.assertTrue(rules[5].matches[0] is rules[8].matches[0])
+        self.assertTrue(rules[5].in_interface is rules[6].in_interface)
+        self.assertRaises(AttributeError, setattr, rules[0], 'unknown', 1)
+        print('...Done')
+
+    def testSpecbitsCache(self):
+        print('Running Test Specbits Cache...')
+        rule = Rule(protocol='tcp', jump=Target('LOG', '--log-prefix "a b"'))
+        self.assertEqual(rule.specline(), '-p tcp -j LOG --log-prefix "a b"')
+        rule.specbits().append('-x')
+        self.assertEqual(rule.specbits(), ['-p', 'tcp', '-j', 'LOG', '--log-prefix', 'a b'])
+        rule.protocol = 'udp'
+        self.assertEqual(rule.specbits(), ['-p', 'udp', '-j', 'LOG', '--log-prefix', 'a b'])
+        key = rule.key()
+        rule.matches.append(Match('udp', '--dport 53'))
+        self.assertNotEqual(rule.key(), key)
+        self.assertEqual(rule.specline(), '-p udp -m udp --dport 53 -j LOG --log-prefix "a b"')
+        rule.matches[0] = Match('udp', '--dport 54')
+        self.assertEqual(rule.specbits(), ['-p', 'udp', '-m', 'udp', '--dport', '54', '-j', 'LOG', '--log-prefix', 'a b'])
+        rule.matches = []
+        rule.jump = 'ACCEPT'
+        self.assertEqual(rule.specline(), '-p udp -j ACCEPT')
+        print('...Done')
+
     def testTargetLog(self):
         print('Running Test Target Log...')
         rule = Rule(jump=Target('LOG', '--log-prefix "ICMP accepted : " --log-level 4'))
@@ -362,6 +454,35 @@ class RuleTestCase(unittest.TestCase):
         print('...Done')
 
 
+class RuleIndexTestCase(unittest.TestCase):
+    def testKey(self):
+        print('Rule Index Test Case Set:\nRunning Test Key...')
+        rule1 = Rule(protocol='tcp', matches=[Match('tcp', '--dport 80 --sport 1024')], jump='ACCEPT')
+        rule2 = Rule(protocol='tcp', matches=[Match('tcp', '--sport 1024 --dport 80')], jump='ACCEPT')
+        rule3 = Rule(protocol='udp', matches=[Match('tcp', '--sport 1024 --dport 80')], jump='ACCEPT')
+        self.assertEqual(rule1.key(), rule2.key())
+        self.assertEqual(hash(rule1), hash(rule2))
+        self.assertNotEqual(rule1.key(), rule3.key())
+        self.assertEqual(len(set([rule1, rule2, rule3])), 2)
+        print('...Done')
+
+    def testIndex(self):
+        print('Running Test Index...')
+        rules = netfilter.parser.parse_rules(iptables_data, 'firewall_input_filter')
+        index = netfilter.rule.RuleIndex(rules)
+        self.assertEqual(len(index), len(rules))
+        for pos, rule in enumerate(rules):
+            wanted = netfilter.parser.parse_rule(' '.join(rule.specbits()))
+            self.assertTrue(wanted in index)
+            self.assertEqual(index.index(wanted), pos)
+            self.assertTrue(wanted.find(index) is rule)
+        missing = Rule(in_interface='eth1', jump='ACCEPT')
+        self.assertFalse(missing in index)
+        self.assertEqual(missing.find(index), None)
+        self.assertRaises(ValueError, index.index, missing)
+        print('...Done')
+
+
 class ParseRuleTestCase(unittest.TestCase):
     def testEmpty(self):
         print('Parse Rule Test Case Set:\nRuning Test Empty...')
@@ -477,6 +598,1349 @@ class BufferedTestCase(unittest.TestCase):
         self.assertEqual(buffer, [['iptables', '-t', 'test_table', '-A', 'test_chain', '-j', 'ACCEPT']])
         print('...Done')
 
+    def testRestorePayload(self):
+        print('Running Test Restore Payload...')
+        table = netfilter.table.Table('test_table', False, atomic_commit=True)
+        table.create_chain('test_chain')
+        table.append_rule('test_chain', Rule(jump=Target('LOG', '--log-prefix "a b"')))
+        table.set_policy('INPUT', 'DROP')
+        payload = table.get_restore_payload(netfilter.parser.ODict())
+        print('\tPayload: ' + payload)
+        self.assertEqual(payload, '*test_table\n'
+                                  ':test_chain - [0:0]\n'
+                                  '-A test_chain -j LOG --log-prefix "a b"\n'
+                                  '-P INPUT DROP\n'
+                                  'COMMIT\n')
+        print('...Done')
+
+    def testAtomicCommit(self):
+        print('Running Test Atomic Commit...')
+        backend = netfilter.simulator.SimulatorBackend()
+        netfilter.table.Table('filter', backend=backend).create_chain('services')
+        table = netfilter.table.Table('filter', False, atomic_commit=True, backend=backend)
+        table.create_chain('services')
+        table.create_chain('web')
+        table.append_rule('services', Rule(protocol='tcp', jump='web'))
+        table.append_rule('web', Rule(jump='ACCEPT'))
+        table.commit()
+        self.assertEqual(table.get_buffer(), [])
+        self.assertEqual(table.list_rules('services'), [Rule(protocol='tcp', jump='web')])
+        self.assertEqual(table.list_rules('web'), [Rule(jump='ACCEPT')])
+        table.append_rule('web', Rule(jump='nonexistent'))
+        self.assertRaises(netfilter.table.IptablesError, table.commit)
+        self.assertEqual(len(table.get_buffer()), 1)
+        self.assertEqual(table.list_rules('web'), [Rule(jump='ACCEPT')])
+        print('...Done')
+
+    def testAtomicExistingChain(self):
+        print('Running Test Atomic Existing Chain...')
+        results = []
+        for atomic_commit in (False, True):
+            backend = netfilter.simulator.SimulatorBackend()
+            live = netfilter.table.Table('filter', backend=backend)
+            live.create_chain('services')
+            live.append_rule('services', Rule(protocol='tcp', jump='ACCEPT'))
+            live.create_chain('old')
+            table = netfilter.table.Table('filter', False, atomic_commit=atomic_commit, backend=backend)
+            table.create_chain('services')
+            table.append_rule('services', Rule(protocol='udp', jump='ACCEPT'))
+            table.delete_chain('old')
+            table.create_chain('old')
+            table.create_chain('web')
+            table.commit()
+            results.append(table.get_ruleset())
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[1]['services']['rules'], [Rule(protocol='tcp', jump='ACCEPT'),
+                                                           Rule(protocol='udp', jump='ACCEPT')])
+        self.assertEqual(netfilter.table.format_restore('filter', [['iptables', '-t', 'filter', '-N', 'services']],
+                                                        ['services']), '*filter\nCOMMIT\n')
+        print('...Done')
+
+
+class DumpBackend(netfilter.backend.Backend):
+    def __init__(self, data):
+        self.data = data
+        self.calls = []
+
+    def run(self, cmd, input=None):
+        self.calls.append(cmd)
+        if cmd[0].endswith('-save'):
+            return self.data
+        return ''
+
+
+class CacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.backend = DumpBackend(iptables_data)
+        self.table = netfilter.table.Table('filter', False, cache=True, backend=self.backend)
+
+    def saves(self):
+        return len([cmd for cmd in self.backend.calls if cmd[0] == 'iptables-save'])
+
+    def testReuseSnapshot(self):
+        print('Cache Test Case Set:\nRunning Test Reuse Snapshot...')
+        self.assertEqual(self.table.get_policy('INPUT'), 'DROP')
+        self.assertEqual(self.table.get_policy('FORWARD'), 'DROP')
+        self.assertEqual(len(self.table.list_rules('firewall_input_filter')), 11)
+        self.assertEqual(self.saves(), 1)
+        print('...Done')
+
+    def testListRulesCopy(self):
+        print('Running Test List Rules Copy...')
+        self.table.list_rules('firewall_input_filter').pop()
+        self.assertEqual(len(self.table.list_rules('firewall_input_filter')), 11)
+        self.assertEqual(self.saves(), 1)
+        print('...Done')
+
+    def testInvalidateOnMutation(self):
+        print('Running Test Invalidate On Mutation...')
+        self.table.get_policy('INPUT')
+        self.table.set_policy('INPUT', 'ACCEPT')
+        self.table.get_policy('INPUT')
+        self.assertEqual(self.saves(), 2)
+        self.table.commit()
+        self.table.get_policy('INPUT')
+        self.assertEqual(self.saves(), 3)
+        print('...Done')
+
+    def testStream(self):
+        print('Running Test Stream...')
+        rules = list(self.table.iter_rules('firewall_input_filter'))
+        self.assertEqual(rules, self.table.list_rules('firewall_input_filter'))
+        pairs = list(self.table.iter_rules())
+        self.assertEqual(len(pairs), 14)
+        self.assertEqual(pairs[0][0], 'INPUT')
+        self.assertEqual(self.saves(), 3)
+        print('...Done')
+
+    def testExpire(self):
+        print('Running Test Expire...')
+        self.table.cache_ttl = 0
+        self.table.get_policy('INPUT')
+        self.table.get_policy('INPUT')
+        self.assertEqual(self.saves(), 2)
+        print('...Done')
+
+
+class ReconcileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.table = netfilter.table.Table('filter', False, backend=DumpBackend(iptables_data))
+        self.live = netfilter.parser.parse_save(iptables_data)
+
+    def desired(self):
+        desired = netfilter.reconcile.DesiredTable('filter')
+        for chainname in self.live.keys():
+            chain = self.live[chainname]
+            desired.create_chain(chainname)
+            if chain['policy']:
+                desired.set_policy(chainname, chain['policy'])
+            for rule in chain['rules']:
+                desired.append_rule(chainname, rule)
+        return desired
+
+    def apply(self, live, ops):
+        rules = list(live)
+        for op in ops:
+            if op[0] == 'delete':
+                del rules[op[1] - 1]
+            elif op[0] == 'insert':
+                rules.insert(op[1] - 1, op[2])
+            else:
+                rules[op[1] - 1] = op[2]
+        return rules
+
+    def testDiffRules(self):
+        print('Reconcile Test Case Set:\nRunning Test Diff Rules...')
+        live = self.live['firewall_input_filter']['rules']
+        self.assertEqual(netfilter.reconcile.diff_rules(live, live), [])
+        changes = [
+            live[1:],
+            live[:3] + live[4:],
+            [Rule(jump='DROP')] + live,
+            live + [Rule(jump='DROP')],
+            live[:5] + [Rule(jump='DROP'), Rule(jump='REJECT')] + live[6:],
+            list(reversed(live)),
+            [],
+        ]
+        for desired in changes:
+            ops = netfilter.reconcile.diff_rules(live, desired)
+            self.assertEqual(self.apply(live, ops), desired)
+        ops = netfilter.reconcile.diff_rules(live, live[:3] + live[4:])
+        self.assertEqual(ops, [('delete', 4)])
+        print('...Done')
+
+    def testUnchanged(self):
+        print('Running Test Unchanged...')
+        applied = netfilter.reconcile.reconcile_table(self.table, self.desired())
+        self.assertEqual(applied, [])
+        self.assertEqual(self.table.get_buffer(), [])
+        print('...Done')
+
+    def testChanged(self):
+        print('Running Test Changed...')
+        desired = self.desired()
+        desired.set_policy('OUTPUT', 'DROP')
+        desired.append_rule('firewall_input_filter', Rule(jump='DROP'))
+        desired.delete_chain('firewall_forward_filter')
+        desired.flush_chain('FORWARD')
+        netfilter.reconcile.reconcile_table(self.table, desired)
+        self.assertEqual(self.table.get_buffer(), [
+            ['iptables', '-t', 'filter', '-D', 'FORWARD', '1'],
+            ['iptables', '-t', 'filter', '-P', 'OUTPUT', 'DROP'],
+            ['iptables', '-t', 'filter', '-I', 'firewall_input_filter', '12', '-j', 'DROP'],
+            ['iptables', '-t', 'filter', '-F', 'firewall_forward_filter'],
+            ['iptables', '-t', 'filter', '-X', 'firewall_forward_filter'],
+        ])
+        print('...Done')
+
+
+class IptcBackendTestCase(unittest.TestCase):
+    def testPrefixLength(self):
+        print('Iptc Backend Test Case Set:\nRunning Test Prefix Length...')
+        self.assertEqual(netfilter.iptcbackend.prefix_length('ipv4', '255.255.240.0'), 20)
+        self.assertEqual(netfilter.iptcbackend.prefix_length('ipv4', '24'), 24)
+        self.assertEqual(netfilter.iptcbackend.prefix_length('ipv6', 'ffff:ffff::'), 32)
+        print('...Done')
+
+    def testHostFromIptc(self):
+        print('Running Test Host From Iptc...')
+        self.assertEqual(netfilter.iptcbackend.host_from_iptc('ipv4', '0.0.0.0/0.0.0.0'), None)
+        self.assertEqual(netfilter.iptcbackend.host_from_iptc('ipv4', '10.1.0.0/255.255.240.0'), '10.1.0.0/20')
+        self.assertEqual(netfilter.iptcbackend.host_from_iptc('ipv4', '!10.1.0.0/255.255.240.0'), '! 10.1.0.0/20')
+        rule = Rule(source=netfilter.iptcbackend.host_from_iptc('ipv4', '192.168.1.3/255.255.255.255'))
+        self.assertEqual(rule.source, '192.168.1.3')
+        print('...Done')
+
+    def testValueToIptc(self):
+        print('Running Test Value To Iptc...')
+        self.assertEqual(netfilter.iptcbackend.value_to_iptc('! eth0'), '!eth0')
+        self.assertEqual(netfilter.iptcbackend.value_to_iptc('tcp'), 'tcp')
+        print('...Done')
+
+
+class CapabilitiesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.binary = os.path.join(self.tmp, 'iptables')
+        with open(self.binary, 'w') as f:
+            f.write('#!/bin/sh\necho "iptables v1.8.7 (nf_tables)"\n')
+        os.chmod(self.binary, 0o755)
+        self.environ = os.environ.get('NETFILTER_CAPABILITIES_CACHE')
+        os.environ['NETFILTER_CAPABILITIES_CACHE'] = os.path.join(self.tmp, 'cache', 'capabilities.json')
+        self.calls = []
+
+    def tearDown(self):
+        netfilter.capabilities.probed.pop(self.binary, None)
+        if self.environ is None:
+            del os.environ['NETFILTER_CAPABILITIES_CACHE']
+        else:
+            os.environ['NETFILTER_CAPABILITIES_CACHE'] = self.environ
+        shutil.rmtree(self.tmp)
+
+    def run_command(self, cmd):
+        self.calls.append(cmd)
+        return netfilter.capabilities.run_version(cmd)
+
+    def testParseVersion(self):
+        print('Capabilities Test Case Set:\nRunning Test Parse Version...')
+        capabilities = netfilter.capabilities.parse_version('iptables v1.8.7 (nf_tables)\n')
+        self.assertEqual(capabilities, {'version': '1.8.7', 'variant': 'nf_tables',
+                                        'wait': True, 'restore_wait': True})
+        capabilities = netfilter.capabilities.parse_version('iptables v1.4.21\n')
+        self.assertEqual(capabilities['variant'], 'legacy')
+        self.assertEqual(capabilities['wait'], True)
+        self.assertEqual(capabilities['restore_wait'], False)
+        self.assertEqual(netfilter.capabilities.parse_version('iptables v1.4.8')['wait'], False)
+        self.assertEqual(netfilter.capabilities.parse_version(None)['wait'], False)
+        print('...Done')
+
+    def testPersisted(self):
+        print('Running Test Persisted...')
+        capabilities = netfilter.capabilities.probe(self.binary, self.run_command)
+        self.assertEqual(capabilities['variant'], 'nf_tables')
+        self.assertEqual(self.calls, [[self.binary, '--version']])
+        # a new process only reads the cache file
+        netfilter.capabilities.probed.clear()
+        self.assertEqual(netfilter.capabilities.probe(self.binary, self.run_command), capabilities)
+        self.assertEqual(len(self.calls), 1)
+        print('...Done')
+
+    def testWaitOption(self):
+        print('Running Test Wait Option...')
+        backend = netfilter.backend.SubprocessBackend()
+        self.assertEqual(backend.wait_option(self.binary), ['--wait'])
+        self.assertEqual(backend.restore_wait_option(self.binary), ['--wait'])
+        print('...Done')
+
+
+class BackendTestCase(unittest.TestCase):
+    def testAbstract(self):
+        print('Backend Test Case Set:\nRunning Test Abstract...')
+
+        class PartialBackend(netfilter.backend.CommandBackend):
+            def dump(self, family, table):
+                return netfilter.parser.ODict()
+
+        self.assertRaises(TypeError, PartialBackend)
+        self.assertRaises(TypeError, netfilter.backend.Backend)
+        self.assertIs(netfilter.table.IptablesError, netfilter.errors.IptablesError)
+        print('...Done')
+
+    def testStreamStderr(self):
+        print('Running Test Stream Stderr...')
+        backend = netfilter.backend.SubprocessBackend()
+        chatty = "import sys; sys.stderr.write('warning\\n' * 50000); print('*filter')"
+        self.assertEqual(list(backend.stream([sys.executable, '-c', chatty])), ['*filter\n'])
+        failing = "import sys; sys.stderr.write('warning\\n' * 50000); sys.exit(1)"
+        with self.assertRaises(netfilter.errors.IptablesError) as context:
+            list(backend.stream([sys.executable, '-c', failing]))
+        self.assertEqual(context.exception.message.count('warning'), 50000)
+        print('...Done')
+
+
+class SimulatorTableTestCase(unittest.TestCase):
+    def setUp(self, auto_commit=True):
+        self.backend = netfilter.simulator.SimulatorBackend()
+        self.table = netfilter.table.Table('filter', auto_commit, backend=self.backend)
+        self.chain = 'netfilter_test'
+        self.table.create_chain(self.chain)
+        self.table.flush_chain(self.chain)
+
+    def testCreateFindDeleteChain(self):
+        print('Simulator Table Test Case Set:\nRunning Test Create Find Delete Chain...')
+        self.assertEqual(len(self.table.list_rules(self.chain)), 0)
+        rule = Rule(source='104.236.221.27', destination='192.168.1.3', jump='ACCEPT')
+        self.table.append_rule(self.chain, rule)
+        rules = self.table.list_rules(self.chain)
+        self.assertEqual(len(rules), 1)
+        rule2 = rule.find(rules)
+        self.assertEqual(rule2.source, '104.236.221.27')
+        self.assertEqual(rule2.destination, '192.168.1.3')
+        self.assertEqual(rule2.jump, Target('ACCEPT'))
+        self.table.delete_rule(self.chain, rule)
+        self.assertEqual(len(self.table.list_rules(self.chain)), 0)
+        self.assertRaises(netfilter.table.IptablesError, self.table.delete_rule, self.chain, rule)
+        self.table.delete_chain(self.chain)
+        self.assertEqual(list(self.table.list_chains()), ['INPUT', 'FORWARD', 'OUTPUT'])
+        print('...Done')
+
+    def testRenameChain(self):
+        print('Running Test Rename Chain...')
+        self.table.append_rule('INPUT', Rule(jump=self.chain))
+        self.table.append_rule(self.chain, Rule(jump='ACCEPT'))
+        self.table.rename_chain(self.chain, self.chain + '_new')
+        self.assertEqual(len(self.table.list_rules(self.chain + '_new')), 1)
+        self.assertEqual(self.table.list_rules('INPUT')[0].jump.name(), self.chain + '_new')
+        self.assertRaises(netfilter.table.IptablesError, self.table.delete_chain, self.chain + '_new')
+        print('...Done')
+
+    def testCounters(self):
+        print('Running Test Counters...')
+        self.table.append_rule(self.chain, Rule(protocol='tcp', jump='ACCEPT'))
+        self.backend.add_counters(self.chain, 1, 10, 1500)
+        self.backend.add_counters('INPUT', None, 3, 180)
+        rule = self.table.list_rules(self.chain)[0]
+        self.assertEqual((rule.packets, rule.bytes), (10, 1500))
+        chains = self.table.get_ruleset()
+        self.assertEqual((chains['INPUT']['packets'], chains['INPUT']['bytes']), (3, 180))
+        print('...Done')
+
+    def testAtomicCommit(self):
+        print('Running Test Atomic Commit...')
+        table = netfilter.table.Table('filter', False, atomic_commit=True, backend=self.backend)
+        table.append_rule(self.chain, Rule(jump='ACCEPT'))
+        table.append_rule('missing_chain', Rule(jump='ACCEPT'))
+        self.assertRaises(netfilter.table.IptablesError, table.commit)
+        self.assertEqual(len(table.get_buffer()), 2)
+        self.assertEqual(len(table.list_rules(self.chain)), 0)
+        table.get_buffer().pop()
+        calls = self.backend.calls
+        table.commit()
+        self.assertEqual(self.backend.calls, calls + 1)
+        self.assertEqual(len(table.list_rules(self.chain)), 1)
+        print('...Done')
+
+    def testLatency(self):
+        print('Running Test Latency...')
+        self.backend.latency = 0.01
+        start = time.time()
+        for i in range(5):
+            self.table.append_rule(self.chain, Rule(jump='ACCEPT'))
+        self.assertTrue(time.time() - start >= 0.05)
+        print('...Done')
+
+    def testRunSave(self):
+        print('Running Test Run Save...')
+        self.table.append_rule(self.chain, Rule(protocol='tcp', jump='ACCEPT'))
+        calls = self.backend.calls
+        dump = self.backend.run(['iptables-save', '-t', 'filter', '-c'])
+        self.assertEqual(self.backend.calls - calls, 1)
+        self.assertIn('-A %s -p tcp -j ACCEPT' % self.chain, dump)
+        self.assertEqual(netfilter.parser.parse_save(dump)[self.chain]['rules'], [Rule(protocol='tcp', jump='ACCEPT')])
+        print('...Done')
+
+
+class SimulatorFirewallTestCase(unittest.TestCase):
+    def setUp(self):
+        self.backend = netfilter.simulator.SimulatorBackend()
+        self.firewall = netfilter.firewall.Firewall(backend=self.backend)
+
+    def testLifecycle(self):
+        print('Simulator Firewall Test Case Set:\nRunning Test Lifecycle...')
+        self.assertEqual(self.firewall.run(['firewall', 'start']), 0)
+        self.assertEqual(self.firewall.filter.get_policy('INPUT'), 'DROP')
+        self.assertEqual(self.firewall.filter.get_policy('FORWARD'), 'DROP')
+        self.assertEqual(len(self.firewall.filter.list_rules('INPUT')), 8)
+        self.firewall.source_nat('eth0')
+        self.assertEqual(self.firewall.nat.list_rules('POSTROUTING')[0].jump.name(), 'MASQUERADE')
+        self.assertEqual(self.firewall.run(['firewall', 'restart']), 0)
+        self.assertEqual(len(self.firewall.filter.list_rules('INPUT')), 8)
+        self.assertEqual(self.firewall.nat.list_rules('POSTROUTING'), [])
+        self.assertEqual(self.firewall.run(['firewall', 'stop']), 0)
+        self.assertEqual(self.firewall.filter.get_policy('INPUT'), 'ACCEPT')
+        self.assertEqual(self.firewall.filter.list_rules('INPUT'), [])
+        print('...Done')
+
+    def testReload(self):
+        print('Running Test Reload...')
+        self.firewall.start()
+        self.backend.add_counters('INPUT', 1, 5, 500)
+        self.assertEqual(self.firewall.reconcile(), [])
+        self.firewall.filter.delete_rule_at('INPUT', 3)
+        self.firewall.filter.append_rule('INPUT', Rule(jump='LOG'))
+        applied = self.firewall.reconcile()
+        self.assertEqual(len(applied), 2)
+        self.assertEqual(self.firewall.filter.list_rules('INPUT')[0].packets, 5)
+        self.assertEqual(self.firewall.reconcile(), [])
+        print('...Done')
+
+
+class IPSetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.backend = netfilter.simulator.SimulatorBackend()
+        self.table = netfilter.table.Table('filter', backend=self.backend)
+
+    def testUpdate(self):
+        print('IPSet Test Case Set:\nRunning Test Update...')
+        partners = netfilter.ipset.IPSet('partners', family='inet', backend=self.backend)
+        self.assertEqual(partners.update(['10.0.0.0/8', '192.168.1.1/32']), (['10.0.0.0/8', '192.168.1.1'], []))
+        self.assertEqual(partners.update(['10.0.0.0/8', '172.16.0.0/12']), (['172.16.0.0/12'], ['192.168.1.1']))
+        self.assertEqual(partners.update(['172.16.0.0/12', '10.1.2.3/8']), ([], []))
+        self.assertEqual(partners.members(), set(['10.0.0.0/8', '172.16.0.0/12']))
+        partners.replace(['192.0.2.0/24'])
+        self.assertEqual(partners.members(), set(['192.0.2.0/24']))
+        self.assertEqual([line for line in self.backend.run(['ipset', 'save']).splitlines()
+                          if line.startswith('create')], ['create partners hash:net family inet'])
+        print('...Done')
+
+    def testRules(self):
+        print('Running Test Rules...')
+        partners = netfilter.ipset.IPSet('partners', backend=self.backend)
+        rule = Rule(protocol='tcp', matches=[partners.match('src')], jump='ACCEPT')
+        self.assertRaises(netfilter.table.IptablesError, self.table.append_rule, 'INPUT', rule)
+        partners.create()
+        self.table.append_rule('INPUT', rule)
+        self.assertEqual(self.table.list_rules('INPUT'), [rule])
+        self.assertRaises(netfilter.table.IptablesError, partners.destroy)
+        self.table.flush_chain('INPUT')
+        partners.destroy()
+        self.assertRaises(netfilter.table.IptablesError, partners.members)
+        print('...Done')
+
+    def testFirewall(self):
+        print('Running Test Firewall...')
+        firewall = netfilter.firewall.Firewall(backend=self.backend)
+        ports = [str(port) for port in range(8000, 8020)]
+        firewall.accept_protocol_set('eth0', 'tcp', ports, sources=['10.%d.0.0/16' % i for i in range(200)],
+                                     name='partners')
+        rules = firewall.filter.list_rules('INPUT')
+        self.assertEqual(len(rules), 1)
+        self.assertEqual(rules[0].specbits()[-10:], ['--match-set', 'partners-ports', 'dst', '-m', 'set',
+                                                     '--match-set', 'partners-src', 'src', '-j', 'ACCEPT'])
+        changes = firewall.update_protocol_set('partners', sources=['10.0.0.0/16', '10.250.0.0/16'])
+        self.assertEqual(changes['partners-src'][0], ['10.250.0.0/16'])
+        self.assertEqual(len(changes['partners-src'][1]), 199)
+        self.assertEqual(firewall.filter.list_rules('INPUT'), rules)
+        self.assertRaises(Exception, firewall.update_protocol_set, 'partners', destinations=['10.0.0.1'])
+        print('...Done')
+
+    def testStaged(self):
+        print('Running Test Staged...')
+        firewall = netfilter.firewall.Firewall(auto_commit=False, backend=self.backend)
+        firewall.accept_protocol_set('eth0', 'tcp', ['22'], sources=['10.0.0.0/8'], name='partners')
+        self.assertEqual(self.backend.run(['ipset', 'save']), '')
+        firewall.commit()
+        self.assertEqual(netfilter.ipset.IPSet('partners-src', backend=self.backend).members(), set(['10.0.0.0/8']))
+        self.assertEqual(len(firewall.filter.list_rules('INPUT')), 1)
+        print('...Done')
+
+    def testDesiredState(self):
+        print('Running Test Desired State...')
+
+        class SetFirewall(netfilter.firewall.Firewall):
+            def configure(self):
+                self.accept_protocol_set('eth0', 'tcp', ['22'], sources=['10.0.0.0/8'], name='partners')
+
+        firewall = SetFirewall(backend=self.backend, fingerprint=True)
+        desired = firewall.desired_state()
+        self.assertEqual(self.backend.run(['ipset', 'save']), '')
+        firewall.reconcile(desired)
+        self.assertEqual(netfilter.ipset.IPSet('partners-src', backend=self.backend).members(), set(['10.0.0.0/8']))
+        self.assertTrue(firewall.unchanged())
+        self.assertEqual(self.backend.run(['ipset', 'save', 'partners-src']).count('add'), 1)
+        print('...Done')
+
+    def testRanges(self):
+        print('Running Test Ranges...')
+        self.assertEqual(netfilter.ipset.port_count(['22', '8000:8010', '9000-9005', '443:443']), 6)
+        firewall = netfilter.firewall.Firewall(backend=self.backend)
+        firewall.accept_protocol_set('eth0', 'tcp', ['%d:%d' % (port, port + 5) for port in range(1000, 1080, 10)],
+                                     name='ranges')
+        self.assertIn('ranges-ports', firewall.filter.list_rules('INPUT')[0].specbits())
+        firewall.accept_protocol_set('eth1', 'tcp', ['%d:%d' % (port, port + 5) for port in range(1000, 1070, 10)] +
+                                     ['22'], name='fits')
+        self.assertIn('multiport', firewall.filter.list_rules('INPUT')[1].specbits())
+        print('...Done')
+
+
+class FingerprintTestCase(unittest.TestCase):
+    def setUp(self):
+        self.backend = netfilter.simulator.SimulatorBackend()
+        self.firewall = netfilter.firewall.Firewall(backend=self.backend, fingerprint=True)
+
+    def testStamp(self):
+        print('Fingerprint Test Case Set:\nRunning Test Stamp...')
+        desired = self.firewall.desired_state()
+        stamp = desired['filter'].list_rules('INPUT')[-1]
+        desired['filter'].list_rules('INPUT').pop()
+        digest = netfilter.reconcile.fingerprint(desired['filter'])
+        self.assertEqual(len(digest), 32)
+        self.assertEqual(stamp, netfilter.reconcile.stamp_rule(digest))
+        self.assertEqual(stamp.specbits(), ['-m', 'comment', '--comment', 'netfilter-fingerprint:' + digest])
+        self.assertEqual(self.firewall.desired_state()['filter'].list_rules('INPUT')[-1], stamp)
+        self.assertFalse(self.firewall.filter.check_rule('INPUT', stamp))
+        self.firewall.start()
+        self.assertTrue(self.firewall.filter.check_rule('INPUT', stamp))
+        self.assertEqual(len(self.firewall.nat.list_rules('PREROUTING')), 1)
+        print('...Done')
+
+    def testSkip(self):
+        print('Running Test Skip...')
+        self.assertEqual(self.firewall.run(['firewall', 'start']), 0)
+        self.backend.add_counters('INPUT', 1, 5, 500)
+        calls = self.backend.calls
+        self.assertEqual(self.firewall.run(['firewall', 'start']), 0)
+        self.assertEqual(self.firewall.run(['firewall', 'restart']), 0)
+        self.assertEqual(self.backend.calls - calls, 4)
+        self.assertEqual(self.firewall.filter.list_rules('INPUT')[0].packets, 5)
+
+        class ExtraFirewall(netfilter.firewall.Firewall):
+            def configure(self):
+                netfilter.firewall.Firewall.configure(self)
+                self.accept_input('eth1')
+        firewall = ExtraFirewall(backend=self.backend, fingerprint=True)
+        self.assertFalse(firewall.unchanged())
+        self.assertEqual(firewall.run(['firewall', 'restart']), 0)
+        self.assertEqual(firewall.filter.list_rules('INPUT')[0].packets, 5)
+        self.assertEqual(firewall.filter.list_rules('INPUT')[-2].in_interface, 'eth1')
+        self.assertTrue(firewall.unchanged())
+        self.assertFalse(self.firewall.unchanged())
+        print('...Done')
+
+    def testBuffered(self):
+        print('Running Test Buffered...')
+        firewall = netfilter.firewall.Firewall(auto_commit=False, backend=self.backend, fingerprint=True)
+        firewall.start()
+        firewall.commit()
+        self.backend.add_counters('INPUT', 1, 5, 500)
+
+        class ExtraFirewall(netfilter.firewall.Firewall):
+            def configure(self):
+                netfilter.firewall.Firewall.configure(self)
+                self.accept_input('eth1')
+        firewall = ExtraFirewall(auto_commit=False, backend=self.backend, fingerprint=True)
+        firewall.restart()
+        firewall.commit()
+        rules = firewall.filter.list_rules('INPUT')
+        self.assertEqual(rules[0].packets, 5)
+        self.assertEqual(rules[-2].in_interface, 'eth1')
+        calls = self.backend.calls
+        firewall.restart()
+        self.assertEqual(firewall.get_buffer(), [])
+        self.assertEqual(self.backend.calls - calls, 2)
+        print('...Done')
+
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.backend = netfilter.simulator.SimulatorBackend()
+        self.firewall = netfilter.firewall.Firewall(backend=self.backend)
+
+    def testParseTables(self):
+        print('Snapshot Test Case Set:\nRunning Test Parse Tables...')
+        tables = netfilter.parser.parse_tables(iptables_data + iptables_data.replace('*filter', '*mangle'))
+        self.assertEqual(list(tables.keys()), ['filter', 'mangle'])
+        self.assertEqual(tables['filter'].keys(), netfilter.parser.parse_save(iptables_data).keys())
+        self.assertEqual(tables['mangle']['INPUT']['policy'], 'DROP')
+        self.assertRaises(netfilter.parser.ParseError, netfilter.parser.parse_tables,
+                          ':INPUT ACCEPT [0:0]\n')
+        print('...Done')
+
+    def testSnapshot(self):
+        print('Running Test Snapshot...')
+        self.firewall.start()
+        self.firewall.source_nat('eth0')
+        calls = self.backend.calls
+        tables = self.firewall.snapshot()
+        self.assertEqual(self.backend.calls - calls, 1)
+        self.assertEqual(list(tables.keys()), ['raw', 'mangle', 'nat', 'filter'])
+        self.assertEqual(len(self.firewall.filter.list_rules('INPUT')), 8)
+        self.assertEqual(self.firewall.nat.list_rules('POSTROUTING')[0].out_interface, 'eth0')
+        self.assertEqual(self.backend.calls - calls, 1)
+        # a non-caching table takes the dump for a single read
+        self.assertEqual(self.firewall.filter.get_policy('INPUT'), 'DROP')
+        self.assertEqual(self.backend.calls - calls, 2)
+        self.firewall.snapshot()
+        self.firewall.accept_input('eth1')
+        self.assertEqual(len(self.firewall.filter.list_rules('INPUT')), 9)
+        self.assertEqual(self.backend.calls - calls, 5)
+        print('...Done')
+
+    def testCaching(self):
+        print('Running Test Caching...')
+        self.firewall.start()
+        table = netfilter.table.Table('filter', cache=True, cache_ttl=60, backend=self.backend)
+        table.set_snapshot(self.firewall.snapshot()['filter'])
+        calls = self.backend.calls
+        self.assertEqual(len(table.list_rules('INPUT')), 8)
+        self.assertEqual(table.get_policy('INPUT'), 'DROP')
+        self.assertEqual(self.backend.calls, calls)
+        print('...Done')
+
+    def testMissingTable(self):
+        print('Running Test Missing Table...')
+        self.firewall.source_nat('eth0')
+        self.firewall.nat.set_snapshot(netfilter.parser.parse_save('*nat\n:POSTROUTING ACCEPT [0:0]\nCOMMIT\n'))
+        dump = self.backend.load_tables(['iptables-save', '-c'])
+        del dump['nat']
+        self.backend.load_tables = lambda cmd: dump
+        self.firewall.snapshot()
+        self.assertEqual(len(self.firewall.nat.list_rules('POSTROUTING')), 1)
+        print('...Done')
+
+
+restore_stub = """import sys
+log = open(sys.argv[1], 'a')
+for number, line in enumerate(iter(sys.stdin.readline, ''), 1):
+    if line.startswith('#'):
+        sys.stdout.write(line)
+        sys.stdout.flush()
+    elif 'FAIL' in line:
+        sys.stderr.write('iptables-restore: line %d failed\\n' % number)
+        sys.exit(1)
+    else:
+        log.write(line)
+        log.flush()
+"""
+
+
+class SessionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.stub = os.path.join(self.tmpdir, 'restore.py')
+        self.log = os.path.join(self.tmpdir, 'restore.log')
+        with open(self.stub, 'w') as f:
+            f.write(restore_stub)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testStub(self):
+        print('Session Test Case Set:\nRunning Test Stub...')
+        session = netfilter.session.RestoreSession(command=[sys.executable, self.stub, self.log], timeout=10)
+        session.transaction('*filter\n-A INPUT -i eth0 -j ACCEPT\nCOMMIT')
+        session.transaction('*filter\n-D INPUT -i eth0 -j ACCEPT\nCOMMIT\n')
+        self.assertEqual(session.started, 1)
+        with self.assertRaises(netfilter.table.IptablesError) as error:
+            session.transaction('*filter\n-A INPUT -j FAIL\nCOMMIT\n')
+        self.assertIn('line 10 failed', error.exception.message)
+        session.transaction('*nat\nCOMMIT\n')
+        self.assertEqual(session.started, 2)
+        session.close()
+        with open(self.log) as f:
+            self.assertEqual(f.read().splitlines(), ['*filter', '-A INPUT -i eth0 -j ACCEPT', 'COMMIT',
+                                                     '*filter', '-D INPUT -i eth0 -j ACCEPT', 'COMMIT',
+                                                     '*filter', '*nat', 'COMMIT'])
+        print('...Done')
+
+    def testCommit(self):
+        print('Running Test Commit...')
+        backend = netfilter.simulator.SimulatorBackend()
+        session = netfilter.session.RestoreSession(backend=backend)
+        table = netfilter.table.Table('filter', auto_commit=False, backend=backend)
+        table.append_rule('INPUT', Rule(in_interface='eth0', jump='ACCEPT'))
+        table.append_rule('INPUT', Rule(in_interface='eth1', jump='ACCEPT'))
+        session.commit(table)
+        self.assertEqual(table.get_buffer(), [])
+        self.assertEqual([rule.in_interface for rule in table.list_rules('INPUT')], ['eth0', 'eth1'])
+        table.append_rule('INPUT', Rule(jump='nonexistent'))
+        self.assertRaises(netfilter.table.IptablesError, session.commit, table)
+        self.assertEqual(len(table.get_buffer()), 1)
+        self.assertEqual(len(table.list_rules('INPUT')), 2)
+        print('...Done')
+
+    def testTable(self):
+        print('Running Test Table...')
+        backend = netfilter.simulator.SimulatorBackend()
+        session = netfilter.session.RestoreSession(backend=backend)
+        self.assertEqual(session.timeout, netfilter.session.default_timeout)
+        firewall = netfilter.firewall.Firewall(backend=backend, session=session)
+        firewall.filter.create_chain('services')
+        firewall.filter.create_chain('services')
+        firewall.filter.append_rule('services', Rule(protocol='tcp', jump='ACCEPT'))
+        firewall.nat.append_rule('POSTROUTING', Rule(out_interface='eth0', jump='MASQUERADE'))
+        firewall.filter.delete_rule('services', Rule(protocol='tcp', jump='ACCEPT'))
+        self.assertEqual(session.transactions, 3)
+        self.assertEqual(firewall.filter.list_rules('services'), [])
+        self.assertEqual(len(firewall.nat.list_rules('POSTROUTING')), 1)
+        self.assertRaises(netfilter.table.IptablesError, firewall.filter.append_rule, 'INPUT', Rule(jump='nonexistent'))
+        print('...Done')
+
+
+class MonitorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 100.0
+        self.backend = netfilter.simulator.SimulatorBackend()
+        self.table = netfilter.table.Table('filter', backend=self.backend)
+        self.table.create_chain('test_chain')
+        self.table.append_rule('test_chain', Rule(protocol='tcp', jump='ACCEPT'))
+        self.table.append_rule('test_chain', Rule(protocol='udp', jump='ACCEPT'))
+        self.table.append_rule('INPUT', Rule(jump='test_chain'))
+        self.monitor = netfilter.monitor.RateMonitor(self.table, clock=lambda: self.now)
+
+    def testRates(self):
+        print('Monitor Test Case Set:\nRunning Test Rates...')
+        self.monitor.sample()
+        self.assertEqual([rate[2] for rate in self.monitor.rule_rates()], [0.0, 0.0, 0.0])
+        self.backend.add_counters('test_chain', 1, 100, 15000)
+        self.backend.add_counters('test_chain', 2, 20, 1000)
+        self.now += 2
+        self.monitor.sample()
+        rates = self.monitor.rule_rates('test_chain')
+        self.assertEqual([(rate[1].protocol, rate[2], rate[3]) for rate in rates],
+                         [('tcp', 50.0, 7500.0), ('udp', 10.0, 500.0)])
+        self.assertEqual(self.monitor.chain_rates(), {'INPUT': (0.0, 0.0), 'test_chain': (60.0, 8000.0)})
+        print('...Done')
+
+    def testRuleMoved(self):
+        print('Running Test Rule Moved...')
+        self.backend.add_counters('test_chain', 2, 20, 1000)
+        self.monitor.sample()
+        # counters follow the rule identity, not its position
+        self.table.insert_rule('test_chain', 1, Rule(protocol='icmp', jump='ACCEPT'))
+        self.backend.add_counters('test_chain', 3, 10, 500)
+        self.now += 1
+        self.monitor.sample()
+        rates = dict((rate[1].protocol, rate[2]) for rate in self.monitor.rule_rates('test_chain'))
+        self.assertEqual(rates, {'icmp': 0.0, 'tcp': 0.0, 'udp': 10.0})
+        self.table.flush_chain('test_chain')
+        self.now += 1
+        self.monitor.sample()
+        self.assertEqual(len(self.monitor.rule_rates()), 1)
+        print('...Done')
+
+
+class HistoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'history')
+        self.tiers = [(1, 4), (4, 3)]
+        self.rule = Rule(protocol='tcp', jump='ACCEPT')
+        self.other = Rule(protocol='udp', jump='ACCEPT')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def record(self, history, now, packets):
+        self.rule.packets = packets
+        self.rule.bytes = packets * 100
+        history.record_rules('INPUT', [self.rule], now)
+
+    def testRing(self):
+        print('History Test Case Set:\nRunning Test Ring...')
+        history = netfilter.history.HistoryStore(self.path, capacity=2, tiers=self.tiers)
+        for now in range(100, 107):
+            self.record(history, now, (now - 100) * 10)
+        self.assertEqual(history.history('INPUT', self.rule),
+                         [(103, 30, 3000), (104, 40, 4000), (105, 50, 5000), (106, 60, 6000)])
+        # the coarse tier keeps the last value of each bucket
+        self.assertEqual(history.history('INPUT', self.rule, 1),
+                         [(100, 30, 3000), (104, 60, 6000)])
+        self.assertEqual(history.rates('INPUT', self.rule, 1), [(104, 7.5, 750.0)])
+        self.assertEqual(history.history('INPUT', self.other), [])
+        # buckets skipped over are cleared
+        self.record(history, 109, 90)
+        self.assertEqual(history.history('INPUT', self.rule), [(106, 60, 6000), (109, 90, 9000)])
+        history.close()
+        print('...Done')
+
+    def testPersisted(self):
+        print('Running Test Persisted...')
+        history = netfilter.history.HistoryStore(self.path, capacity=2, tiers=self.tiers)
+        self.record(history, 100, 10)
+        history.close()
+        history = netfilter.history.HistoryStore(self.path)
+        self.assertEqual(history.tiers, self.tiers)
+        self.assertEqual(len(history), 1)
+        self.record(history, 101, 20)
+        self.assertEqual(history.history('INPUT', self.rule), [(100, 10, 1000), (101, 20, 2000)])
+        history.close()
+        print('...Done')
+
+    def testFull(self):
+        print('Running Test Full...')
+        history = netfilter.history.HistoryStore(self.path, capacity=1, tiers=self.tiers)
+        self.record(history, 100, 10)
+        self.assertRaises(Exception, history.record_rules, 'INPUT', [self.other], 101)
+        # once the rule aged out of every tier its slot is reused
+        history.record_rules('INPUT', [self.other], 200)
+        self.assertEqual(history.history('INPUT', self.rule), [])
+        self.assertEqual(history.history('INPUT', self.other), [(200, 0, 0)])
+        history.close()
+        print('...Done')
+
+    def testRecordTable(self):
+        print('Running Test Record Table...')
+        backend = netfilter.simulator.SimulatorBackend()
+        table = netfilter.table.Table('filter', backend=backend)
+        table.append_rule('INPUT', self.rule)
+        backend.add_counters('INPUT', 1, 3, 300)
+        history = netfilter.history.HistoryStore(self.path, capacity=2, tiers=self.tiers)
+        history.record(table, 100)
+        self.assertEqual(history.history('INPUT', self.rule), [(100, 3, 300)])
+        history.close()
+        print('...Done')
+
+
+classifier_filter = """*filter
+:INPUT DROP [0:0]
+:FORWARD DROP [0:0]
+:OUTPUT ACCEPT [0:0]
+:services - [0:0]
+:blacklist - [0:0]
+:web - [0:0]
+[0:0] -A INPUT -m state --state ESTABLISHED,RELATED -j ACCEPT
+[0:0] -A INPUT -i lo -j ACCEPT
+[0:0] -A INPUT -j blacklist
+[0:0] -A INPUT -p icmp -m icmp --icmp-type echo-request -j ACCEPT
+[0:0] -A INPUT -i eth+ -p tcp -m multiport --dports 80,443 -g web
+[0:0] -A INPUT -i eth0 -j services
+[0:0] -A INPUT -p udp -m udp --dport 514 -j LOG
+[0:0] -A INPUT -p udp -m udp --dport 1024:65535 -j REJECT
+[0:0] -A INPUT -p tcp -m tcp --dport 8000:8080 -j ACCEPT
+[0:0] -A blacklist -s 192.0.2.0/24 -j DROP
+[0:0] -A blacklist ! -s 10.0.0.0/8 -p tcp -m tcp --dport 23 -j DROP
+[0:0] -A services -p tcp -m tcp --dport 22 -j ACCEPT
+[0:0] -A services -p udp -m udp --dport 53 -j ACCEPT
+[0:0] -A services -p tcp -m tcp ! --dport 25 -j RETURN
+[0:0] -A services -p tcp -j ACCEPT
+[0:0] -A web -s 10.0.0.0/8 -j ACCEPT
+[0:0] -A web -p tcp -m tcp --dport 443 -j ACCEPT
+COMMIT
+"""
+
+
+class ClassifierTestCase(unittest.TestCase):
+    def setUp(self):
+        self.chains = netfilter.parser.parse_save(classifier_filter)
+        self.classifier = netfilter.classifier.Classifier(self.chains)
+
+    def packet(self, protocol, source, dport, interface='eth0', **kwargs):
+        return netfilter.classifier.Packet(protocol, source, '10.1.1.1', 40000, dport,
+                                           interface, **kwargs)
+
+    def testVerdicts(self):
+        print('Classifier Test Case Set:\nRunning Test Verdicts...')
+        verdict = self.classifier.verdict
+        self.assertEqual(verdict('INPUT', self.packet('tcp', '10.2.2.2', 22)), 'ACCEPT')
+        self.assertEqual(verdict('INPUT', self.packet('tcp', '10.2.2.2', 22, 'eth1')), 'DROP')
+        self.assertEqual(verdict('INPUT', self.packet('tcp', '10.2.2.2', 22, 'eth1', state='ESTABLISHED')),
+                         'ACCEPT')
+        self.assertEqual(verdict('INPUT', self.packet('tcp', '192.0.2.7', 22)), 'DROP')
+        self.assertEqual(verdict('INPUT', self.packet('tcp', '198.51.100.1', 23)), 'DROP')
+        self.assertEqual(verdict('INPUT', self.packet('tcp', '10.2.2.2', 25)), 'ACCEPT')
+        # LOG does not decide
+        self.assertEqual(verdict('INPUT', self.packet('udp', '10.2.2.2', 514)), 'DROP')
+        self.assertEqual(verdict('INPUT', self.packet('udp', '10.2.2.2', 5140)), 'REJECT')
+        self.assertEqual(verdict('INPUT', self.packet('17', '10.2.2.2', 53)), 'ACCEPT')
+        self.assertEqual(verdict('INPUT', self.packet('icmp', '10.2.2.2', None, icmp_type=8)), 'ACCEPT')
+        self.assertEqual(verdict('INPUT', self.packet('icmp', '10.2.2.2', None,
+                                                      icmp_type='port-unreachable')), 'DROP')
+        print('...Done')
+
+    def testJumps(self):
+        print('Running Test Jumps...')
+        # RETURN from services carries on in INPUT
+        self.assertEqual(self.classifier.classify('INPUT', self.packet('tcp', '10.2.2.2', 8080)),
+                         ('ACCEPT', 'INPUT', 9))
+        # falling off a chain entered with -g returns to the caller of INPUT
+        self.assertEqual(self.classifier.classify('INPUT', self.packet('tcp', '198.51.100.1', 80)),
+                         ('DROP', 'INPUT', None))
+        rule = self.classifier.matching_rule('INPUT', self.packet('tcp', '198.51.100.1', 443))
+        self.assertEqual(rule.specline(), '-p tcp -m tcp --dport 443 -j ACCEPT')
+        self.assertEqual(self.classifier.matching_rule('INPUT', self.packet('tcp', '10.2.2.2', 80)),
+                         self.chains['web']['rules'][0])
+        print('...Done')
+
+    def testIndexed(self):
+        print('Running Test Indexed...')
+        linear = netfilter.classifier.Classifier(self.chains, indexed=False)
+        packets = []
+        for protocol in ('tcp', 'udp', 'icmp'):
+            for source in ('10.2.2.2', '192.0.2.1', '198.51.100.1'):
+                for dport in (22, 23, 25, 53, 80, 443, 514, 1500, 8000, None):
+                    for interface in ('eth0', 'eth1', 'lo'):
+                        for state in ('NEW', 'ESTABLISHED'):
+                            packets.append(self.packet(protocol, source, dport, interface, state=state))
+        self.assertEqual(self.classifier.classify_many('INPUT', packets),
+                         linear.classify_many('INPUT', packets))
+        self.assertEqual(self.classifier.unsupported(), [])
+        print('...Done')
+
+    def testIcmpv6(self):
+        print('Running Test Icmpv6...')
+        rules = [netfilter.parser.parse_rule(spec) for spec in
+                 ['-p ipv6-icmp -m icmp6 --icmpv6-type echo-request -j ACCEPT',
+                  '-p ipv6-icmp -m icmp6 --icmpv6-type destination-unreachable -j ACCEPT']]
+        classifier = netfilter.classifier.Classifier({'INPUT': {'policy': 'DROP', 'rules': rules}})
+
+        def packet(icmp_type):
+            return netfilter.classifier.Packet('ipv6-icmp', '2001:db8::1', '2001:db8::2', icmp_type=icmp_type)
+
+        self.assertEqual(classifier.classify('INPUT', packet('echo-request')), ('ACCEPT', 'INPUT', 1))
+        self.assertEqual(classifier.classify('INPUT', packet((128, 0))), ('ACCEPT', 'INPUT', 1))
+        self.assertEqual(classifier.classify('INPUT', packet((8, 0))), ('DROP', 'INPUT', None))
+        self.assertEqual(classifier.classify('INPUT', packet('port-unreachable')), ('ACCEPT', 'INPUT', 2))
+        self.assertEqual(classifier.classify('INPUT', packet((3, 3))), ('DROP', 'INPUT', None))
+        self.assertRaises(Exception, netfilter.classifier.parse_icmp_type, 'source-quench', True)
+        print('...Done')
+
+    def testIndexedHosts(self):
+        print('Running Test Indexed Hosts...')
+        rules = [netfilter.parser.parse_rule(spec) for spec in
+                 ['-d 10.1.1.%d -p tcp -j ACCEPT' % i for i in range(6)] +
+                 ['-d 10.1.1.2 -i eth1 -j REJECT', '! -d 10.1.1.3 -j LOG', '-d 10.1.1.0/24 -j DROP',
+                  '-i eth0 -p udp -m udp --dport 53 -j ACCEPT', '-i eth0 -j RETURN']]
+        chains = {'INPUT': {'policy': 'DROP', 'rules': rules}}
+        indexed = netfilter.classifier.Classifier(chains)
+        linear = netfilter.classifier.Classifier(chains, indexed=False)
+        packets = [netfilter.classifier.Packet(protocol, '192.0.2.1', '10.1.1.%d' % host, 40000, 53, interface)
+                   for protocol in ('tcp', 'udp') for host in range(8) for interface in ('eth0', 'eth1')]
+        self.assertEqual(indexed.classify_many('INPUT', packets), linear.classify_many('INPUT', packets))
+        self.assertEqual(indexed.classify('INPUT', packets[21]), ('REJECT', 'INPUT', 7))
+        print('...Done')
+
+    @unittest.skipIf(netfilter.batch.numpy is None, 'numpy is not installed')
+    def testBatch(self):
+        print('Running Test Batch...')
+        packets = []
+        for protocol in ('tcp', 'udp', 'icmp'):
+            for source in ('10.2.2.2', '192.0.2.1', '198.51.100.1'):
+                for dport in (22, 23, 25, 53, 80, 443, 514, 5140, 8000, None):
+                    for interface in ('eth0', 'eth1', 'lo'):
+                        for icmp_type in (None, 'echo-request', 'port-unreachable'):
+                            packets.append(self.packet(protocol, source, dport, interface,
+                                                       icmp_type=icmp_type))
+        batch = netfilter.batch.BatchClassifier(self.chains, chunk_size=100)
+        verdicts, rules = batch.classify('INPUT', netfilter.batch.columns_from_packets(packets))
+        self.assertEqual(list(batch.verdict_names(verdicts)),
+                         self.classifier.classify_many('INPUT', packets))
+        for packet, rule in zip(packets, rules):
+            expected = self.classifier.matching_rule('INPUT', packet)
+            if expected is None:
+                self.assertEqual(rule, -1)
+            else:
+                self.assertTrue(batch.rules[rule][2] is expected)
+        print('...Done')
+
+
+class ChainTreeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.flat = netfilter.reconcile.DesiredTable('filter')
+        self.flat.set_policy('INPUT', 'DROP')
+        self.flat.append_rule('INPUT', Rule(matches=[Match('state', '--state ESTABLISHED,RELATED')], jump='ACCEPT'))
+        for interface in ('eth0', 'eth1', 'vlan100'):
+            for port in range(20, 26):
+                self.flat.append_rule('INPUT', Rule(in_interface=interface, protocol='tcp',
+                                                    matches=[Match('tcp', '--dport %d' % port)], jump='ACCEPT'))
+            self.flat.append_rule('INPUT', Rule(in_interface=interface, protocol='udp',
+                                                matches=[Match('udp', '--dport 53')], jump='ACCEPT'))
+        # a RETURN ends the run, so the eth0 rules after it need a chain of their own
+        self.flat.append_rule('INPUT', Rule(in_interface='eth0', protocol='tcp',
+                                            matches=[Match('tcp', '--dport 25')], jump='RETURN'))
+        for port in range(20, 26):
+            self.flat.append_rule('INPUT', Rule(in_interface='eth0', protocol='tcp',
+                                                matches=[Match('tcp', '--dport %d' % port)], jump='REJECT'))
+        self.flat.append_rule('INPUT', Rule(in_interface='eth+', protocol='tcp', jump='REJECT'))
+
+    def testCompile(self):
+        print('Chain Tree Test Case Set:\nRunning Test Compile...')
+        tree = netfilter.chaintree.compile_ruleset(self.flat).get_ruleset()
+        self.assertEqual(list(tree.keys()), ['INPUT', 'INPUT-eth0', 'INPUT-eth0-tcp', 'INPUT-eth1',
+                                             'INPUT-eth1-tcp', 'INPUT-vlan100', 'INPUT-vlan100-tcp',
+                                             'INPUT-eth0-2', 'INPUT-eth0-2-tcp'])
+        self.assertEqual(tree['INPUT']['policy'], 'DROP')
+        self.assertEqual(len(tree['INPUT']['rules']), 7)
+        self.assertEqual(tree['INPUT']['rules'][1].jump.name(), 'INPUT-eth0')
+        self.assertEqual(len(tree['INPUT-eth0-tcp']['rules']), 6)
+        classifier = netfilter.classifier.Classifier(self.flat.get_ruleset())
+        compiled = netfilter.classifier.Classifier(tree)
+        for interface in ('eth0', 'eth1', 'eth2', 'vlan100', 'lo'):
+            for protocol in ('tcp', 'udp', 'icmp'):
+                for port in (19, 20, 25, 53):
+                    packet = netfilter.classifier.Packet(protocol, '10.0.0.1', '10.0.0.2', 1024, port,
+                                                         interface, None)
+                    self.assertEqual(compiled.verdict('INPUT', packet), classifier.verdict('INPUT', packet))
+        print('...Done')
+
+    def testFirewall(self):
+        print('Running Test Firewall...')
+        backend = netfilter.simulator.SimulatorBackend()
+        firewall = netfilter.firewall.Firewall(backend=backend, chain_tree=True)
+        self.assertEqual(firewall.run(['firewall', 'start']), 0)
+        self.assertEqual([rule.jump.name() for rule in firewall.filter.list_rules('INPUT')],
+                         ['ACCEPT', 'INPUT-icmp', 'ACCEPT'])
+        self.assertEqual(len(firewall.filter.list_rules('INPUT-icmp')), 6)
+        self.assertEqual(firewall.reconcile(), [])
+        self.assertEqual(firewall.run(['firewall', 'restart']), 0)
+        self.assertEqual(len(firewall.filter.list_rules('INPUT-icmp')), 6)
+        print('...Done')
+
+    def testBuffered(self):
+        print('Running Test Buffered...')
+        backend = netfilter.simulator.SimulatorBackend()
+        firewall = netfilter.firewall.Firewall(auto_commit=False, backend=backend, chain_tree=True)
+        firewall.start()
+        firewall.commit()
+        backend.add_counters('INPUT', 1, 5, 500)
+        firewall.filter.append_rule('INPUT', Rule(in_interface='eth9', jump='DROP'))
+        firewall.commit()
+        self.assertEqual(len(firewall.filter.list_rules('INPUT')), 4)
+        firewall.start()
+        firewall.commit()
+        rules = firewall.filter.list_rules('INPUT')
+        self.assertEqual([rule.jump.name() for rule in rules], ['ACCEPT', 'INPUT-icmp', 'ACCEPT'])
+        self.assertEqual(rules[0].packets, 5)
+        print('...Done')
+
+
+class AnalyzerTestCase(unittest.TestCase):
+    def analyze(self, specs, policy=None, chains=()):
+        rules = [netfilter.parser.parse_rule(spec) for spec in specs]
+        findings = netfilter.analyzer.analyze_chain(rules, 'test_chain', policy, chains)
+        return [(finding.kind, finding.position, finding.related) for finding in findings]
+
+    def testShadowed(self):
+        print('Analyzer Test Case Set:\nRunning Test Shadowed...')
+        findings = self.analyze(['-s 10.0.0.0/8 -j DROP',
+                                 '-s 10.1.0.0/16 -p tcp -m tcp --dport 80 -j ACCEPT',
+                                 '-s 10.1.0.0/16 -j DROP',
+                                 '-s 11.0.0.0/8 -j DROP',
+                                 '-i eth+ -p tcp -m multiport --dports 20:30 -j ACCEPT',
+                                 '-i eth0 -p tcp -m tcp --dport 22 -m state --state NEW -j LOG',
+                                 '-i eth0 -p udp -m udp --dport 22 -j LOG'])
+        self.assertEqual(findings, [('shadowed', 2, 1), ('redundant', 3, 1), ('shadowed', 6, 5)])
+        print('...Done')
+
+    def testInterfaces(self):
+        print('Running Test Interfaces...')
+        findings = self.analyze(['-i eth0 -p tcp -j ACCEPT',
+                                 '-i eth1 -p tcp -j ACCEPT',
+                                 '-i eth0 -p tcp -m tcp --dport 22 -j ACCEPT',
+                                 '-i eth+ -j DROP',
+                                 '-i eth2 -p udp -j DROP',
+                                 '! -i eth3 -p udp -j ACCEPT',
+                                 '-i eth1 -j DROP',
+                                 '-p tcp -j ACCEPT',
+                                 '-i eth1 -p tcp -m tcp --dport 80 -j ACCEPT'])
+        self.assertEqual(findings, [('redundant', 3, 1), ('redundant', 5, 4), ('redundant', 7, 4),
+                                    ('redundant', 9, 2)])
+        print('...Done')
+
+    def testNotCovered(self):
+        print('Running Test Not Covered...')
+        # partial overlaps, negations, jumps and unknown matches never cover
+        findings = self.analyze(['-s 10.1.0.0/16 -j DROP',
+                                 '-s 10.0.0.0/8 -j DROP',
+                                 '! -s 192.168.0.0/16 -j other_chain',
+                                 '-s 172.16.0.0/12 -j ACCEPT',
+                                 '-p tcp -m limit --limit 5/sec -j ACCEPT',
+                                 '-p tcp -j ACCEPT',
+                                 '-p tcp -m tcp ! --dport 22 -j ACCEPT'], chains=['other_chain'])
+        self.assertEqual(findings, [('redundant', 7, 6)])
+        # options the classifier does not evaluate only compare equal
+        findings = self.analyze(['-p tcp -m tcp --tcp-flags SYN,RST SYN,RST -j DROP',
+                                 '-p tcp -m tcp --dport 22 -j ACCEPT',
+                                 '-p tcp -m conntrack --ctorigdst 10.0.0.1 -j DROP',
+                                 '-p tcp -m tcp --tcp-flags SYN,RST SYN,RST -j DROP',
+                                 '-p tcp -m tcp --dport 22 -m tcp --dport 22 -j DROP',
+                                 '-p tcp -m tcp --dport 22 -m tcp --dport 22 -j DROP'])
+        self.assertEqual(findings, [('redundant', 4, 1)])
+        print('...Done')
+
+    def testStates(self):
+        print('Running Test States...')
+        findings = self.analyze(['-m state --state NEW,ESTABLISHED -m conntrack --ctstate NEW,RELATED -j DROP',
+                                 '-m state --state NEW -j DROP',
+                                 '-m state --state RELATED -j DROP',
+                                 '-m state --state NEW -m state ! --state NEW -j DROP'])
+        # both state matches hold, so only NEW is covered
+        self.assertEqual(findings, [('redundant', 2, 1), ('redundant', 4, 1)])
+        print('...Done')
+
+    def testPolicyAndMergeable(self):
+        print('Running Test Policy And Mergeable...')
+        findings = self.analyze(['-p tcp -m tcp --dport 22 -j ACCEPT',
+                                 '-p tcp -m tcp --dport 80 -j ACCEPT',
+                                 '-p tcp -m tcp --dport 443 -j ACCEPT',
+                                 '-p udp -m udp --dport 53 -j ACCEPT',
+                                 '-p udp -j DROP',
+                                 '-j LOG',
+                                 '-p icmp -j DROP',
+                                 '-j DROP'], policy='DROP')
+        self.assertEqual(findings, [('mergeable', 1, (1, 2, 3)), ('mergeable', 2, (1, 2, 3)),
+                                    ('mergeable', 3, (1, 2, 3)),
+                                    ('redundant', 7, None), ('redundant', 8, None)])
+        # the DROP only looks removable because it shadows the ACCEPT after it
+        findings = self.analyze(['-p tcp -m tcp --dport 22 -j ACCEPT',
+                                 '-p tcp -j DROP',
+                                 '-p tcp -m tcp --dport 80 -j ACCEPT'], policy='DROP')
+        self.assertEqual(findings, [('shadowed', 3, 2)])
+        print('...Done')
+
+    def testRuleset(self):
+        print('Running Test Ruleset...')
+        chains = netfilter.parser.parse_save(classifier_filter)
+        # jumps to user chains do not cover what follows them
+        self.assertEqual(netfilter.analyzer.analyze(chains), [])
+        chains['INPUT']['rules'].append(netfilter.parser.parse_rule('-i lo -p tcp -j ACCEPT'))
+        findings = netfilter.analyzer.analyze(chains)
+        self.assertEqual([(finding.kind, finding.chain, finding.position, finding.related)
+                          for finding in findings], [('redundant', 'INPUT', 10, 2)])
+        print('...Done')
+
+
+class OptimizerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.chains = netfilter.parser.parse_save(iptables_data)
+        self.rules = self.chains['firewall_input_filter']['rules']
+
+    def testMergePorts(self):
+        print('Optimizer Test Case Set:\nRunning Test Merge Ports...')
+        rules = netfilter.optimizer.merge_ports(self.rules, self.chains)
+        self.assertEqual(len(rules), 9)
+        self.assertEqual(rules[6].specline(),
+                         '-p tcp -i eth0.161 -m multiport --dports 8089,8090,5222,7777,8080 -j ACCEPT')
+        self.assertEqual(rules[6].packets, 216515)
+        rules = netfilter.optimizer.merge_ports([Rule(protocol='tcp', matches=[Match('tcp', '--dport 22')],
+                                                      jump='ACCEPT'),
+                                                 Rule(protocol='tcp', matches=[Match('tcp', '--dport 80:90')],
+                                                      jump='ACCEPT')])
+        self.assertEqual([rule.specline() for rule in rules],
+                         ['-p tcp -m multiport --dports 22,80:90 -j ACCEPT'])
+        print('...Done')
+
+    def testReorder(self):
+        print('Running Test Reorder...')
+        rules = netfilter.optimizer.optimize_chain(self.rules, self.chains)
+        self.assertTrue(netfilter.optimizer.traversal_cost(rules) <
+                        netfilter.optimizer.traversal_cost(self.rules) / 2)
+        # ULOG does not decide, so the ACCEPT after it must stay after it
+        specs = [rule.specline() for rule in rules]
+        self.assertTrue(specs.index('-p tcp -m multiport --dports 22 -j ACCEPT') >
+                        specs.index([spec for spec in specs if 'ULOG' in spec][0]))
+        before = netfilter.classifier.Classifier(self.chains)
+        optimized = netfilter.parser.ODict()
+        for name in self.chains.keys():
+            optimized[name] = dict(self.chains[name])
+        optimized['firewall_input_filter']['rules'] = rules
+        after = netfilter.classifier.Classifier(optimized)
+        packets = []
+        for protocol in ('tcp', 'udp', 'icmp'):
+            for dport in (22, 53, 67, 80, 5222, 8080, 8089):
+                for interface in ('lo', 'eth0.161', 'eth0.171', 'eth1'):
+                    for state in ('NEW', 'ESTABLISHED'):
+                        packets.append(netfilter.classifier.Packet(protocol, '10.0.0.1', '10.0.0.2', 1024,
+                                                                   dport, interface, state=state))
+        self.assertEqual(after.classify_many('INPUT', packets), before.classify_many('INPUT', packets))
+        print('...Done')
+
+    def testOptimizeTable(self):
+        print('Running Test Optimize Table...')
+        backend = netfilter.simulator.SimulatorBackend()
+        table = netfilter.table.Table('filter', atomic_commit=True, backend=backend)
+        table.create_chain('firewall_input_filter')
+        for rule in self.rules:
+            table.append_rule('firewall_input_filter', rule)
+        table.append_rule('INPUT', Rule(jump='firewall_input_filter'))
+        for pos, rule in enumerate(self.rules):
+            backend.add_counters('firewall_input_filter', pos + 1, rule.packets, rule.bytes)
+        applied = netfilter.optimizer.optimize_table(table, ['firewall_input_filter'])
+        self.assertTrue(applied)
+        rules = table.list_rules('firewall_input_filter')
+        self.assertEqual(len(rules), 9)
+        expected = netfilter.optimizer.optimize_chain(self.rules, self.chains)
+        self.assertEqual([rule.specline() for rule in rules], [rule.specline() for rule in expected])
+        print('...Done')
+
+
+class DualStackTestCase(unittest.TestCase):
+    def setUp(self):
+        self.backend = netfilter.simulator.SimulatorBackend()
+        self.ipv6_backend = netfilter.simulator.SimulatorBackend()
+        self.firewall = netfilter.firewall.DualStackFirewall(backend=self.backend,
+                                                             ipv6_backend=self.ipv6_backend)
+
+    def testStart(self):
+        print('Dual Stack Test Case Set:\nRunning Test Start...')
+        self.assertEqual(self.firewall.run(['firewall', 'start']), 0)
+        self.assertEqual(len(self.firewall.ipv4.filter.list_rules('INPUT')), 8)
+        self.assertEqual(len(self.firewall.ipv6.filter.list_rules('INPUT')), 3)
+        self.firewall.accept_input('eth1')
+        self.assertEqual(len(self.firewall.ipv4.filter.get_buffer()), 1)
+        self.assertEqual(len(self.firewall.ipv6.filter.get_buffer()), 1)
+        self.firewall.commit()
+        self.assertEqual(self.firewall.get_buffer(), [[], []])
+        self.assertEqual(self.firewall.ipv6.filter.list_rules('INPUT')[-1].in_interface, 'eth1')
+        print('...Done')
+
+    def testParallel(self):
+        print('Running Test Parallel...')
+        self.backend.latency = self.ipv6_backend.latency = 0.01
+        self.firewall.start()
+        # IPv4 and IPv6 commands ran at the same time
+        self.assertTrue(overlapping(self.backend.intervals, self.ipv6_backend.intervals))
+        print('...Done')
+
+    def testProtocolSet(self):
+        print('Running Test Protocol Set...')
+        ports = [str(port) for port in range(8000, 8020)]
+        self.firewall.accept_protocol_set('eth0', 'tcp', ports, name='web')
+        self.assertEqual(self.backend.run(['ipset', 'save']), '')
+        self.firewall.commit()
+        for backend, stack in ((self.backend, self.firewall.ipv4), (self.ipv6_backend, self.firewall.ipv6)):
+            self.assertEqual(netfilter.ipset.IPSet('web-ports', 'bitmap:port', backend=backend).members(),
+                             set(ports))
+            self.assertIn('web-ports', stack.filter.list_rules('INPUT')[0].specbits())
+        print('...Done')
+
+    def testErrors(self):
+        print('Running Test Errors...')
+        self.firewall.ipv4.filter.append_rule('missing_chain', Rule(jump='ACCEPT'))
+        self.firewall.ipv6.filter.append_rule('missing_chain', Rule(jump='ACCEPT'))
+        self.firewall.ipv4.nat.append_rule('POSTROUTING', Rule(jump='MASQUERADE'))
+        try:
+            self.firewall.commit()
+            self.fail('commit should have failed')
+        except netfilter.firewall.CommitError as e:
+            print('\tError: ' + str(e))
+            self.assertEqual(sorted(e.errors), ['ipv4/filter', 'ipv6/filter'])
+        self.assertEqual(len(self.firewall.ipv4.nat.list_rules('POSTROUTING')), 1)
+        print('...Done')
+
+
+def overlapping(intervals, others):
+    """
+    Checks whether any (start, end) interval overlaps any of others
+
+    :param intervals
+    :param others
+    :return overlapping
+    """
+    return any(start < other_end and other_start < end
+               for start, end in intervals for other_start, other_end in others)
+
+
+class AsyncTestCase(unittest.TestCase):
+    def testTable(self):
+        print('Async Test Case Set:\nRunning Test Table...')
+        backend = netfilter.simulator.SimulatorBackend()
+        table = netfilter.aio.AsyncTable('filter', backend=backend)
+
+        async def scenario():
+            await table.create_chain('netfilter_test')
+            await table.create_chain('netfilter_test')
+            await table.append_rule('netfilter_test', Rule(protocol='tcp', jump='ACCEPT'))
+            await table.set_policy('INPUT', 'DROP')
+            return await table.list_rules('netfilter_test'), await table.get_policy('INPUT')
+
+        rules, policy = asyncio.run(scenario())
+        self.assertEqual(rules, [Rule(protocol='tcp', jump='ACCEPT')])
+        self.assertEqual(policy, 'DROP')
+        print('...Done')
+
+    def testConcurrentFirewalls(self):
+        print('Running Test Concurrent Firewalls...')
+        backends = [netfilter.simulator.SimulatorBackend(latency=0.005) for i in range(4)]
+        firewalls = [netfilter.aio.AsyncFirewall(backend=backend) for backend in backends]
+
+        async def scenario():
+            await asyncio.gather(*[firewall.start() for firewall in firewalls])
+            return await asyncio.gather(*[firewall.get_ruleset() for firewall in firewalls])
+
+        rulesets = asyncio.run(scenario())
+        for ruleset in rulesets:
+            self.assertEqual(ruleset['filter']['INPUT']['policy'], 'DROP')
+            self.assertEqual(len(ruleset['filter']['INPUT']['rules']), 8)
+        # the firewalls ran their commands at the same time
+        self.assertTrue(overlapping(backends[0].intervals, backends[1].intervals))
+        self.assertEqual(asyncio.run(firewalls[0].reconcile()), [])
+        print('...Done')
+
+    def testReconcileSemaphore(self):
+        print('Running Test Reconcile Semaphore...')
+        held = []
+
+        class CountingSemaphore(netfilter.aio.LoopSemaphore):
+            active = 0
+
+            async def __aenter__(self):
+                await netfilter.aio.LoopSemaphore.__aenter__(self)
+                self.active += 1
+
+            async def __aexit__(self, exc_type, exc, tb):
+                self.active -= 1
+                await netfilter.aio.LoopSemaphore.__aexit__(self, exc_type, exc, tb)
+
+        class CheckedBackend(netfilter.simulator.SimulatorBackend):
+            def load_table(self, cmd):
+                held.append(semaphore.active > 0)
+                return netfilter.simulator.SimulatorBackend.load_table(self, cmd)
+
+        semaphore = CountingSemaphore()
+
+        firewall = netfilter.aio.AsyncFirewall(backend=CheckedBackend(), semaphore=semaphore)
+
+        async def scenario():
+            await firewall.start()
+            del held[:]
+            return await firewall.reconcile()
+
+        self.assertEqual(asyncio.run(scenario()), [])
+        self.assertEqual(held, [True, True])
+        print('...Done')
+
+    def testRun(self):
+        print('Running Test Run...')
+        firewall = netfilter.aio.AsyncFirewall(backend=netfilter.simulator.SimulatorBackend())
+        self.assertEqual(firewall.run(['firewall', 'start']), 0)
+        self.assertEqual(firewall.filter.get_policy('INPUT'), 'DROP')
+        self.assertEqual(firewall.run(['firewall', 'reload']), 0)
+        self.assertEqual(firewall.run(['firewall', 'stop']), 0)
+        self.assertEqual(firewall.filter.get_policy('INPUT'), 'ACCEPT')
+        self.assertEqual(firewall.run(['firewall', 'bogus']), 1)
+        print('...Done')
+
 
 if __name__ == '__main__':
     unittest.main()